@@ -15,6 +15,7 @@ Documentation can be found online at https://webbpsf.readthedocs.io/
 
 import os
 import sys
+from importlib import import_module
 from warnings import warn
 from astropy import config as _config
 
@@ -51,6 +52,17 @@ class Conf(_config.ConfigNamespace):
 
     default_output_mode = _config.ConfigItem('both', "Should output include the oversampled PSF, a copy rebinned onto the integer detector spacing, or both? Options: 'oversampled','detector','both' ")
     default_fov_arcsec = _config.ConfigItem( 5.0, "Default field of view size, in arcseconds per side of the square ")
+    optsys_cache_size = _config.ConfigItem(4, "Number of optical systems to cache per instrument instance, for "
+            "reuse across repeated PSF calculations with an unchanged configuration. Set to 0 to disable caching.")
+    use_shared_memory_executor = _config.ConfigItem(False, "Should polychromatic PSF calculations be parallelized "
+            "over wavelength using a persistent pool of worker processes, with the optical system arrays held in "
+            "shared memory? This is an alternative to poppy.conf.use_multiprocessing; see webbpsf.parallel.")
+    cache_directory = _config.ConfigItem('default', "Directory in which to save computed data products that "
+            "can be reused between sessions, such as monochromatic PSF bases. 'default' uses a 'webbpsf' "
+            "subdirectory of the astropy cache directory.")
+    memmap_opd_files = _config.ConfigItem(True, "Should OPD files be read using memory mapping, so that only the "
+            "selected slice of an OPD datacube is loaded? Gzipped files are decompressed once into the cache "
+            "directory to allow this.")
 
 # Should be package settings:
     WEBBPSF_PATH = _config.ConfigItem('from_environment_variable','Directory path to data files required for WebbPSF calculations, such as OPDs and filter transmissions. This will be overridden by the environment variable $WEBBPSF_PATH, if present.')
@@ -108,38 +120,100 @@ if os.path.isfile(config_template):
         except:
             raise orig_error
 
-from . import utils
-from .utils import setup_logging, restart_logging, system_diagnostic, measure_strehl
-
-from poppy import ( display_psf, display_psf_difference, display_ee, measure_ee, # current names
-        display_profiles, radial_profile,
-        measure_radial, measure_fwhm, measure_sharpness, measure_centroid,
-        specFromSpectralType, fwcentroid)
-
-from .webbpsf_core import (Instrument, JWInstrument, NIRCam, NIRISS, NIRSpec,
-    MIRI, FGS)
-
-from .opds import enable_adjustable_ote
-
-from .roman import WFI, CGI
-
-# Temporally make "wfirst" available
-from . import roman as wfirst
+# Submodules, classes and functions are imported lazily on first access, so that
+# "import webbpsf" is quick and doesn't load poppy, pysiaf, matplotlib etc. until they
+# are actually needed (on Python 3.7 or later; see below).
+# Maps public name -> (module, attribute or None for a module)
+_LAZY_ATTRIBUTES = {
+    'utils': ('.utils', None),
+    'webbpsf_core': ('.webbpsf_core', None),
+    'optics': ('.optics', None),
+    'opds': ('.opds', None),
+    'distortion': ('.distortion', None),
+    'gridded_library': ('.gridded_library', None),
+    'spectral_basis': ('.spectral_basis', None),
+    'parallel': ('.parallel', None),
+    'data_registry': ('.data_registry', None),
+    'profiling': ('.profiling', None),
+    'constants': ('.constants', None),
+    'roman': ('.roman', None),
+    # Temporally make "wfirst" available
+    'wfirst': ('.roman', None),
+
+    'setup_logging': ('.utils', 'setup_logging'),
+    'restart_logging': ('.utils', 'restart_logging'),
+    'system_diagnostic': ('.utils', 'system_diagnostic'),
+    'measure_strehl': ('.utils', 'measure_strehl'),
+
+    'display_psf': ('poppy', 'display_psf'),
+    'display_psf_difference': ('poppy', 'display_psf_difference'),
+    'display_ee': ('poppy', 'display_ee'),
+    'measure_ee': ('poppy', 'measure_ee'),
+    'display_profiles': ('poppy', 'display_profiles'),
+    'radial_profile': ('poppy', 'radial_profile'),
+    'measure_radial': ('poppy', 'measure_radial'),
+    'measure_fwhm': ('poppy', 'measure_fwhm'),
+    'measure_sharpness': ('poppy', 'measure_sharpness'),
+    'measure_centroid': ('poppy', 'measure_centroid'),
+    'specFromSpectralType': ('poppy', 'specFromSpectralType'),
+    'fwcentroid': ('poppy', 'fwcentroid'),
+
+    'Instrument': ('.webbpsf_core', 'Instrument'),
+    'JWInstrument': ('.webbpsf_core', 'JWInstrument'),
+    'NIRCam': ('.webbpsf_core', 'NIRCam'),
+    'NIRISS': ('.webbpsf_core', 'NIRISS'),
+    'NIRSpec': ('.webbpsf_core', 'NIRSpec'),
+    'MIRI': ('.webbpsf_core', 'MIRI'),
+    'FGS': ('.webbpsf_core', 'FGS'),
+
+    'enable_adjustable_ote': ('.opds', 'enable_adjustable_ote'),
+
+    'WFI': ('.roman', 'WFI'),
+    'CGI': ('.roman', 'CGI'),
+
+    'show_notebook_interface': ('.jupyter_gui', 'show_notebook_interface'),
+    'wxgui': ('.wxgui', 'wxgui'),
+    'tkgui': ('.tkgui', 'tkgui'),
+}
+
+
+def _gui_available(module):
+    try:
+        import_module(module, __name__)
+        return True
+    except ImportError:
+        return False
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        module_name, attribute = _LAZY_ATTRIBUTES[name]
+        module = import_module(module_name, __name__)
+        value = module if attribute is None else getattr(module, attribute)
+    elif name == '_HAVE_WX_GUI':
+        value = _gui_available('.wxgui')
+    elif name == '_HAVE_TK_GUI':
+        value = _gui_available('.tkgui')
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value  # so subsequent lookups don't come through here again
+    return value
 
-from .jupyter_gui import show_notebook_interface
 
-try:
-    from .wxgui import wxgui
-    _HAVE_WX_GUI = True
-except ImportError:
-    _HAVE_WX_GUI = False
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
 
-try:
-    from .tkgui import tkgui
-    _HAVE_TK_GUI = True
-except ImportError:
-    _HAVE_TK_GUI = False
 
+if sys.version_info < (3, 7):
+    # Module __getattr__ (PEP 562) requires Python 3.7, so import everything up front instead
+    for _name in _LAZY_ATTRIBUTES:
+        try:
+            __getattr__(_name)
+        except (ImportError, AttributeError):
+            pass  # the optional GUIs, or functions not in the installed poppy version; as when lazy
+    __getattr__('_HAVE_WX_GUI')
+    __getattr__('_HAVE_TK_GUI')
+    del _name
 
 
 #if (_HAVE_WX_GUI or _HAVE_TK_GUI):
@@ -158,10 +232,11 @@ def gui(preferred='wx'):
 
 
     """
-    if preferred == 'wx' and _HAVE_WX_GUI:
+    if preferred == 'wx' and _gui_available('.wxgui'):
+        from .wxgui import wxgui
         wxgui()
-        pass
-    elif preferred=='ttk' or _HAVE_TK_GUI:
+    elif preferred=='ttk' or _gui_available('.tkgui'):
+        from .tkgui import tkgui
         tkgui()
     else:
         raise NotImplementedError("Neither TK nor WX GUI libraries are available. Cannot start GUI.")
@@ -0,0 +1,384 @@
+"""
+Process-wide registry of read-only instrument reference data.
+
+Creating an instrument instance needs the instrument's SIAF, its filter table and the list
+of available OPD files, and each optical system needs the SI WFE Zernike table and field
+interpolator. Parsing these is much slower than the rest of instrument setup, particularly
+for the SIAF XML files, so the registry loads each of them once per process and shares
+them between all instances of the same instrument.
+
+The registry also holds derived arrays which are costly to compute, such as the Zernike
+basis used to synthesize SI WFE OPDs. Large arrays are saved to the WebbPSF cache directory
+and memory mapped, so they are computed once and shared between processes; see
+`memory_usage` for the amount of array data held.
+
+The shared objects must be treated as read-only. Instrument instances receive their own
+copies of the mutable containers (filter lists and dicts) so these may still be modified
+per instance.
+
+Entries are keyed by the current WebbPSF data path where relevant, so changing
+``WEBBPSF_PATH`` transparently loads new data. If data files are modified in place, or
+pysiaf is updated within a running session, call `refresh` to discard the registry.
+"""
+
+from collections import namedtuple
+import glob
+import os
+import threading
+
+import numpy as np
+
+import logging
+
+_log = logging.getLogger('webbpsf')
+
+Filter = namedtuple('Filter', ['name', 'filename', 'default_nlambda'])
+InfluenceFunctions = namedtuple('InfluenceFunctions', ['table', 'segment_sensitivities', 'sm_sensitivities'])
+ThermalModelParameters = namedtuple('ThermalModelParameters', ['fit_data', 'segnames', 'sm_hexike', 'tau1', 'gn1',
+                                                               'tau2', 'gn2', 'units_scale'])
+
+_registry = {}
+_registry_lock = threading.RLock()
+
+
+def _get_or_load(key, loader):
+    """ Return the registry entry for key, calling loader() to create it if necessary """
+    with _registry_lock:
+        try:
+            return _registry[key]
+        except KeyError:
+            _log.debug(f"Loading {key[0]} for {key[1:]} into data registry")
+            value = _registry[key] = loader()
+            return value
+
+
+def refresh():
+    """ Discard all shared reference data, so that it will be reloaded from disk as needed.
+
+    Instrument instances which already exist keep their current data; create new instances
+    to pick up the reloaded data.
+    """
+    with _registry_lock:
+        _registry.clear()
+
+
+def memory_usage():
+    """ Return the number of bytes of array data held in the registry
+
+    Returns
+    -------
+    usage : dict
+        Totals for arrays loaded into memory, as 'in_memory', and arrays memory mapped
+        from files in the cache directory, as 'memory_mapped'.
+    """
+    usage = {'in_memory': 0, 'memory_mapped': 0}
+    with _registry_lock:
+        for value in _registry.values():
+            if isinstance(value, np.memmap):
+                usage['memory_mapped'] += value.nbytes
+            elif isinstance(value, np.ndarray):
+                usage['in_memory'] += value.nbytes
+    return usage
+
+
+def get_data_version(path):
+    """ Return the contents of the version.txt file of the WebbPSF data package in path.
+    Raises IOError if the file can't be read. """
+    def load():
+        with open(os.path.join(path, 'version.txt')) as f:
+            return f.read().strip()
+
+    return _get_or_load(('data_version', path), load)
+
+
+def get_siaf(siaf_name):
+    """ Return the shared pysiaf.Siaf instance for an instrument
+
+    Parameters
+    ----------
+    siaf_name : str
+        Instrument name, with capitalization as expected by pysiaf (e.g. 'NIRCam')
+    """
+    import pysiaf
+    return _get_or_load(('siaf', siaf_name), lambda: pysiaf.Siaf(siaf_name))
+
+
+def get_filters(basepath, instrument_name):
+    """ Return the available filters for an instrument, as read from its filters.tsv file
+
+    Returns
+    -------
+    filter_list : tuple
+        Filter names, in the order given in the table (generally by wavelength)
+    filters : dict
+        Filter named tuples with name, filename and default_nlambda, keyed by filter name.
+        This dict is shared, so callers should copy it before making any changes.
+    """
+    def load():
+        import astropy.io.ascii as ioascii
+        filter_table = ioascii.read(os.path.join(basepath, instrument_name, 'filters.tsv'))
+        filter_info = {}
+        filter_list = []  # preserve the order from the table
+
+        for filter_row in filter_table:
+            filter_filename = os.path.join(
+                basepath,
+                instrument_name,
+                'filters',
+                '{}_throughput.fits'.format(filter_row['filter'])
+            )
+            filter_info[filter_row['filter']] = Filter(
+                name=filter_row['filter'],
+                filename=filter_filename,
+                default_nlambda=filter_row['nlambda']
+            )
+            filter_list.append(filter_row['filter'])
+        return tuple(filter_list), filter_info
+
+    return _get_or_load(('filters', basepath, instrument_name), load)
+
+
+def get_opd_list(opd_path):
+    """ Return a sorted tuple of the OPD file names (OPD*.fits*) in a directory """
+    def load():
+        return tuple(sorted(os.path.basename(os.path.abspath(filename))
+                            for filename in glob.glob(os.path.join(opd_path, 'OPD*.fits*'))))
+
+    return _get_or_load(('opd_list', opd_path), load)
+
+
+def get_detector_geometry(siaf_name, aperturename):
+    """ Return a shared DetectorGeometry instance for a SIAF aperture """
+    from .webbpsf_core import DetectorGeometry
+    return _get_or_load(('detector_geometry', siaf_name, aperturename),
+                        lambda: DetectorGeometry(get_siaf(siaf_name), aperturename))
+
+
+def get_fits_data(filename):
+    """ Return the shared data array from the primary HDU of a FITS file, such as an
+    oversized pupil amplitude mask. The array is read-only; copy it to make changes.
+    """
+    def load():
+        from astropy.io import fits
+        data = fits.getdata(filename)
+        data.flags.writeable = False
+        return data
+
+    return _get_or_load(('fits_data', filename), load)
+
+
+def get_pupil_mask(filename, npix=None, cutout=None):
+    """ Return a shared pupil amplitude mask from the primary HDU of a FITS file, such as
+    an oversized internal pupil mask. The array is read-only; copy it to make changes.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the FITS file
+    npix : int, optional
+        Number of pixels across, to block average the mask down to. Must evenly
+        divide the size of the mask. By default, the mask is at its own sampling.
+    cutout : tuple of int, optional
+        Start and stop indices, along both axes, of the region of the file's array
+        to use, before any downsampling. By default, the whole array is used.
+    """
+    mask = get_fits_data(filename)
+    if cutout is not None:
+        start, stop = cutout
+        mask = mask[start:stop, start:stop]
+    if npix is None or npix == mask.shape[0]:
+        return mask
+
+    def load():
+        from .opds import _downsample_transmission
+        downsampled = _downsample_transmission(mask, npix)
+        downsampled.flags.writeable = False
+        return downsampled
+
+    return _get_or_load(('pupil_mask', filename, npix, cutout), load)
+
+
+def get_si_zernike_table(zernike_file):
+    """ Return the shared table of SI WFE Zernike coefficients from an ISIM CV3 Zernike file """
+    def load():
+        from astropy.table import Table
+        return Table.read(zernike_file)
+
+    return _get_or_load(('si_zernike_table', zernike_file), load)
+
+
+def get_si_wfe_interpolator(zernike_file, lookup_name, coronagraph=False):
+    """ Return a shared SIWFEFieldInterpolator for the SI WFE of one instrument
+
+    Parameters
+    ----------
+    zernike_file : str
+        Path to the Zernike coefficients table file
+    lookup_name : str
+        Value of the 'instrument' column for the desired rows, e.g. 'NIRCamSWA' or 'Guider1'
+    coronagraph : bool
+        Are these the measurements for the NIRCam coronagraph field?
+    """
+    def load():
+        from .optics import SIWFEFieldInterpolator
+        ztable = get_si_zernike_table(zernike_file)
+        return SIWFEFieldInterpolator(ztable[ztable['instrument'] == lookup_name], lookup_name=lookup_name,
+                                      coronagraph=coronagraph, zernike_file=zernike_file)
+
+    return _get_or_load(('si_wfe_interpolator', zernike_file, lookup_name, coronagraph), load)
+
+
+def get_zernike_basis(npix, nterms=36):
+    """ Return a shared single precision cube of Zernike polynomials on a circular pupil
+
+    The values are as from ``poppy.zernike.zernike_basis_faster(nterms, npix, outside=0)``,
+    in float32. The basis is saved to the 'zernike' subdirectory of the WebbPSF cache
+    directory the first time it is needed, and memory mapped from there, so the pages are
+    shared between processes. If the cache directory is not writable the basis is held in
+    memory instead.
+
+    Parameters
+    ----------
+    npix : int
+        Pupil diameter in pixels
+    nterms : int
+        Number of Zernike terms, in Noll order starting from piston
+    """
+    def load():
+        import tempfile
+        import poppy
+        from . import utils
+
+        def compute():
+            # bypass poppy's lru_cache, which would keep another, double precision, copy
+            zernike_basis = getattr(poppy.zernike.zernike_basis_faster, '__wrapped__',
+                                    poppy.zernike.zernike_basis_faster)
+            return zernike_basis(nterms=nterms, npix=npix, outside=0).astype(np.float32)
+
+        try:
+            cache_dir = utils.get_webbpsf_cache_dir('zernike')
+            filename = os.path.join(cache_dir, f"zernike_basis_{npix}_{nterms}_poppy{poppy.__version__}.npy")
+            if not os.path.exists(filename):
+                basis = compute()
+                fd, tmp_filename = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'wb') as outfile:
+                        np.save(outfile, basis)
+                    os.replace(tmp_filename, filename)  # atomic, in case of concurrent processes
+                except BaseException:
+                    os.remove(tmp_filename)
+                    raise
+            return np.load(filename, mmap_mode='r')
+        except OSError as err:
+            _log.warning(f"Could not cache the Zernike basis for npix={npix} ({err}); holding it in memory.")
+            return compute()
+
+    return _get_or_load(('zernike_basis', npix, nterms), load)
+
+
+def get_segment_masks(segment_mask_file, npix=None):
+    """ Return the shared, read-only, array of primary mirror segment masks
+
+    Parameters
+    ----------
+    segment_mask_file : str
+        Path to the segment mask FITS file
+    npix : int, optional
+        Number of pixels across, to downsample the masks to. Must evenly divide the
+        size of the file's array. By default, the masks are as in the file.
+    """
+    segment_masks = get_fits_data(segment_mask_file)
+    if npix is None or npix == segment_masks.shape[0]:
+        return segment_masks
+
+    def load():
+        from .opds import _downsample_segment_masks
+        downsampled = _downsample_segment_masks(segment_masks, npix)
+        downsampled.flags.writeable = False
+        return downsampled
+
+    return _get_or_load(('segment_masks', segment_mask_file, npix), load)
+
+
+def get_segment_hexike_basis(segment_mask_file, pixelscale, nterms=9, npix=None):
+    """ Return a shared SegmentHexikeBasis of the hexike values over each primary mirror segment
+
+    Parameters
+    ----------
+    segment_mask_file : str
+        Path to the segment mask FITS file
+    pixelscale : float
+        Pupil pixel scale in meters/pixel
+    nterms : int
+        Number of hexike terms
+    npix : int, optional
+        Number of pixels across the pupil, if the segment masks are downsampled
+    """
+    def load():
+        from .opds import SegmentHexikeBasis, _pupil_center_pixels
+        native_npix = get_fits_data(segment_mask_file).shape[0]
+        segment_masks = get_segment_masks(segment_mask_file, npix)
+        return SegmentHexikeBasis(segment_masks, pixelscale, nterms=nterms,
+                                  center=_pupil_center_pixels(native_npix, segment_masks.shape[0]))
+
+    return _get_or_load(('segment_hexike_basis', segment_mask_file, pixelscale, nterms, npix), load)
+
+
+def get_global_hexike_basis(segment_mask_file, nterms=9, npix=None):
+    """ Return a shared cube of hexike polynomials over the whole JWST primary mirror
+
+    Parameters
+    ----------
+    segment_mask_file : str
+        Path to the segment mask FITS file, which defines the aperture and sampling
+    nterms : int
+        Number of hexike terms, in the WSS ordering
+    npix : int, optional
+        Number of pixels across the pupil, if the segment masks are downsampled
+
+    Returns
+    -------
+    basis : ndarray
+        Read-only array with shape (nterms, npix, npix), zero outside of the aperture
+    """
+    def load():
+        import poppy
+        aperture = get_segment_masks(segment_mask_file, npix) != 0
+        basis = poppy.zernike.hexike_basis_wss(nterms=nterms, npix=aperture.shape[0], aperture=aperture)
+        basis[~np.isfinite(basis)] = 0.0
+        basis.flags.writeable = False
+        return basis
+
+    return _get_or_load(('global_hexike_basis', segment_mask_file, nterms, npix), load)
+
+
+def get_ote_influence_functions(filename):
+    """ Return the shared OTE influence functions, as used by OTE_Linear_Model_WSS
+
+    Returns
+    -------
+    influence_fns : InfluenceFunctions
+        Named tuple of the influence function table and the dense sensitivity matrices
+        compiled from it; see `webbpsf.opds._load_influence_functions`.
+    """
+    def load():
+        from .opds import _load_influence_functions
+        return _load_influence_functions(filename)
+
+    return _get_or_load(('ote_influence_functions', filename), load)
+
+
+def get_ote_thermal_model_parameters(filename):
+    """ Return the shared OTE thermal slew model fit parameters, as used by OteThermalModel
+
+    Returns
+    -------
+    fit_params : ThermalModelParameters
+        Named tuple of the fit parameters table and the arrays compiled from it;
+        see `webbpsf.opds._load_thermal_model_parameters`.
+    """
+    def load():
+        from .opds import _load_thermal_model_parameters
+        return _load_thermal_model_parameters(filename)
+
+    return _get_or_load(('ote_thermal_model_parameters', filename), load)
@@ -1,5 +1,3 @@
-import copy
-
 import astropy.convolution
 import astropy.io.fits as fits
 import numpy as np
@@ -7,6 +5,8 @@ import pysiaf
 from scipy.interpolate import griddata
 from scipy.ndimage.interpolation import rotate
 
+from . import data_registry
+
 
 def _get_default_siaf(instrument, aper_name):
     """
@@ -35,12 +35,21 @@ def _get_default_siaf(instrument, aper_name):
         siaf_name = instrument
 
     # Select a single SIAF aperture
-    siaf = pysiaf.Siaf(siaf_name)
+    siaf = data_registry.get_siaf(siaf_name)
     aper = siaf.apertures[aper_name]
 
     return aper
 
 
+def _copy_hdulist(hdu_list):
+    """ Copy an HDUList and its headers, sharing rather than copying the data arrays.
+
+    The functions here replace the data of the extension they modify, rather than
+    changing it in place, so the input PSF is left unchanged.
+    """
+    return fits.HDUList([hdu.__class__(data=hdu.data, header=hdu.header) for hdu in hdu_list])
+
+
 # Function for applying distortion from SIAF polynomials
 
 def apply_distortion(hdulist_or_filename=None, fill_value=0):
@@ -59,7 +68,8 @@ def apply_distortion(hdulist_or_filename=None, fill_value=0):
     Returns
     -------
     psf : HDUlist object
-        PSF with distortion applied from SIAF polynomial
+        PSF with distortion applied from SIAF polynomial. Extensions other than 1 share their
+        data arrays with the input PSF.
     """
 
     # Read in input PSF
@@ -70,8 +80,8 @@ def apply_distortion(hdulist_or_filename=None, fill_value=0):
     else:
         raise ValueError("input must be a filename or HDUlist")
 
-    # Create a copy of the PSF
-    psf = copy.deepcopy(hdu_list)
+    # Create a copy of the PSF, sharing the data of the unmodified extensions
+    psf = _copy_hdulist(hdu_list)
 
     # Log instrument and detector names
     instrument = hdu_list[0].header["INSTRUME"].upper()
@@ -143,8 +153,8 @@ def apply_distortion(hdulist_or_filename=None, fill_value=0):
     psf_new = griddata((xsci.flatten(), ysci.flatten()), psf[ext].data.flatten(), (xnew, ynew),
                        fill_value=fill_value)
 
-    # Apply data to correct extensions
-    psf[ext].data = psf_new
+    # Apply data to correct extensions, preserving the input precision
+    psf[ext].data = psf_new.astype(psf[ext].data.dtype, copy=False)
 
     # Set new header keywords
     psf[ext].header["DISTORT"] = ("True", "SIAF distortion coefficients applied")
@@ -184,7 +194,8 @@ def apply_rotation(hdulist_or_filename=None, rotate_value=None, crop=True):
     Returns
     -------
     psf : HDUlist object
-        PSF with rotation applied from SIAF values
+        PSF with rotation applied from SIAF values. Extensions other than 1 share their
+        data arrays with the input PSF.
     """
 
     # Read in input PSF
@@ -195,8 +206,8 @@ def apply_rotation(hdulist_or_filename=None, rotate_value=None, crop=True):
     else:
         raise ValueError("input must be a filename or HDUlist")
 
-    # Create a copy of the PSF
-    psf = copy.deepcopy(hdu_list)
+    # Create a copy of the PSF, sharing the data of the unmodified extensions
+    psf = _copy_hdulist(hdu_list)
 
     # Log instrument and detector names
     instrument = hdu_list[0].header["INSTRUME"].upper()
@@ -328,7 +339,8 @@ def apply_miri_scattering(hdulist_or_filename=None, kernel_amp=None):
     Returns
     -------
     psf : HDUlist object
-        PSF with MIRI detector scattering effect applied
+        PSF with MIRI detector scattering effect applied. Extensions other than 1 share their
+        data arrays with the input PSF.
     """
 
     # Read in input PSF
@@ -339,8 +351,8 @@ def apply_miri_scattering(hdulist_or_filename=None, kernel_amp=None):
     else:
         raise ValueError("input must be a filename or HDUlist")
 
-    # Create a copy of the PSF
-    psf = copy.deepcopy(hdu_list)
+    # Create a copy of the PSF, sharing the data of the unmodified extensions
+    psf = _copy_hdulist(hdu_list)
 
     # Log instrument name and filter
     instrument = hdu_list[0].header["INSTRUME"].upper()
@@ -380,8 +392,8 @@ def apply_miri_scattering(hdulist_or_filename=None, kernel_amp=None):
     # To ensure conservation of intensity, normalize the psf
     psf_new *= in_psf.sum() / psf_new.sum()
 
-    # Apply data to correct extensions
-    psf[ext].data = psf_new
+    # Apply data to correct extensions, preserving the input precision
+    psf[ext].data = psf_new.astype(in_psf.dtype, copy=False)
 
     # Set new header keywords
     psf[ext].header["MIR_DIST"] = ("True", "MIRI detector scattering applied")
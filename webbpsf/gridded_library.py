@@ -260,21 +260,38 @@ class CreatePSFLibrary:
 
             self.webb.detector = det
 
-            # For each of the locations on the detector (loc = tuple = (x,y))
-            for i, loc in enumerate(self.location_list):
-                self.webb.detector_position = loc  # (X,Y) - line 286 in webbpsf_core.py
+            if hasattr(self.webb, 'calc_psfs'):
+                # Compute all the locations in one batch, reusing the optical system setup between them
+                def progress(i, loc):
+                    if self.verbose is True:
+                        print("    Position {}/{}: {} pixels".format(i+1, len(self.location_list), loc))
 
-                if self.verbose is True:
-                    print("    Position {}/{}: {} pixels".format(i+1, len(self.location_list), loc))
+                psf_cube, psf_headers = self.webb.calc_psfs(self.location_list, progress=progress, **self._kwargs)
 
-                # Create PSF
-                psf = self.webb.calc_psf(**self._kwargs)
+                for i in range(len(self.location_list)):
+                    # Convolve PSF with a square kernel
+                    psf_arr[i, :, :] = astropy.convolution.convolve(psf_cube[ext].data[i], kernel)
 
-                # Convolve PSF with a square kernel
-                psf_conv = astropy.convolution.convolve(psf[ext].data, kernel)
+                # Pull header values below from the last PSF made
+                psf_header = psf_headers[-1][psf_cube.index_of(ext)]
+            else:
+                # For each of the locations on the detector (loc = tuple = (x,y))
+                for i, loc in enumerate(self.location_list):
+                    self.webb.detector_position = loc  # (X,Y) - line 286 in webbpsf_core.py
+
+                    if self.verbose is True:
+                        print("    Position {}/{}: {} pixels".format(i+1, len(self.location_list), loc))
+
+                    # Create PSF
+                    psf = self.webb.calc_psf(**self._kwargs)
+
+                    # Convolve PSF with a square kernel
+                    psf_conv = astropy.convolution.convolve(psf[ext].data, kernel)
+
+                    # Add PSF to 5D array
+                    psf_arr[i, :, :] = psf_conv
 
-                # Add PSF to 5D array
-                psf_arr[i, :, :] = psf_conv
+                psf_header = psf[ext].header
 
             # Normalize the output PSFs as expected by photutils.GriddedPSFModel:
             #  PSFs should be in surface brightness units, independent of oversampling.
@@ -289,15 +306,15 @@ class CreatePSFLibrary:
             meta["INSTRUME"] = (self.instr, "Instrument name")
             meta["DETECTOR"] = (det, "Detector name")
             meta["FILTER"] = (self.filter, "Filter name")
-            meta["PUPILOPD"] = (psf[ext].header["PUPILOPD"], "Pupil OPD source name")
-            meta['OPD_FILE'] = (psf[ext].header["OPD_FILE"], 'Pupil OPD file name')
-            meta['OPDSLICE'] = (psf[ext].header["OPDSLICE"], 'Pupil OPD slice number')
+            meta["PUPILOPD"] = (psf_header["PUPILOPD"], "Pupil OPD source name")
+            meta['OPD_FILE'] = (psf_header["OPD_FILE"], 'Pupil OPD file name')
+            meta['OPDSLICE'] = (psf_header["OPDSLICE"], 'Pupil OPD slice number')
 
             meta["FOVPIXEL"] = (self.fov_pixels, "Field of view in pixels (full array)")
-            meta["FOV"] = (psf[ext].header["FOV"], "Field of view in arcsec (full array)")
-            meta["OVERSAMP"] = (psf[ext].header["OVERSAMP"], "Oversampling factor for FFTs in computation")
-            meta["DET_SAMP"] = (psf[ext].header["DET_SAMP"], "Oversampling factor for MFT to detector plane")
-            meta["NWAVES"] = (psf[ext].header["NWAVES"], "Number of wavelengths used in calculation")
+            meta["FOV"] = (psf_header["FOV"], "Field of view in arcsec (full array)")
+            meta["OVERSAMP"] = (psf_header["OVERSAMP"], "Oversampling factor for FFTs in computation")
+            meta["DET_SAMP"] = (psf_header["DET_SAMP"], "Oversampling factor for MFT to detector plane")
+            meta["NWAVES"] = (psf_header["NWAVES"], "Number of wavelengths used in calculation")
 
             if self.webb.image_mask is not None:
                 meta["CORONMSK"] = (self.webb.image_mask, "Image plane mask")
@@ -319,49 +336,49 @@ class CreatePSFLibrary:
 
             # Distortion information
             if self.add_distortion:
-                meta["DISTORT"] = (psf[ext].header["DISTORT"], "SIAF distortion coefficients applied")
-                meta["SIAF_VER"] = (psf[ext].header["SIAF_VER"], "SIAF PRD version used")
+                meta["DISTORT"] = (psf_header["DISTORT"], "SIAF distortion coefficients applied")
+                meta["SIAF_VER"] = (psf_header["SIAF_VER"], "SIAF PRD version used")
 
-                for key in list(psf[ext].header.keys()):
+                for key in list(psf_header.keys()):
                     if "COEF_" in key:
-                        meta[key] = (psf[ext].header[key], "SIAF distortion coefficient for {}".format(key))
+                        meta[key] = (psf_header[key], "SIAF distortion coefficient for {}".format(key))
 
                 if self.instr in ["NIRCam", "NIRISS", "FGS"]:
-                    meta["ROTATION"] = (psf[ext].header["ROTATION"], "PSF rotated to match detector rotation")
+                    meta["ROTATION"] = (psf_header["ROTATION"], "PSF rotated to match detector rotation")
 
                 if self.instr is "MIRI":
-                    meta["MIR_DIST"] = (psf[ext].header["MIR_DIST"], "MIRI detector scattering applied")
-                    meta["KERN_AMP"] = (psf[ext].header["KERN_AMP"],
+                    meta["MIR_DIST"] = (psf_header["MIR_DIST"], "MIRI detector scattering applied")
+                    meta["KERN_AMP"] = (psf_header["KERN_AMP"],
                                         "Amplitude(A) in kernel function A * exp(-x / B)")
-                    meta["KERNFOLD"] = (psf[ext].header["KERNFOLD"],
+                    meta["KERNFOLD"] = (psf_header["KERNFOLD"],
                                         "e - folding length(B) in kernel func A * exp(-x / B)")
 
             # Pull values from the last made psf
-            meta["WAVELEN"] = (psf[ext].header["WAVELEN"], "Weighted mean wavelength in meters")
-            meta["DIFFLMT"] = (psf[ext].header["DIFFLMT"], "Diffraction limit lambda/D in arcsec")
-            meta["FFTTYPE"] = (psf[ext].header["FFTTYPE"], "Algorithm for FFTs: numpy or fftw")
-            meta["NORMALIZ"] = (psf[ext].header["NORMALIZ"], "PSF normalization method")
-            meta["TEL_WFE"] = (psf[ext].header["TEL_WFE"], "[nm] Telescope pupil RMS wavefront error")
+            meta["WAVELEN"] = (psf_header["WAVELEN"], "Weighted mean wavelength in meters")
+            meta["DIFFLMT"] = (psf_header["DIFFLMT"], "Diffraction limit lambda/D in arcsec")
+            meta["FFTTYPE"] = (psf_header["FFTTYPE"], "Algorithm for FFTs: numpy or fftw")
+            meta["NORMALIZ"] = (psf_header["NORMALIZ"], "PSF normalization method")
+            meta["TEL_WFE"] = (psf_header["TEL_WFE"], "[nm] Telescope pupil RMS wavefront error")
 
             # Copy values for per-segment Zernike {piston, tip, tilt}, if present
             # (these are only present or used in incoherent segment PSF generation with the
             # remove_piston_tip_tilt value set to True):
-            if 'S01PISTN' in psf[ext].header:
+            if 'S01PISTN' in psf_header:
                 # if we have one such keyword, assume we have them for all segments and all types
                 for i in range(1,19):
                     for ztype in ('PISTN', 'XTILT', 'YTILT'):
                         mykey = f"S{i:02d}{ztype}"
-                        meta[mykey] = (psf[ext].header[mykey], psf[ext].header.comments[mykey])
+                        meta[mykey] = (psf_header[mykey], psf_header.comments[mykey])
 
             # copy all the jitter-related keys (the exact set of keywords varies based on jitter type)
-            for k in psf[ext].header.keys():   # do the rest
+            for k in psf_header.keys():   # do the rest
                 if k.startswith('JITR'):
-                    meta[k] = (psf[ext].header[k], psf[ext].header.comments[k])
+                    meta[k] = (psf_header[k], psf_header.comments[k])
 
-            meta["DATE"] = (psf[ext].header["DATE"], "Date of calculation")
-            meta["AUTHOR"] = (psf[ext].header["AUTHOR"], "username@host for calculation")
-            meta["VERSION"] = (psf[ext].header["VERSION"], "WebbPSF software version")
-            meta["DATAVERS"] = (psf[ext].header["DATAVERS"], "WebbPSF reference data files version")
+            meta["DATE"] = (psf_header["DATE"], "Date of calculation")
+            meta["AUTHOR"] = (psf_header["AUTHOR"], "username@host for calculation")
+            meta["VERSION"] = (psf_header["VERSION"], "WebbPSF software version")
+            meta["DATAVERS"] = (psf_header["DATAVERS"], "WebbPSF reference data files version")
 
             # Create GriddedPSFModel object
             model = self.to_model(psf_arr, meta)
@@ -41,6 +41,7 @@ from collections import OrderedDict
 import poppy
 import poppy.zernike as zernike
 from . import constants
+from . import data_registry
 from . import surs
 from . import utils
 
@@ -88,7 +89,7 @@ class OPD(poppy.FITSOpticalElement):
     """
 
     def __init__(self, name='unnamed OPD', opd=None, opd_index=0, transmission=None,
-                 segment_mask_file='JWpupil_segments.fits',
+                 segment_mask_file='JWpupil_segments.fits', npix=None,
                  **kwargs):
         """
         Parameters
@@ -99,6 +100,10 @@ class OPD(poppy.FITSOpticalElement):
         transmission: str
             FITS file for pupil mask, with throughput from 0-1. If not explicitly provided, will be inferred from
             wherever is nonzero in the OPD file.
+        npix : int, optional
+            Number of pixels across the pupil, to downsample the OPD, pupil and segment masks to,
+            e.g. 256 or 512 for faster, lower fidelity calculations. Must evenly divide the size
+            of the input files. By default the input sampling, normally 1024 pixels, is kept.
 
 
         ext : int, optional
@@ -111,25 +116,43 @@ class OPD(poppy.FITSOpticalElement):
             _log.debug('Neither a pupil mask nor OPD were specified. Using the default JWST pupil.')
             transmission = os.path.join(utils.get_webbpsf_data_path(), "jwst_pupil_RevW_npix1024.fits.gz")
 
+        # Load just the one slice needed from OPD files, which may be large datacubes
+        opd_file = None
+        if isinstance(opd, str):
+            opd_file = opd
+        elif isinstance(opd, tuple) and len(opd) == 2 and isinstance(opd[0], str):
+            opd_file, opd_index = opd
+        if opd_file is not None:
+            opd = utils.load_fits_slice(opd_file, opd_index)
+
         super(OPD, self).__init__(name=name,
                                   opd=opd, transmission=transmission,
                                   opd_index=opd_index, transmission_index=0,
                                   planetype=poppy.poppy_core.PlaneType.pupil, **kwargs)
+        if opd_file is not None:
+            self.opd_file = opd_file
+            self.opd_slice = opd_index
 
         if self.opd_header is None:
             self.opd_header = self.amplitude_header.copy()
 
         self.segnames = np.asarray([a[0:2] for a in constants.SEGNAMES_WSS_ORDER])
 
+        native_npix = self.shape[0]
+        if npix is not None and npix != native_npix:
+            self._downsample(npix)
+
         full_seg_mask_file = os.path.join(utils.get_webbpsf_data_path(), segment_mask_file)
-        self._segment_masks = fits.getdata(full_seg_mask_file)
+        self._segment_mask_file = full_seg_mask_file
+        self._segment_masks = data_registry.get_segment_masks(full_seg_mask_file, npix=self.shape[0])
         self._segment_masks_version = fits.getheader(full_seg_mask_file)['VERSION']
 
         # Where are the centers of each segment?  From OTE design geometry
         self._seg_centers_m = {seg[0:2]: np.asarray(cen)
                                for seg, cen in constants.JWST_PRIMARY_SEGMENT_CENTERS}
         # convert the center of each segment to pixels for the current array sampling:
-        self._seg_centers_pixels = {seg[0:2]: self.shape[0] / 2 + np.asarray(cen) / self.pixelscale.value
+        center = _pupil_center_pixels(native_npix, self.shape[0])
+        self._seg_centers_pixels = {seg[0:2]: center + np.asarray(cen) / self.pixelscale.value
                                     for seg, cen in constants.JWST_PRIMARY_SEGMENT_CENTERS}
 
         # And what are the angles of the local control coordinate systems?
@@ -152,6 +175,27 @@ class OPD(poppy.FITSOpticalElement):
         self.name = name
         self.header = self.opd_header  # convenience reference
 
+    def _downsample(self, npix):
+        """ Block average the OPD and pupil transmission down to npix pixels across """
+        factor = self.shape[0] // npix
+        if self.shape != (npix * factor, npix * factor):
+            raise ValueError("npix={} must evenly divide the OPD size of {} pixels".format(npix, self.shape[0]))
+
+        def block_sum(array):
+            return array.reshape(npix, factor, npix, factor).sum(axis=(1, 3))
+
+        # The OPD is averaged over only the illuminated parts of each block
+        weights = block_sum(self.amplitude)
+        opd = block_sum(self.opd * self.amplitude)
+        self.opd = np.divide(opd, weights, out=np.zeros_like(opd), where=weights != 0)
+        self.amplitude = weights / factor ** 2
+
+        self.pixelscale = self.pixelscale * factor
+        for header in {id(h): h for h in (self.opd_header, self.amplitude_header) if h is not None}.values():
+            for key in ('PUPLSCAL', 'PIXELSCL'):
+                if key in header:
+                    header[key] = header[key] * factor
+
     def copy(self):
         """ Make a copy of a wavefront object """
         from copy import deepcopy
@@ -1050,6 +1094,210 @@ class OTE_Linear_Model_Elliott(OPD):
         print("After perturbation, segment %s has RMS WFE = %.1f nm" % (segment, rms))
 
 
+class SegmentHexikeBasis(object):
+    """ Hexike basis values over the pixels of each primary mirror segment
+
+    The hexikes use the same ordering as Ball does, in the unrotated coordinates centered
+    on each segment, as used by `OTE_Linear_Model_WSS`. The values are computed once, for
+    only the pixels within each segment, so that the OPD for a set of hexike coefficients is
+    synthesized with one small matrix product per segment instead of evaluating the hexikes
+    again over the whole pupil.
+
+    Instances are shared via `webbpsf.data_registry.get_segment_hexike_basis` and should be
+    treated as read-only.
+
+    Parameters
+    ----------
+    segment_masks : ndarray
+        Segment mask array, with values 1 to 18 for the segments in WSS order and 0 elsewhere.
+    pixelscale : float
+        Pupil pixel scale in meters/pixel
+    nterms : int
+        Number of hexike terms
+
+    Attributes
+    ----------
+    values : ndarray
+        Hexike values with shape (18, nterms, max_pixels), zero padded beyond the number of
+        pixels in each segment
+    indices : ndarray
+        Row and column indices of the pixels in each segment, with shape (2, 18, max_pixels)
+    counts : ndarray
+        Number of pixels in each segment
+    """
+
+    def __init__(self, segment_masks, pixelscale, nterms=9, center=None):
+        self.shape = segment_masks.shape
+        self.nterms = nterms
+        if center is None:
+            center = self.shape[0] / 2
+        segnames = [a[0:2] for a in constants.SEGNAMES_WSS_ORDER]
+        seg_centers_pixels = {seg[0:2]: center + np.asarray(cen) / pixelscale
+                              for seg, cen in constants.JWST_PRIMARY_SEGMENT_CENTERS}
+
+        wsegs = [np.where(segment_masks == iseg + 1) for iseg in range(18)]
+        self.counts = np.asarray([len(wseg[0]) for wseg in wsegs])
+        self.values = np.zeros((18, nterms, self.counts.max()))
+        self.indices = np.zeros((2, 18, self.counts.max()), dtype=np.intp)
+
+        for iseg, segment in enumerate(segnames):
+            rows, cols = wsegs[iseg]
+            n = self.counts[iseg]
+            self.indices[:, iseg, :n] = rows, cols
+
+            # determine the X and Y hexike coordinates for each segment
+            # FIXME this should just use the BATC-provided center coordinates; see jwst_ote3d.py
+            cx, cy = seg_centers_pixels[segment]
+            seg_radius = (cols.max() - cols.min()) / 2.0
+
+            _log.debug("Segment %s is centered at pixel loc (%.1f, %.1f) with radius %.1f pix" % (segment, cx, cy, seg_radius))
+
+            # These are the BATC "Control" coordinates for each segment
+            Yc = (rows - cy) / seg_radius
+            Xc = (cols - cx) / seg_radius
+
+            apmask = np.ones_like(Xc)  # by construction, we're only evaluating this for the good pixels
+
+            self.values[iseg, :, :n] = zernike.hexike_basis_wss(x=Xc, y=Yc, nterms=nterms, aperture=apmask)
+
+    def add_to_opd(self, opd, iseg, hexike_coeffs):
+        """ Add the OPD for hexike coefficients to one segment of an OPD array, in place
+
+        Parameters
+        ----------
+        opd : ndarray
+            OPD array to modify, or a stack of OPD arrays with shape (N, ny, nx)
+        iseg : int
+            Segment index, from 0 to 17 in WSS order
+        hexike_coeffs : iterable of floats
+            Hexike coefficients, up to nterms of them, or an (N, nterms) array
+            of coefficients for each OPD in a stack
+        """
+        hexike_coeffs = np.asarray(hexike_coeffs, dtype=float)
+        n = self.counts[iseg]
+        rows, cols = self.indices[:, iseg, :n]
+        opd[..., rows, cols] += np.einsum('...k,kn->...n', hexike_coeffs, self.values[iseg, :hexike_coeffs.shape[-1], :n])
+
+
+def _pupil_center_pixels(native_npix, npix):
+    """ Pixel coordinate of the center of the pupil, in an array block averaged down
+    from native_npix to npix pixels across. In the native sampling this is native_npix / 2. """
+    factor = native_npix // npix
+    return (native_npix / 2 - (factor - 1) / 2) / factor
+
+
+def _downsample_transmission(transmission, npix):
+    """ Block average a pupil transmission array down to npix pixels across, as in OPD._downsample """
+    factor = transmission.shape[0] // npix
+    if transmission.shape != (npix * factor, npix * factor):
+        raise ValueError("npix={} must evenly divide the transmission size of {} pixels".format(
+            npix, transmission.shape[0]))
+    return transmission.reshape(npix, factor, npix, factor).mean(axis=(1, 3))
+
+
+def _downsample_segment_masks(segment_masks, npix):
+    """ Downsample a segment mask array to npix pixels across, consistently with OPD._downsample.
+    Each block is assigned to whichever segment covers most of it, if any segment covers part of it. """
+    factor = segment_masks.shape[0] // npix
+    if segment_masks.shape != (npix * factor, npix * factor):
+        raise ValueError("npix={} must evenly divide the segment mask size of {} pixels".format(
+            npix, segment_masks.shape[0]))
+    blocks = segment_masks.reshape(npix, factor, npix, factor)
+    counts = np.stack([(blocks == iseg).sum(axis=(1, 3)) for iseg in range(1, 19)])
+    return np.where(counts.max(axis=0) > 0, counts.argmax(axis=0) + 1, 0).astype(segment_masks.dtype)
+
+
+def _write_chunks(chunks, out=None, filename=None, shape=None, header=None, overwrite=True):
+    """ Write chunks of results from a generator into an array, and/or stream them into a FITS file
+
+    Parameters
+    ----------
+    chunks : iterable of ndarrays
+        Chunks of results, concatenated along their first axis
+    out : ndarray, optional
+        Array to write the results into
+    filename : str, optional
+        FITS file to write the results into, as a single data array of the given shape
+    shape : tuple
+        Total shape of the results, required for writing to a FITS file
+    header : astropy.io.fits.Header, optional
+        Additional keywords for the FITS file
+    """
+    stream = None
+    if filename is not None:
+        if overwrite and os.path.exists(filename):
+            os.remove(filename)
+        stream_header = fits.Header()
+        stream_header['SIMPLE'] = True
+        stream_header['BITPIX'] = -64
+        stream_header['NAXIS'] = len(shape)
+        for i, length in enumerate(shape[::-1]):
+            stream_header['NAXIS{}'.format(i + 1)] = length
+        if header is not None:
+            stream_header.extend(header)
+        stream = fits.StreamingHDU(filename, stream_header)
+    try:
+        i = 0
+        for chunk in chunks:
+            if out is not None:
+                out[i:i + len(chunk)] = chunk
+            if stream is not None:
+                stream.write(np.ascontiguousarray(chunk, dtype=float))
+            i += len(chunk)
+    finally:
+        if stream is not None:
+            stream.close()
+
+
+def _load_influence_functions(filename):
+    """ Load the OTE influence function table, and compile it into dense sensitivity matrices
+
+    Returns
+    -------
+    influence_fns : webbpsf.data_registry.InfluenceFunctions
+        The table, with signs converted to the WSS convention, and the sensitivities in meters
+        of each segment's 9 hexike coefficients to the segment's own control modes, with shape
+        (18, 6, 9), and to the SM control modes, with shape (18, 5, 9). Segments are in WSS order
+        and control modes in the order of OTE_Linear_Model_WSS._control_modes and _sm_control_modes.
+    """
+    from .data_registry import InfluenceFunctions
+    table = astropy.table.Table.read(filename)
+
+    #fix IFM sign convention for consistency to WSS
+    cnames = table.colnames
+    for icol in cnames[3:]:
+        table[icol] *= -1
+
+    segment_moved = np.asarray(table['segment_moved'], dtype=str)
+    segment_affected = np.asarray(table['segment_affected'], dtype=str)
+    control_mode = np.asarray(table['control_mode'], dtype=str)
+    # this code requires ordering is the same as expected (but verifies that)
+    nhexike = 9
+    hexikes = np.stack([np.asarray(table['Hexike_{}'.format(h)], dtype=float) for h in range(nhexike)], axis=-1)
+
+    def compile_sensitivities(moved, control_modes):
+        sensitivities = np.zeros((18, len(control_modes), nhexike))
+        for iseg, segment in enumerate(constants.SEGNAMES_WSS_ORDER):
+            segment = segment[0:2]
+            wseg = np.where((segment_moved == (segment if moved is None else moved)) &
+                            (segment_affected == segment))[0]
+            assert len(wseg) == len(control_modes), 'Got wrong number of expected records from the table'
+            if list(control_mode[wseg]) != list(control_modes):
+                raise RuntimeError("Influence function table has unexpected ordering")
+            sensitivities[iseg] = hexikes[wseg]
+
+        # the coefficients are in the table natively in units of microns,
+        # as preferred by most Ball code. WebbPSF works natively in meters
+        # for wavefront, so we have to convert from microns to meters here:
+        sensitivities *= 1e-6
+        sensitivities.flags.writeable = False
+        return sensitivities
+
+    return InfluenceFunctions(table=table,
+                              segment_sensitivities=compile_sensitivities(None, OTE_Linear_Model_WSS._control_modes),
+                              sm_sensitivities=compile_sensitivities('SM', OTE_Linear_Model_WSS._sm_control_modes))
+
+
 class OTE_Linear_Model_WSS(OPD):
     """ Perturb an existing wavefront OPD file, by applying changes in WFE
     based on a linear optical model that is algorithmically consistent with the
@@ -1060,8 +1308,13 @@ class OTE_Linear_Model_WSS(OPD):
 
     """
 
+    # controllable modes in WAS order; yes it's not an obvious ordering but that's the order of the
+    # WAS influence function matrix for historical reasons.
+    _control_modes = ['Xtilt', 'Ytilt', 'Piston', 'Clocking', 'Radial', 'ROC']
+    _sm_control_modes = ['Xtilt', 'Ytilt', 'Xtrans', 'Ytrans', 'Piston']
+
     def __init__(self, name='Unnamed OPD', opd=None, opd_index=0, transmission=None, segment_mask_file='JWpupil_segments.fits',
-                 zero=False, rm_ptt=False, rm_piston=False, v2v3=None):
+                 zero=False, rm_ptt=False, rm_piston=False, v2v3=None, npix=None):
         """
         Parameters
         ----------
@@ -1087,21 +1340,18 @@ class OTE_Linear_Model_WSS(OPD):
 
         """
 
-        OPD.__init__(self, name=name, opd=opd, opd_index=opd_index, transmission=transmission, segment_mask_file=segment_mask_file)
+        OPD.__init__(self, name=name, opd=opd, opd_index=opd_index, transmission=transmission,
+                     segment_mask_file=segment_mask_file, npix=npix)
         self.v2v3 = v2v3
 
-        # load influence function table:
-        self._influence_fns = astropy.table.Table.read(os.path.join(__location__, 'otelm', 'JWST_influence_functions_control_with_sm.fits'))
-
-        #fix IFM sign convention for consistency to WSS
-        cnames = self._influence_fns.colnames
-        for icol in cnames[3:]:
-            self._influence_fns[icol] *= -1
+        # load influence function table, and the sensitivity matrices compiled from it.
+        # These are shared between instances, and must not be modified.
+        influence_fns = data_registry.get_ote_influence_functions(
+            os.path.join(__location__, 'otelm', 'JWST_influence_functions_control_with_sm.fits'))
+        self._influence_fns = influence_fns.table
+        self._seg_sensitivities = influence_fns.segment_sensitivities
+        self._sm_sensitivities = influence_fns.sm_sensitivities
 
-        self._control_modes = ['Xtilt', 'Ytilt', 'Piston', 'Clocking', 'Radial', 'ROC']
-        self._sm_control_modes = ['Xtilt', 'Ytilt', 'Xtrans', 'Ytrans', 'Piston']
-        # controllable modes in WAS order; yes it's not an obvious ordering but that's the order of the
-        # WAS influence function matrix for historical reasons.
         self.state = {}
         self.segment_state = np.zeros((19, 6), dtype=float)  # 18 segs, 6 controllable DOF each, plus SM
         self.segnames = np.asarray(list(self.segnames) + ['SM'])  # this model, unlike the above, knows about the SM.
@@ -1127,6 +1377,9 @@ class OTE_Linear_Model_WSS(OPD):
 
         self.meta = OrderedDict()  # container for arbitrary extra metadata
 
+        # Record of the perturbations applied by the last update_opd, for incremental updates
+        self._applied_opd_terms = None
+
         if zero:
             self.zero()
         else:
@@ -1136,6 +1389,13 @@ class OTE_Linear_Model_WSS(OPD):
 
     # ---- overall state manipulation
 
+    def copy(self):
+        """ Make a copy of a wavefront object """
+        output = super().copy()
+        # the copy's OPD may be modified in place, e.g. by OPD arithmetic, so the next update should rebuild it
+        output._applied_opd_terms = None
+        return output
+
     def reset(self):
         """ Reset an OPD to the state it was loaded from disk.
 
@@ -1143,6 +1403,7 @@ class OTE_Linear_Model_WSS(OPD):
         """
         self.opd = self._opd_original.copy()
         self.segment_state *= 0
+        self._applied_opd_terms = None
         _log.info("Reset to unperturbed OPD")
 
     def zero(self, zero_original=False):
@@ -1161,6 +1422,7 @@ class OTE_Linear_Model_WSS(OPD):
         self._thermal_wfe_amplitude = 0
         self._frill_wfe_amplitude = 0
         self._iec_wfe_amplitude = 0
+        self._applied_opd_terms = None
         if zero_original:
             self._opd_original *= 0
         self.name = "Null OPD"
@@ -1185,54 +1447,35 @@ class OTE_Linear_Model_WSS(OPD):
     # ---- segment manipulation via linear model
 
     def _get_seg_sensitivities(self, segment='A1'):
+        """ Return the sensitivities of a segment's 9 hexike coefficients, in meters,
+        to its 6 control modes, as a (6, 9) array """
         assert (segment in self.segnames)
-
-        # Get rows matching PMSA moves
-        wseg = np.where((np.asarray(self._influence_fns['segment_moved'], dtype=str) == segment) &
-                        (np.asarray(self._influence_fns['segment_affected'], dtype=str) == segment))
-        table = self._influence_fns[wseg]
-
-        coeffs = np.zeros((6, 9))
-        # this code requires ordering is the same as expected (but verifies that)
-        nhexike = 9
-
-        assert len(table) == len(self._control_modes), 'Got wrong number of expected records from the table'
-
-        for i, label in enumerate(self._control_modes):
-            if table[i]['control_mode'] != self._control_modes[i]:
-                raise RuntimeError("Influence function table has unexpected ordering")
-            for h in range(nhexike):
-                coeffs[i, h] = table[i]['Hexike_{}'.format(h)]
-
-        # the coefficients are in the table natively in units of microns,
-        # as preferred by most Ball code. WebbPSF works natively in meters
-        # for wavefront, so we have to convert from microns to meters here:
-        return coeffs * 1e-6
+        return self._seg_sensitivities[list(self.segnames).index(segment)].copy()
 
     def _get_seg_sensitivities_from_sm(self, segment='A1'):
+        """ Return the sensitivities of a segment's 9 hexike coefficients, in meters,
+        to the 5 SM control modes, as a (5, 9) array """
         assert (segment in self.segnames)
+        return self._sm_sensitivities[list(self.segnames).index(segment)].copy()
 
-        # Get rows matching PMSA moves
-        wseg = np.where((np.asarray(self._influence_fns['segment_moved'], dtype=str) == 'SM') &
-                        (np.asarray(self._influence_fns['segment_affected'], dtype=str) == segment))
-        table = self._influence_fns[wseg]
+    def _get_hexike_coeffs_from_state(self, segment_state):
+        """ Convert segment poses to hexike coefficients for each segment
 
-        coeffs = np.zeros((5, 9))
-        # this code requires ordering is the same as expected (but verifies that)
-        nhexike = 9
-
-        assert len(table) == len(self._sm_control_modes), 'Got wrong number of expected records from the table'
-
-        for i, label in enumerate(self._sm_control_modes):
-            if table[i]['control_mode'] != self._sm_control_modes[i]:
-                raise RuntimeError("Influence function table has unexpected ordering")
-            for h in range(nhexike):
-                coeffs[i, h] = table[i]['Hexike_{}'.format(h)]
+        Parameters
+        ----------
+        segment_state : ndarray
+            Segment and SM poses in control coordinates, with shape (..., 19, 6) like segment_state
 
-        # the coefficients are in the table natively in units of microns,
-        # as preferred by most Ball code. WebbPSF works natively in meters
-        # for wavefront, so we have to convert from microns to meters here:
-        return coeffs * 1e-6
+        Returns
+        -------
+        hexike_coeffs, hexike_coeffs_from_sm : ndarray
+            Hexike coefficients in meters for each segment, with shape (..., 18, 9), due to the motion
+            of that segment and due to the motion of the SM respectively
+        """
+        segment_state = np.asarray(segment_state)
+        hexike_coeffs = np.einsum('...sm,smh->...sh', segment_state[..., 0:18, :], self._seg_sensitivities)
+        hexike_coeffs_from_sm = np.einsum('...m,smh->...sh', segment_state[..., 18, 0:5], self._sm_sensitivities)
+        return hexike_coeffs, hexike_coeffs_from_sm
 
     def _apply_hexikes_to_seg(self, segment, hexike_coeffs, debug=False):
         """ Apply Hexike perturbations to a given segment, using the
@@ -1245,40 +1488,26 @@ class OTE_Linear_Model_WSS(OPD):
         hexike_coeffs : iterable of floats
             Zernike coefficients, in units of meters
         """
-        assert (segment in self.segnames)
-
-        iseg = np.where(self.segnames == segment)[0][0] + 1  # segment index from 1 - 18
-        wseg = np.where(self._segment_masks == iseg)
+        self._remove_seg_ptt(segment, hexike_coeffs)
 
         # Note that the influence function matrix values already take into
         # account the rotations between segment coordinate systems.
-        # so here we can just work in unrotated coordinates.
-
-        # determine the X and Y hexike coordinates for each segment
-        # determine the center of each segment, as the mean of the min and max X and Y values
-        # FIXME this should just use the BATC-provided center coordinates; see jwst_ote3d.py
-
-        Y, X = np.indices(self.opd.shape, dtype=float)
-        cx, cy = self._seg_centers_pixels[segment]
-        # cx = np.mean([X[wseg].min(), X[wseg].max()])
-        # cy = np.mean([Y[wseg].min(), Y[wseg].max()])
-
-        seg_radius = (X[wseg].max() - X[wseg].min()) / 2.0
-
-        _log.debug("Segment %s is centered at pixel loc (%.1f, %.1f) with radius %.1f pix" % (segment, cx, cy, seg_radius))
+        # so here we can just work in unrotated coordinates, for which the hexike
+        # values over each segment are precomputed.
+        iseg = np.where(self.segnames == segment)[0][0]
+        self._get_segment_hexike_basis().add_to_opd(self.opd, iseg, hexike_coeffs)
 
-        # These are the BATC "Control" coordinates for each segment
-        Y = (Y - cy) / seg_radius
-        X = (X - cx) / seg_radius
-        # cut out just the values of interest inside this segment.
-        Xc = X[wseg]
-        Yc = Y[wseg]
+        # outtxt="Hs=["+", ".join(['%.1e'%z for z in hexike_coeffs])+"]"
+        # _log.debug("     "+outtxt)
 
-        apmask = np.ones_like(Xc)  # by construction, we're only evaluating this for the good pixels
+    def _remove_seg_ptt(self, segment, hexike_coeffs):
+        """ Remove piston, tip and tilt from a segment's hexike coefficients, in place, if
+        the remove_piston_tip_tilt or remove_piston_only options are set, and record
+        the removed values in self.meta.
+        """
+        assert (segment in self.segnames)
 
-        hexikes = zernike.hexike_basis_wss(x=Xc, y=Yc, nterms=len(hexike_coeffs),
-                                           aperture=apmask)
-        # returns a list of hexike array values each with the same shape as Xc
+        iseg = np.where(self.segnames == segment)[0][0] + 1  # segment index from 1 - 18
 
         if self.remove_piston_tip_tilt:
             # Save the values of the PTT we are removing, for optional reference elsewhere
@@ -1300,26 +1529,34 @@ class OTE_Linear_Model_WSS(OPD):
             except:
                 pass
 
-        for i in range(len(hexike_coeffs)):
-            if hexike_coeffs[i] == 0:
-                continue
-            self.opd[wseg] += hexikes[i] * hexike_coeffs[i]
-
-        # outtxt="Hs=["+", ".join(['%.1e'%z for z in hexike_coeffs])+"]"
-        # _log.debug("     "+outtxt)
+    def _get_segment_hexike_basis(self):
+        """ Return the shared SegmentHexikeBasis for this OPD's segment masks and sampling """
+        return data_registry.get_segment_hexike_basis(self._segment_mask_file, self.pixelscale.to_value(u.m / u.pixel),
+                                                      npix=self.shape[0])
 
-    def _apply_global_zernikes(self):
+    def _apply_global_zernikes(self, coefficients=None):
         """ Apply Zernike perturbations to the whole primary
 
+        Parameters
+        ----------
+        coefficients : ndarray. By default this applies the self._global_zernike_coeffs values, but
+            you can overtide that by optionally providing different coefficients to this function
         """
 
-        if not self.opd.shape == (1024, 1024):
-            raise NotImplementedError("Code need to be generalized for OPD sizes other than 1024**2")
-        perturbation = poppy.zernike.opd_from_zernikes(self._global_zernike_coeffs,
-                                                       npix=1024,
-                                                       basis=poppy.zernike.zernike_basis_faster)
-        # Add perturbation to the opd
-        self.opd += perturbation
+        if coefficients is None:
+            coefficients = self._global_zernike_coeffs
+
+        npix = self.opd.shape[0]
+        if not self.opd.shape == (npix, npix):
+            raise NotImplementedError("Global Zernikes are only supported for square OPD arrays")
+        # The Zernikes are defined over the circle inscribed in the OPD array, and zero outside it
+        # Use the leading terms of the shared single precision basis, as for the SI WFE,
+        # adding each term to the OPD in double precision
+        nterms = len(coefficients)
+        basis = data_registry.get_zernike_basis(npix, max(nterms, 36))
+        for coeff, term in zip(np.asarray(coefficients, dtype=float), basis[:nterms]):
+            if coeff != 0:
+                self.opd += np.multiply(coeff, term, dtype=float)
 
     def _apply_global_hexikes(self, coefficients=None):
         """ Apply Hexike perturbations to the whole primary
@@ -1333,22 +1570,19 @@ class OTE_Linear_Model_WSS(OPD):
         if coefficients is None:
             coefficients = self._global_hexike_coeffs
 
-        def _get_basis(*args, **kwargs):
-            """ Convenience function to make basis callable """
-            return basis
-        # Define aperture as the full OTE
-        aperture = self._segment_masks != 0
-        # Get size of mask (1024)
-        npix = np.shape(aperture)[0]
-        basis = poppy.zernike.hexike_basis_wss(nterms=9, npix=npix, aperture=aperture > 0.)
-        # Use the Hexike basis to reconstruct the global terms
-        perturbation = poppy.zernike.opd_from_zernikes(coefficients,
-                                                       basis=_get_basis,
-                                                       aperture=aperture > 0.)
-        perturbation[~np.isfinite(perturbation)] = 0.0
+        basis = self._get_global_hexike_basis()
+        # Use the Hexike basis to reconstruct the global terms. Only as many terms as
+        # are in the basis are used.
+        coefficients = np.asarray(coefficients, dtype=float)[:len(basis)]
+        perturbation = np.dot(coefficients, basis.reshape(len(basis), -1)).reshape(self.opd.shape)
         # Add perturbation to the opd
         self.opd += perturbation
 
+    def _get_global_hexike_basis(self, nterms=9):
+        """ Return the shared hexike basis over the whole primary, as an (nterms, npix, npix) array
+        which is zero outside of the aperture """
+        return data_registry.get_global_hexike_basis(self._segment_mask_file, nterms=nterms, npix=self.shape[0])
+
     def _apply_field_dependence_model(self):
         """Apply field dependence model for OTE wavefront error spatial variation.
 
@@ -1918,6 +2152,18 @@ class OTE_Linear_Model_WSS(OPD):
             Segment to be fit. 'SM' will fit the global focus term. Any other
             segment name will fits 9 Hexikes to that segment
         """
+        coeffs = self._thermal_model.get_coeffs(segid, self.delta_time)
+        return self._get_thermal_slew_scaling()*coeffs
+
+    def _get_thermal_slew_coeffs_all(self, delta_times):
+        """ Get the WSS Hexike coefficients of the thermal slew model for all segments and the SM,
+        with shape delta_times.shape + (19, 9), for times in days after a slew with the current angles
+        or scaling. See OteThermalModel.get_coeffs_all.
+        """
+        return self._get_thermal_slew_scaling() * self._thermal_model.get_coeffs_all(delta_times)
+
+    def _get_thermal_slew_scaling(self):
+        """ Scaling factor of the thermal slew model, from the slew angles or the scaling set by thermal_slew """
         if not self.scaling:
             num = np.sin(np.radians(self.end_angle)) - np.sin(np.radians(self.start_angle))
             den = np.sin(np.radians(45.)) - np.sin(np.radians(-5.))
@@ -1925,47 +2171,54 @@ class OTE_Linear_Model_WSS(OPD):
 
         else:
             scaling = self.scaling
-
-        coeffs = self._thermal_model.get_coeffs(segid, self.delta_time)
-        return scaling*coeffs
+        return scaling
 
 
-    def update_opd(self, display=False, verbose=False):
+    def update_opd(self, display=False, verbose=False, full_rebuild=False):
         """ Update the OPD based on the current linear model values.
 
         Users typically only need to call this directly if they have set the
         "delay_update" parameter to True in some function call to move mirrors.
 
-        """
+        By default, if the OPD was computed by a previous update, only the changes in
+        each segment's hexike coefficients since then are added, to the pixels of just the
+        segments which changed, and likewise for the global hexike and Zernike terms. Any
+        changes in the v2v3 field position or the piston/tip/tilt removal options trigger a
+        full rebuild instead. Note
+        that changes made directly to the opd array are not detected; call this with
+        full_rebuild=True after doing so, or use reset() first.
 
-        # always start from the input OPD, then apply perturbations
-        self.opd = self._opd_original.copy()
+        Parameters
+        ----------
+        display : bool
+            Display the OPD after updating it
+        verbose : bool
+            Print the segment poses and resulting hexike coefficients
+        full_rebuild : bool
+            Rebuild the whole OPD starting from the original input OPD, rather than
+            only applying changes since the last update.
+        """
 
         sm = 18
         sm_pose_coeffs = self.segment_state[sm].copy()[0:5]  # 6th row is n/a for SM
-        sm_pose_coeffs.shape = (5, 1)  # to allow broadcasting below
-
 
         total_segment_state = self.segment_state + self._get_frill_drift_poses() + self._get_iec_drift_poses()
+        total_segment_state[sm] = self.segment_state[sm]
+
+        # Convert all the segment and SM poses to hexike coefficients for each segment at once
+        all_hexike_coeffs, all_hexike_coeffs_from_sm = self._get_hexike_coeffs_from_state(total_segment_state)
+        all_hexike_coeffs_from_thermal = self._get_thermal_slew_coeffs_all(self.delta_time)
 
+        segment_hexike_coeffs = np.zeros((18, 9))
         for iseg, segname in enumerate(self.segnames[0:18]):
-            pose_coeffs = total_segment_state[iseg].copy()
+            pose_coeffs = total_segment_state[iseg]
             if np.all(pose_coeffs == 0) and np.all(sm_pose_coeffs == 0) and self.delta_time==0:
                 continue
             else:
-
-                sensitivities = self._get_seg_sensitivities(segname)
-                pose_coeffs.shape = (6, 1)  # to allow broadcasting in next line
-
-                hexike_coeffs = sensitivities * pose_coeffs  # this will be a 6,9 array
-                hexike_coeffs = hexike_coeffs.sum(axis=0)  # sum across all controlled modes
-                # to yield a set of 9 overall coeffs
-
-                sm_sensitivities = self._get_seg_sensitivities_from_sm(segname)
-                hexike_coeffs_from_sm = sm_sensitivities * sm_pose_coeffs  # will be 5,9 array
-                hexike_coeffs_from_sm = hexike_coeffs_from_sm.sum(axis=0)  # sum to get 9
-                hexike_coeffs_from_thermal = self._get_thermal_slew_coeffs(segname)
-                hexike_coeffs_combined = hexike_coeffs + hexike_coeffs_from_sm + hexike_coeffs_from_thermal
+                hexike_coeffs = all_hexike_coeffs[iseg]
+                hexike_coeffs_from_sm = all_hexike_coeffs_from_sm[iseg]
+                hexike_coeffs_from_thermal = all_hexike_coeffs_from_thermal[iseg]
+                segment_hexike_coeffs[iseg] = hexike_coeffs + hexike_coeffs_from_sm + hexike_coeffs_from_thermal
 
                 if verbose:
                     print("Need to move segment {} by {} ".format(segname, pose_coeffs.flatten()))
@@ -1973,24 +2226,296 @@ class OTE_Linear_Model_WSS(OPD):
                     print("plus segment moved by {} due to thermal contribution".format(hexike_coeffs_from_thermal))
                     print("   Hexike coeffs for {}: {}".format(segname, hexike_coeffs))
 
-                self._apply_hexikes_to_seg(segname, hexike_coeffs_combined)
+                self._remove_seg_ptt(segname, segment_hexike_coeffs[iseg])
 
         # The thermal slew model for the SM global defocus is implemented as a global hexike.
         # So we have to combine that with the _global_hexikes array here
         global_hexike_coeffs_combined = self._global_hexike_coeffs.copy()
         if self.delta_time != 0.0:
-            global_hexike_coeffs_combined[4] += self._get_thermal_slew_coeffs('SM')
+            global_hexike_coeffs_combined[0:9] += all_hexike_coeffs_from_thermal[sm]
+
+        applied = self._applied_opd_terms
+        options = (self.remove_piston_tip_tilt, self.remove_piston_only,
+                   None if self.v2v3 is None else tuple(u.Quantity(self.v2v3, u.arcsec).value))
+        if full_rebuild or applied is None or applied['opd'] is not self.opd or applied['options'] != options:
+            # start from the input OPD, then apply perturbations
+            self.opd = self._opd_original.copy()
+            changed_segment_coeffs = segment_hexike_coeffs
+            changed_global_hexike_coeffs = global_hexike_coeffs_combined
+            changed_global_zernike_coeffs = self._global_zernike_coeffs
+            apply_field_dependence = True
+        else:
+            changed_segment_coeffs = segment_hexike_coeffs - applied['segment_hexike_coeffs']
+            changed_global_hexike_coeffs = global_hexike_coeffs_combined - applied['global_hexike_coeffs']
+            changed_global_zernike_coeffs = self._global_zernike_coeffs - applied['global_zernike_coeffs']
+            apply_field_dependence = False
+
+        # Apply segment hexikes, only to the segments which changed
+        basis = self._get_segment_hexike_basis()
+        for iseg in np.where(np.any(changed_segment_coeffs != 0, axis=1))[0]:
+            basis.add_to_opd(self.opd, iseg, changed_segment_coeffs[iseg])
 
         # Apply Global Zernikes, and/or hexikes
-        if not np.all(global_hexike_coeffs_combined == 0):
-            self._apply_global_hexikes(global_hexike_coeffs_combined)
-        if not np.all(self._global_zernike_coeffs == 0):
-            self._apply_global_zernikes()
-        self._apply_field_dependence_model()
+        if not np.all(changed_global_hexike_coeffs == 0):
+            self._apply_global_hexikes(changed_global_hexike_coeffs)
+        if not np.all(changed_global_zernike_coeffs == 0):
+            self._apply_global_zernikes(changed_global_zernike_coeffs)
+        if apply_field_dependence:
+            self._apply_field_dependence_model()
+
+        self._applied_opd_terms = {'opd': self.opd,
+                                   'options': options,
+                                   'segment_hexike_coeffs': segment_hexike_coeffs,
+                                   'global_hexike_coeffs': global_hexike_coeffs_combined,
+                                   'global_zernike_coeffs': self._global_zernike_coeffs.copy()}
 
         if display:
             self.display()
 
+    def check_update_consistency(self, atol=1e-15):
+        """ Check that the current OPD matches rebuilding it from the original OPD
+
+        This verifies that incremental updates of the OPD have not diverged from the result of
+        a full rebuild, beyond floating point round off. The model state is not changed.
+
+        Parameters
+        ----------
+        atol : float
+            Maximum allowed absolute difference in meters
+
+        Returns
+        -------
+        max_diff : float
+            Maximum absolute difference between the current and rebuilt OPDs, in meters
+        """
+        opd, meta, applied = self.opd, self.meta.copy(), self._applied_opd_terms
+        try:
+            self.update_opd(full_rebuild=True)
+            rebuilt = self.opd
+        finally:
+            self.opd, self.meta, self._applied_opd_terms = opd, meta, applied
+
+        if not np.array_equal(np.isfinite(opd), np.isfinite(rebuilt)):
+            raise RuntimeError("OPD does not match a full rebuild: the undefined pixels differ")
+        good = np.isfinite(opd)
+        max_diff = np.abs(opd[good] - rebuilt[good]).max() if good.any() else 0.0
+        if max_diff > atol:
+            raise RuntimeError("OPD differs from a full rebuild by up to {:.3g} m".format(max_diff))
+        return max_diff
+
+    def opds_from_states(self, states, delta_times=None, frill_amplitudes=None, iec_amplitudes=None,
+                         chunk_size=16, out=None):
+        """ Compute the OPDs for many mirror states at once
+
+        Each OPD is the same as would be computed by update_opd after setting segment_state
+        to the corresponding state, and applying the corresponding thermal slew time and frill
+        and IEC drift amplitudes. The other terms, i.e. the original OPD, the global Zernike and
+        hexike coefficients, the thermal slew angles, scaling and case, and the piston/tip/tilt
+        removal options, are taken from the current model. The model itself is not changed,
+        and no metadata is recorded for each OPD.
+
+        Parameters
+        ----------
+        states : ndarray
+            Segment and SM poses in control coordinates, with shape (N, 19, 6) like segment_state
+        delta_times : astropy.units.Quantity or ndarray, optional
+            Time after slew for the thermal slew model for each state; default units are hours.
+            By default the current delta_time of the model is used for all states.
+        frill_amplitudes, iec_amplitudes : ndarray, optional
+            Frill and IEC drift amplitudes in nm rms for each state. By default, the current
+            amplitudes of the model are used for all states.
+        chunk_size : int
+            Number of OPDs to compute together
+        out : ndarray, optional
+            Array with shape (N, ny, nx), e.g. a numpy.memmap, to write the OPDs into.
+
+        Returns
+        -------
+        opds : generator or ndarray
+            If out is None, a generator yielding arrays of up to chunk_size OPDs at a time, in meters.
+            Otherwise, out, filled with the OPDs.
+        """
+        states = np.asarray(states, dtype=float)
+        if states.ndim != 3 or states.shape[1:] != (19, 6):
+            raise ValueError("states must have shape (N, 19, 6)")
+        nstates = len(states)
+
+        delta_times, frill_amplitudes, iec_amplitudes = self._get_drift_parameters(nstates, delta_times,
+                                                                                   frill_amplitudes, iec_amplitudes)
+
+        def iter_opds():
+            base_opd = self._get_static_opd()
+            for start in range(0, nstates, chunk_size):
+                chunk = slice(start, start + chunk_size)
+                coeffs = self._get_coeffs_from_states(states[chunk], delta_times[chunk],
+                                                      frill_amplitudes[chunk], iec_amplitudes[chunk])
+                yield self._get_opds_from_coeffs(*coeffs, base_opd=base_opd)
+
+        if out is not None:
+            if out.shape != (nstates,) + self.opd.shape:
+                raise ValueError("out must have shape {}".format((nstates,) + self.opd.shape))
+            _write_chunks(iter_opds(), out=out)
+            return out
+        return iter_opds()
+
+    def opd_time_series(self, times, frill_amplitudes=None, iec_amplitudes=None, coefficients=False,
+                        deltas=False, chunk_size=16, out=None, filename=None, overwrite=True):
+        """ Compute the time evolution of the OPD due to thermal slew, frill and IEC drifts
+
+        This combines the models of thermal_slew, apply_frill_drift and apply_iec_drift for a sequence
+        of times, with the segment poses and all other terms fixed at the current state of the model.
+        The thermal slew model uses the current slew angles or scaling and case as set by thermal_slew.
+        Each result is the same as would be computed by update_opd after setting the thermal slew time
+        and the frill and IEC drift amplitudes, but is computed without changing the model, and for many
+        times at once.
+
+        Parameters
+        ----------
+        times : astropy.units.Quantity or ndarray
+            Times after the slew for the thermal slew model; default units are hours.
+        frill_amplitudes, iec_amplitudes : ndarray, optional
+            Frill and IEC drift amplitudes in nm rms at each time. By default, the current amplitudes
+            of the model are used for all times.
+        coefficients : bool
+            Compute the hexike coefficients, in meters, instead of OPDs. These are returned with shape
+            (19, 9) for each time, with the coefficients for each segment in WSS order followed by the
+            first 9 of the global hexike coefficients, which include the thermal slew of the SM.
+        deltas : bool
+            Compute only the change from the previous time, or for the first time, the change from the
+            current state of the model.
+        chunk_size : int
+            Number of times to compute together
+        out : ndarray, optional
+            Array with shape (T, ...), e.g. a numpy.memmap, to write the results into.
+        filename : str, optional
+            FITS file to write the results into as a data cube, one time at a time.
+        overwrite : bool
+            Overwrite an existing FITS file?
+
+        Returns
+        -------
+        results : generator or ndarray or None
+            If neither out nor filename is given, a generator yielding arrays of the results for up
+            to chunk_size times at a time. Otherwise, out, if given, after writing all the results.
+        """
+        ntimes = np.size(times)
+        times, frill_amplitudes, iec_amplitudes = self._get_drift_parameters(ntimes, times,
+                                                                             frill_amplitudes, iec_amplitudes)
+        result_shape = (19, 9) if coefficients else self.opd.shape
+
+        def iter_results():
+            base_opd = None if deltas else self._get_static_opd()
+            if deltas:
+                previous = self._get_coeffs_from_states(self.segment_state[np.newaxis],
+                                                        *self._get_drift_parameters(1))
+            for start in range(0, ntimes, chunk_size):
+                chunk = slice(start, start + chunk_size)
+                states = np.broadcast_to(self.segment_state, (len(times[chunk]), 19, 6))
+                coeffs = self._get_coeffs_from_states(states, times[chunk], frill_amplitudes[chunk],
+                                                      iec_amplitudes[chunk])
+                if deltas:
+                    # subtract the coefficients of each previous time
+                    coeffs, previous = [np.diff(np.concatenate([p[-1:], c]), axis=0)
+                                        for p, c in zip(previous, coeffs)], coeffs
+                if coefficients:
+                    segment_hexike_coeffs, global_hexike_coeffs = coeffs
+                    yield np.concatenate([segment_hexike_coeffs, global_hexike_coeffs[:, np.newaxis, 0:9]], axis=1)
+                else:
+                    yield self._get_opds_from_coeffs(*coeffs, base_opd=base_opd)
+
+        if out is None and filename is None:
+            return iter_results()
+
+        if out is not None and out.shape != (ntimes,) + result_shape:
+            raise ValueError("out must have shape {}".format((ntimes,) + result_shape))
+        header = None
+        if filename is not None:
+            header = fits.Header()
+            header['BUNIT'] = 'meter'
+            header['CONTENTS'] = ('hexike coefficients' if coefficients else 'OPD',
+                                  'Hexike coefficients or OPD at each time')
+            header['DELTAS'] = (deltas, 'Changes from the previous time?')
+            header['STARTANG'] = (self.start_angle, "Starting sun pitch angle [deg]")
+            header['ENDANG'] = (self.end_angle, "Ending sun pitch angle [deg]")
+            header['THRMCASE'] = (self._thermal_model.case, "Thermal model case, beginning or end of life")
+            if self.scaling:
+                header['SCALING'] = (self.scaling, 'Scaling factor for delta slew')
+            header['TSTART'] = (times[0], 'First time after slew [d]')
+            header['TSTOP'] = (times[-1], 'Last time after slew [d]')
+        _write_chunks(iter_results(), out=out, filename=filename, shape=(ntimes,) + result_shape,
+                      header=header, overwrite=overwrite)
+        return out
+
+    def _get_drift_parameters(self, n, delta_times=None, frill_amplitudes=None, iec_amplitudes=None):
+        """ Return arrays of the thermal slew times in days, and frill and IEC drift amplitudes, for n states.
+        Times without units are in hours. Values which are not given are the current values of the model.
+        """
+        def per_state(values, default, unit=None):
+            if values is None:
+                values = default
+            elif unit is not None:
+                values = u.Quantity(values, u.hour).to_value(unit)
+            return np.broadcast_to(np.asarray(values, dtype=float), (n,))
+
+        return (per_state(delta_times, self.delta_time, unit=u.day),
+                per_state(frill_amplitudes, self._frill_wfe_amplitude),
+                per_state(iec_amplitudes, self._iec_wfe_amplitude))
+
+    def _get_static_opd(self):
+        """ Return the OPD terms which do not depend on the mirror states, i.e. the original OPD
+        plus the global Zernikes and field dependence """
+        saved_opd = self.opd
+        try:
+            self.opd = self._opd_original.copy()
+            if not np.all(self._global_zernike_coeffs == 0):
+                self._apply_global_zernikes()
+            self._apply_field_dependence_model()
+            return self.opd
+        finally:
+            self.opd = saved_opd
+
+    def _get_coeffs_from_states(self, states, delta_times, frill_amplitudes, iec_amplitudes):
+        """ Return the hexike coefficients applied for each of a set of states
+
+        Returns
+        -------
+        segment_hexike_coeffs : ndarray
+            Hexike coefficients for each segment, with shape (N, 18, 9)
+        global_hexike_coeffs : ndarray
+            Global hexike coefficients, with shape (N, 15)
+        """
+        sm = 18
+        total_segment_state = (states +
+                               frill_amplitudes[:, np.newaxis, np.newaxis] * self._get_frill_drift_poses(1) +
+                               iec_amplitudes[:, np.newaxis, np.newaxis] * self._get_iec_drift_poses(1))
+        total_segment_state[:, sm] = states[:, sm]
+
+        hexike_coeffs, hexike_coeffs_from_sm = self._get_hexike_coeffs_from_state(total_segment_state)
+        hexike_coeffs_from_thermal = self._get_thermal_slew_coeffs_all(delta_times)
+        segment_hexike_coeffs = hexike_coeffs + hexike_coeffs_from_sm + hexike_coeffs_from_thermal[:, 0:18]
+        if self.remove_piston_tip_tilt:
+            segment_hexike_coeffs[..., 0:3] = 0
+        elif self.remove_piston_only:
+            segment_hexike_coeffs[..., 0] = 0
+
+        global_hexike_coeffs = np.repeat(self._global_hexike_coeffs[np.newaxis], len(states), axis=0)
+        global_hexike_coeffs[:, 0:9] += hexike_coeffs_from_thermal[:, sm]
+        return segment_hexike_coeffs, global_hexike_coeffs
+
+    def _get_opds_from_coeffs(self, segment_hexike_coeffs, global_hexike_coeffs, base_opd=None):
+        """ Return the OPDs for sets of segment and global hexike coefficients, added to base_opd
+        if given, with shape (N, ny, nx) """
+        if base_opd is None:
+            opds = np.zeros((len(segment_hexike_coeffs),) + self.opd.shape)
+        else:
+            opds = np.repeat(base_opd[np.newaxis], len(segment_hexike_coeffs), axis=0)
+        segment_basis = self._get_segment_hexike_basis()
+        for iseg in range(18):
+            segment_basis.add_to_opd(opds, iseg, segment_hexike_coeffs[:, iseg])
+        if not np.all(global_hexike_coeffs == 0):
+            global_hexike_basis = self._get_global_hexike_basis()
+            opds += np.einsum('nk,kyx->nyx', global_hexike_coeffs[:, :len(global_hexike_basis)], global_hexike_basis)
+        return opds
 
     def apply_frill_drift(self, amplitude=None, random=False, case='BOL', delay_update=False):
         """ Apply model of segment PTT motions for the frill-induced drift.
@@ -2034,8 +2559,8 @@ class OTE_Linear_Model_WSS(OPD):
         if not delay_update:
             self.update_opd()
 
-    def _get_frill_drift_poses(self):
-        """ Return segment poses for current frill drift state
+    def _get_frill_drift_poses(self, amplitude=None):
+        """ Return segment poses for current frill drift state, or for some other amplitude in nm rms
         """
         # These segment piston/tip/tilt misalignments are normalized to give 1 nm rms.
         # This segment state approximates the OTE in-flight prediction from John Johnston / Joe Howard.
@@ -2061,7 +2586,9 @@ class OTE_Linear_Model_WSS(OPD):
                [-0.00273 ,  0.      ,  0.00273 ,  0.      ,  0.      ,  0.      ],
                [ 0.      ,  0.      ,  0.      ,  0.      ,  0.      ,  0.      ]])/16
 
-        return ote_seg_motions_frill * self._frill_wfe_amplitude
+        if amplitude is None:
+            amplitude = self._frill_wfe_amplitude
+        return ote_seg_motions_frill * amplitude
 
 
     def apply_iec_drift(self, amplitude=None, random=False, case='BOL', delay_update=False):
@@ -2106,7 +2633,9 @@ class OTE_Linear_Model_WSS(OPD):
         if not delay_update:
             self.update_opd()
 
-    def _get_iec_drift_poses(self):
+    def _get_iec_drift_poses(self, amplitude=None):
+        """ Return segment poses for current IEC drift state, or for some other amplitude in nm rms
+        """
 
         # These segment piston/tip/tilt motions approximate the OTE observed
         # oscillation seen at JSC OTIS cryo vac test, due to IEC heater thermal loading
@@ -2136,7 +2665,9 @@ class OTE_Linear_Model_WSS(OPD):
                [ 0.7644,  0.6466, -0.0861,  0.    ,  0.    ,  0.    ],
                [ 0.1887,  0.0825, -0.7851,  0.    ,  0.    ,  0.    ],
                [ 0.    ,  0.    ,  0.    ,  0.    ,  0.    ,  0.    ]])/1000
-        return ote_seg_motions_iec * self._iec_wfe_amplitude
+        if amplitude is None:
+            amplitude = self._iec_wfe_amplitude
+        return ote_seg_motions_iec * amplitude
 
     def header_keywords(self):
         """ Return info we would like to save in FITS header of output PSFs
@@ -2196,7 +2727,7 @@ def enable_adjustable_ote(instr):
 
     name = "Modified OPD from " + str(instr.pupilopd)
     opd = OTE_Linear_Model_WSS(name=name,
-                               opd=opdpath, transmission=pupilpath)
+                               opd=opdpath, transmission=pupilpath, npix=instr.options.get('pupil_npix'))
 
     instcopy.pupilopd = opd
     instcopy.pupil = opd
@@ -2479,7 +3010,9 @@ class OteThermalModel(object):
         mypath = os.path.dirname(os.path.abspath( __file__ ))+os.sep
         # This table is in units of microns
         self._fit_file = os.path.join(mypath, 'otelm', 'thermal_OPD_fitting_parameters_9H_um.fits')
-        self._fit_data = fits.getdata(self._fit_file)
+        # The table, and the fit parameters compiled from it, are shared between instances
+        self._fit_params = data_registry.get_ote_thermal_model_parameters(self._fit_file)
+        self._fit_data = self._fit_params.fit_data
         self.case = case
 
 
@@ -2521,26 +3054,94 @@ class OteThermalModel(object):
                 return 0.0
             else:
                 return np.zeros(self.nterms)
+        elif segid not in self._fit_params.segnames:
+            _log.warning("Invalid segment ID. No coefficients returned")
+            return 0.0
         else:
-            coeffs = OteThermalModel.second_order_thermal_response_function(delta_time,
-                                         self._fit_data[self._fit_data['segs'] == segid]['tau1'],
-                                         self._fit_data[self._fit_data['segs'] == segid]['Gn1'],
-                                         self._fit_data[self._fit_data['segs'] == segid]['tau2'],
-                                         self._fit_data[self._fit_data['segs'] == segid]['Gn2'])
-            if len(coeffs) == 0:
-                _log.warning("Invalid segment ID. No coefficients returned")
-                coeffs = 0.0
-            elif segid == 'SM':
-                coeffs = self.check_units(coeffs[0])
-            else:
-                coeffs = self.check_units(coeffs)
+            coeffs = self.get_coeffs_all(delta_time)[self._fit_params.segnames.index(segid)]
+            if segid == 'SM':
+                # The SM model has only the global focus term
+                coeffs = coeffs[self._fit_params.sm_hexike]
+            return coeffs
 
-            if self.case.upper()=='BOL':
-                # Beginning of life predictions as of 2020 have much lower amplitude WFE drift
-                # than the EOL model that was fit to produce the coefficients here.
-                coeffs *= 0.35
+    def get_coeffs_all(self, delta_times):
+        """ Return the Hexike coefficients for all segments and the SM, for one or many times
+
+        Parameters
+        ----------
+        delta_times : float or ndarray
+            Times after the slew, in units of days
+
+        Returns
+        -------
+        coeffs : ndarray
+            Hexike coefficients in meters, with shape delta_times.shape + (19, 9). The first 18 rows
+            are the segments, in the same order as constants.SEGNAMES_WSS_ORDER; the last is the
+            SM, for which only the global focus term is nonzero.
+        """
+        params = self._fit_params
+        delta_times = np.asarray(delta_times, dtype=float)[..., np.newaxis, np.newaxis]
+        coeffs = OteThermalModel.second_order_thermal_response_function(delta_times, params.tau1, params.gn1,
+                                                                        params.tau2, params.gn2)
+        coeffs *= params.units_scale
+
+        if self.case.upper()=='BOL':
+            # Beginning of life predictions as of 2020 have much lower amplitude WFE drift
+            # than the EOL model that was fit to produce the coefficients here.
+            coeffs *= 0.35
+
+        return coeffs
 
-            return coeffs
+
+def _load_thermal_model_parameters(filename):
+    """ Load the OTE thermal model fit parameters, and compile them into arrays
+
+    Returns
+    -------
+    fit_params : webbpsf.data_registry.ThermalModelParameters
+        The fit parameters table, and the tau1, gn1, tau2 and gn2 parameters as (19, 9) arrays of the
+        fits to each of the hexike terms of each segment in WSS order, followed by the SM. Terms which
+        are not in the table, i.e. all but the global focus term for the SM, have zero gain.
+    """
+    from .data_registry import ThermalModelParameters
+    fit_data = fits.getdata(filename)
+    header = fits.getheader(filename, ext=1)
+
+    segnames = [a[0:2] for a in constants.SEGNAMES_WSS_ORDER] + ['SM']
+    nterms = 9
+    tau1, tau2 = np.ones((len(segnames), nterms)), np.ones((len(segnames), nterms))
+    gn1, gn2 = np.zeros((len(segnames), nterms)), np.zeros((len(segnames), nterms))
+    segs = np.asarray(fit_data['segs'], dtype=str)
+    for iseg, segid in enumerate(segnames):
+        rows = np.where(segs == segid)[0]
+        if segid == 'SM':
+            assert len(rows) == 1, 'Got wrong number of expected records from the table'
+            terms = fit_data['Hs'][rows] - 1
+            sm_hexike = int(terms[0])
+        else:
+            assert len(rows) == nterms, 'Got wrong number of expected records from the table'
+            # the per-segment coefficients are in table order
+            terms = np.arange(nterms)
+        tau1[iseg, terms] = fit_data['tau1'][rows]
+        gn1[iseg, terms] = fit_data['Gn1'][rows]
+        tau2[iseg, terms] = fit_data['tau2'][rows]
+        gn2[iseg, terms] = fit_data['Gn2'][rows]
+
+    # Scale factor to convert the coefficients to meters (Adapted from OteThermalModel.check_units)
+    opdunits = header['BUNIT'].lower()
+    if opdunits.endswith('s'):
+        opdunits = opdunits[:-1]
+    if opdunits in ('micron', 'um', 'micrometer'):
+        units_scale = 1e-6
+    elif opdunits in ('nanometer', 'nm'):
+        units_scale = 1e-9
+    else:
+        units_scale = 1.0
+
+    for param in (tau1, gn1, tau2, gn2):
+        param.flags.writeable = False
+    return ThermalModelParameters(fit_data=fit_data, segnames=segnames, sm_hexike=sm_hexike, tau1=tau1, gn1=gn1,
+                                  tau2=tau2, gn2=gn2, units_scale=units_scale)
 
 
 def convert_quantity(input_quantity, from_units=None, to_units=u.day):
@@ -2596,7 +3197,7 @@ class JWST_WAS_PTT_Basis(object):
             (b) matches the local control coordinates for JWST segment controls.
 
         Useful for decomposing WFE maps into segment piston, tip, tilts.
-        See poppy.zernike.opd_expand_segments()
+        See the fit() method, or poppy.zernike.opd_expand_segments()
         and coeffs_to_seg_state() in this file.
 
         """
@@ -2605,11 +3206,49 @@ class JWST_WAS_PTT_Basis(object):
 
         self.ote = OTE_Linear_Model_WSS()
         self.nsegments=18
+        self._sparse_bases = {}
 
     def aperture(self):
         """ Return the overall aperture across all segments """
         return self.ote.amplitude
 
+    def _get_sparse_basis(self, npix):
+        """ Return the basis values for only the pixels within each segment, for a given sampling
+
+        Returns
+        -------
+        indices : ndarray
+            Row and column indices of the pixels in each segment, with shape (2, 18, max_pixels)
+        counts : ndarray
+            Number of pixels in each segment
+        values : ndarray
+            Piston, tip and tilt OPD values per unit motion, with shape (18, 3, max_pixels),
+            zero padded beyond the number of pixels in each segment
+        inverse_normal_matrices : ndarray
+            Inverses of the (3, 3) normal equation matrices of each segment, for fitting
+            over all of the pixels in each segment
+        """
+        if npix not in self._sparse_bases:
+            # Re-use the machinery inside the OTE Linear model class class to set up the
+            # arrays defining the segment geometry and sensitivities.
+            ote = self.ote if npix == self.ote.shape[0] else OTE_Linear_Model_WSS(npix=npix)
+            hexike_basis = ote._get_segment_hexike_basis()
+
+            # We do these intentionally with the base units, though those result in unphysically large moves:
+            # 1 meter of piston, and 1 radian of tip and tilt, converted to the microns and microradians
+            # of the segment state. Ordering of the segment state = xtilt, ytilt, piston, ...
+            states = np.zeros((3, 19, 6))
+            states[0, 0:18, 2] = 1e6
+            states[1, 0:18, 0] = 1e6
+            states[2, 0:18, 1] = 1e6
+            hexike_coeffs, _ = ote._get_hexike_coeffs_from_state(states)
+            values = np.einsum('tsh,shn->stn', hexike_coeffs, hexike_basis.values)
+
+            normal_matrices = np.einsum('sin,sjn->sij', values, values)
+            self._sparse_bases[npix] = (hexike_basis.indices, hexike_basis.counts, values,
+                                        np.linalg.inv(normal_matrices))
+        return self._sparse_bases[npix]
+
     def __call__(self, nterms=None, npix=1024, outside=np.nan):
         """ Generate PTT basis ndarray for the specified aperture
 
@@ -2618,50 +3257,87 @@ class JWST_WAS_PTT_Basis(object):
         nterms : int
             Number of terms. Set to 3x the number of segments.
         npix : int
-            Size, in pixels, of the aperture array.
+            Size, in pixels, of the aperture array. Must evenly divide the 1024 pixel
+            sampling of the segment masks, e.g. 256 or 512.
         outside : float
             Value for pixels outside the specified aperture.
             Default is `np.nan`, but you may also find it useful for this to
             be 0.0 sometimes.
 
         """
-        if npix != 1024:
-            raise ValueError("Only npix=1024 supported for now")
-
         if nterms is None:
             nterms = 3*self.nsegments
         elif nterms > 3*self.nsegments:
             raise ValueError("nterms must be <= {} for the specified segment aperture.".format(3*self.nsegments))
 
-        # Re-use the machinery inside the OTE Linear model class class to set up the
-        # arrays defining the segment and zernike geometry.
+        indices, counts, values, _ = self._get_sparse_basis(npix)
 
-        # For simplicity we always generate the basis for all the segments
-        # even if for some reason the user has set a smaller nterms.
-        basis = np.zeros((self.nsegments*3, npix, npix))
-        basis[:] = outside
-        for i, segname in enumerate(self.ote.segnames[0:18]):
-            # We do these intentionally with the base units, though those result in unphysically large moves
+        basis = np.full((nterms, npix, npix), outside, dtype=float)
+        for iseg in range(int(np.ceil(nterms / 3))):
+            n = counts[iseg]
+            rows, cols = indices[:, iseg, :n]
+            for j in range(min(3, nterms - iseg*3)):
+                basis[iseg*3 + j, rows, cols] = values[iseg, j, :n]
 
-            iseg = i+1
-            wseg = np.where(self.ote._segment_masks==iseg)
+        return basis
 
-            # Piston
-            self.ote.zero()
-            self.ote.move_seg_local(segname, piston=1, trans_unit='meter')
-            basis[i*3][wseg] = self.ote.opd[wseg]
+    def fit(self, opd, aperture=None, rcond=1e-4):
+        """ Decompose an OPD into piston, tip and tilt of each segment
 
-            # Tip
-            self.ote.zero()
-            self.ote.move_seg_local(segname, xtilt=1, rot_unit='radian')
-            basis[i*3+1][wseg] = self.ote.opd[wseg]
+        This is a least squares fit per segment, solved with the normal equations
+        precomputed for the segment geometry, so it is much faster than
+        poppy.zernike.opd_expand_segments with this basis. The latter iterates towards
+        the same least squares solution, so results agree to within its convergence.
 
-            #Tilt
-            self.ote.zero()
-            self.ote.move_seg_local(segname, ytilt=1, rot_unit='radian')
-            basis[i*3+2][wseg] = self.ote.opd[wseg]
+        Parameters
+        ----------
+        opd : 2D ndarray
+            OPD map in meters, with a size in pixels supported by __call__, e.g. 1024.
+            Non-finite pixels are excluded from the fit.
+        aperture : 2D ndarray, optional
+            Aperture mask for which pixels are included in the fit. Any pixels
+            with zero, negative or NaN values are excluded.
+        rcond : float
+            If pixels are excluded, segments for which the ratio of the smallest to the
+            largest singular value of the basis over their remaining pixels is below this
+            are not fit, since the terms are then poorly constrained. Over a whole segment
+            the ratio is about 0.35.
 
-        return basis[0:nterms]
+        Returns
+        -------
+        coeffs : ndarray
+            Piston in meters and tip and tilt in radians for each segment, as a
+            flat array of 54 values in the same order as the basis terms.
+            See coeffs_to_seg_state() to convert this to a segment state.
+            The coefficients are NaN for any segment which cannot be fit, because its
+            usable pixels do not determine all three terms, e.g. if there are fewer
+            than three of them or they all lie along a line (see rcond).
+        """
+        opd = np.asarray(opd, dtype=float)
+        indices, counts, values, inverse_normal_matrices = self._get_sparse_basis(opd.shape[0])
+        rows, cols = indices
+
+        samples = opd[rows, cols]
+        good = (np.arange(samples.shape[1]) < counts[:, np.newaxis]) & np.isfinite(samples)
+        if aperture is not None:
+            aperture = np.asarray(aperture)[rows, cols]
+            good &= np.isfinite(aperture) & (aperture > 0)
+        samples = np.where(good, samples, 0)
+        projections = np.einsum('stn,sn->st', values, samples)
+
+        if good.sum() != counts.sum():
+            # Some pixels are excluded, so set up the normal equations for just those remaining,
+            # for those segments where the remaining pixels still constrain all three terms
+            masked_values = values * good[:, np.newaxis, :]
+            normal_matrices = np.einsum('sin,sjn->sij', masked_values, values)
+            singular_values = np.linalg.svd(masked_values, compute_uv=False)
+            fittable = singular_values[:, -1] > rcond * singular_values[:, 0]
+            coeffs = np.full((self.nsegments, 3), np.nan)
+            coeffs[fittable] = np.linalg.solve(normal_matrices[fittable], projections[fittable])
+        else:
+            coeffs = np.einsum('sij,sj->si', inverse_normal_matrices, projections)
+
+        return coeffs.ravel()
 
 
 def coeffs_to_seg_state(coeffs):
@@ -2671,9 +3347,12 @@ def coeffs_to_seg_state(coeffs):
 
     Example usage:
 
-    coeffs = poppy.zernike.opd_expand_segments(some_opd, aperture=ote.amplitude, basis=jw_ptt_basis, nterms=54)
+    coeffs = jw_ptt_basis.fit(some_opd, aperture=ote.amplitude)
     ote.segment_state = coeffs_to_seg_state(coeffs)
 
+    The coefficients may equivalently, but more slowly, be computed via
+    coeffs = poppy.zernike.opd_expand_segments(some_opd, aperture=ote.amplitude, basis=jw_ptt_basis, nterms=54)
+
 
     """
     seg_state = np.zeros((18,6))
@@ -1,3 +1,4 @@
+import functools
 import os
 import poppy
 import poppy.utils
@@ -9,11 +10,12 @@ from astropy.table import Table
 import astropy.io.fits as fits
 import astropy.units as units
 
-from scipy.interpolate import griddata, RegularGridInterpolator
+from scipy.interpolate import RegularGridInterpolator, CloughTocher2DInterpolator
 from scipy.ndimage import rotate
 
 from . import utils
 from . import constants
+from . import data_registry
 
 import logging
 
@@ -1172,6 +1174,318 @@ def _fix_zgrid_NaNs(xgrid, ygrid, zgrid, rot_ang=0):
     return zgrid
 
 
+class SIWFEFieldInterpolator(object):
+    """ Interpolator for the SI WFE Zernike coefficients measured at ISIM CV3 field points
+
+    Covers the measurements for one instrument (or NIRCam module and channel) from one
+    Zernike table file. The Delaunay triangulation of the measured field points is computed
+    once, and all of the Zernike coefficients are interpolated together, giving the same
+    results as cubic interpolation with `scipy.interpolate.griddata` for each term separately.
+
+    Field points outside the measured points are handled by `extrapolate`, which uses a
+    regular grid of coefficients over the full instrument field. That grid is computed
+    when first needed and saved to the WebbPSF cache directory for use in later sessions.
+
+    Instances are shared between instruments via `webbpsf.data_registry.get_si_wfe_interpolator`
+    and should be treated as read-only.
+
+    Parameters
+    ----------
+    ztable : astropy.table.Table
+        Table rows for the instrument, with V2 and V3 field coordinates in arcmin and
+        Zernike_1 through Zernike_36 coefficient columns.
+    lookup_name : str
+        Instrument name as used in the table, e.g. 'NIRCamSWA' or 'Guider1'
+    coronagraph : bool
+        Are these the measurements for the NIRCam coronagraph field?
+    zernike_file : str, optional
+        Filename of the Zernike table, used to identify cached extrapolation grids. If not
+        given, grids are not cached on disk.
+    """
+    nterms = 36
+    # Increment this if the method used to compute extrapolation grids changes, to invalidate cached grids
+    _extrapolation_grid_version = 1
+
+    def __init__(self, ztable, lookup_name=None, coronagraph=False, zernike_file=None):
+        self.ztable = ztable
+        self.lookup_name = lookup_name
+        self.coronagraph = coronagraph
+        self.zernike_file = zernike_file
+        self.v2 = np.asarray(ztable['V2'], dtype=float)
+        self.v3 = np.asarray(ztable['V3'], dtype=float)
+        self.coeffs = np.stack([np.asarray(ztable['Zernike_{}'.format(i)], dtype=float)
+                                for i in range(1, self.nterms + 1)], axis=-1)
+        self._interpolator = CloughTocher2DInterpolator((self.v2, self.v3), self.coeffs)
+        self._extrapolator = None
+
+    def __call__(self, v2, v3):
+        """ Interpolate the Zernike coefficients at field coordinates v2, v3 (in arcmin),
+        which may be scalars or arrays. Returns an array of shape np.shape(v2) + (36,),
+        which is NaN outside the convex hull of the measured field points.
+        """
+        return self._interpolator(v2, v3)
+
+    def evaluate(self, v2, v3):
+        """ Return the Zernike coefficients at field coordinates v2, v3 (in arcmin), interpolating
+        within the measured field points and extrapolating outside of them.
+
+        Returns
+        -------
+        coeffs : ndarray
+            Coefficients with shape np.shape(v2) + (36,)
+        extrapolated : ndarray of bool
+            Mask with shape np.shape(v2), True for points which were extrapolated
+        """
+        coeffs = self(v2, v3)
+        outside = np.isnan(coeffs)
+        if outside.any():
+            # Only extrapolate at the points which need it
+            points = outside.any(axis=-1)
+            coeffs[outside] = self.extrapolate(np.asarray(v2)[points], np.asarray(v3)[points])[outside[points]]
+        return coeffs, outside[..., 0]
+
+    def extrapolate(self, v2, v3):
+        """ Extrapolate the Zernike coefficients to field coordinates v2, v3 (in arcmin),
+        which may lie outside the measured field points. Returns an array of shape
+        np.shape(v2) + (36,).
+        """
+        if self._extrapolator is None:
+            xgrid, ygrid, zgrid = self.get_extrapolation_grid()
+            self._extrapolator = RegularGridInterpolator((ygrid, xgrid), np.moveaxis(zgrid, 0, -1),
+                                                         method='linear', bounds_error=False, fill_value=None)
+        return self._extrapolator((v3, v2))
+
+    def _field_limits(self):
+        """ Full field V2/V3 limits for each instrument, in arcmin.
+        Produces better initial extrapolation with fewer interpolation artifacts in RGI.
+        """
+        lookup_name = self.lookup_name
+        if lookup_name == 'Guider1':
+            v2_min, v2_max, v3_min, v3_max = (2.2, 4.7, -12.9, -10.4)
+        elif lookup_name == 'Guider2':
+            v2_min, v2_max, v3_min, v3_max = (-0.8, 1.6, -12.9, -10.4)
+        elif lookup_name == 'NIRISS':
+            v2_min, v2_max, v3_min, v3_max = (-6.0, -3.6, -12.9, -10.4)
+        elif lookup_name == 'MIRI':
+            v2_min, v2_max, v3_min, v3_max = (-8.3, -6.1, -7.3, -5.2)
+        elif lookup_name == 'NIRSpec':
+            v2_min, v2_max, v3_min, v3_max = (3.7, 9.0, -9.8, -4.5)
+        elif (lookup_name == 'NIRCamLWA') or (lookup_name == 'NIRCamSWA'):
+            v2_min, v2_max, v3_min, v3_max = (0.2, 2.7, -9.5, -7.0)
+        elif (lookup_name == 'NIRCamLWB') or (lookup_name == 'NIRCamSWB'):
+            v2_min, v2_max, v3_min, v3_max = (-2.7, -0.2, -9.5, -7.0)
+        else:
+            v2_min, v2_max, v3_min, v3_max = (self.v2.min(), self.v2.max(), self.v3.min(), self.v3.max())
+
+        # For NIRCam coronagraphy, add 50" to V3 limits
+        if self.coronagraph:
+            v3_min += 50. / 60.
+            v3_max += 50. / 60.
+        return v2_min, v2_max, v3_min, v3_max
+
+    def _compute_extrapolation_grid(self):
+        """ Compute the coefficients on a regular grid covering the instrument field.
+
+        To extrapolate outside the measured field points, we proceed in two steps. This first
+        creates a fine-meshed cubic fit over the known field points, and fixes any NaN's using
+        RegularGridInterpolator. `extrapolate` then again uses RegularGridInterpolator on the
+        fixed data to extrapolate the requested field point.
+
+        In principle, the first call of RegularGridInterpolator can be used to extrapolate the
+        requested field point to eliminate the intermediate step, but this method enables use
+        of all the real data rather than the trimmed data set.
+        """
+        v2_min, v2_max, v3_min, v3_max = self._field_limits()
+
+        # Create fine mesh grid
+        dstep = 1. / 60.  # 1" steps
+        xgrid = np.arange(v2_min, v2_max + dstep, dstep)
+        ygrid = np.arange(v3_min, v3_max + dstep, dstep)
+        X, Y = np.meshgrid(xgrid, ygrid)
+
+        # Cubic interpolation of all points
+        # Will produce a number of NaN's that need to be extrapolated over
+        zgrid_all = self(X, Y)
+
+        # Want to rotate zgrid image of some SIs to minimize NaN clipping
+        if 'NIRSpec' in self.lookup_name:
+            rot_ang = 43
+        elif 'MIRI' in self.lookup_name:
+            rot_ang = -5
+        elif 'NIRISS' in self.lookup_name:
+            rot_ang = 2
+        else:
+            rot_ang = 0
+
+        # Fix the NaN's within each zgrid array
+        # Perform specified rotation for certain SIs
+        # Trim rows/cols
+        zgrid = np.stack([_fix_zgrid_NaNs(xgrid, ygrid, zgrid_all[..., i], rot_ang=rot_ang)
+                          for i in range(self.nterms)])
+        return xgrid, ygrid, zgrid
+
+    def _get_cache_filename(self):
+        import hashlib
+        stat = os.stat(self.zernike_file)
+        key = hashlib.sha1("{}:{}:{}:{}:{}:{}".format(
+            os.path.abspath(self.zernike_file), stat.st_size, stat.st_mtime_ns,
+            self.lookup_name, self.coronagraph, self._extrapolation_grid_version).encode()).hexdigest()
+        return os.path.join(utils.get_webbpsf_cache_dir('si_wfe'),
+                            'si_wfe_extrapolation_{}_{}.fits'.format(self.lookup_name, key[:16]))
+
+    def get_extrapolation_grid(self):
+        """ Return the extrapolation grid, loading it from the cache directory if possible
+
+        Returns
+        -------
+        xgrid, ygrid : ndarray
+            1D V2 and V3 coordinates of the grid, in arcmin
+        zgrid : ndarray
+            Zernike coefficients on the grid, with shape (36, len(ygrid), len(xgrid))
+        """
+        filename = None
+        if self.zernike_file is not None:
+            try:
+                filename = self._get_cache_filename()
+                if os.path.exists(filename):
+                    with fits.open(filename) as hdulist:
+                        return (np.array(hdulist['XGRID'].data), np.array(hdulist['YGRID'].data),
+                                np.array(hdulist[0].data))
+            except (OSError, KeyError) as err:
+                _log.warning("Could not read cached SI WFE extrapolation grid ({}); recomputing it.".format(err))
+
+        _log.info("Computing SI WFE extrapolation grid for {}".format(self.lookup_name))
+        xgrid, ygrid, zgrid = self._compute_extrapolation_grid()
+
+        if filename is not None:
+            import tempfile
+            hdulist = fits.HDUList([fits.PrimaryHDU(zgrid), fits.ImageHDU(xgrid, name='XGRID'),
+                                    fits.ImageHDU(ygrid, name='YGRID')])
+            hdulist[0].header['INSTRUME'] = (self.lookup_name, 'Instrument name in Zernike table')
+            hdulist[0].header['ZERNFILE'] = (os.path.basename(self.zernike_file), 'Zernike table file')
+            try:
+                fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'wb') as outfile:
+                        hdulist.writeto(outfile)
+                    os.replace(tmp_filename, filename)  # atomic, in case of concurrent processes
+                except BaseException:
+                    os.remove(tmp_filename)
+                    raise
+            except OSError as err:
+                _log.warning("Could not save SI WFE extrapolation grid to {} ({})".format(filename, err))
+        return xgrid, ygrid, zgrid
+
+
+def _opd_from_zernikes(coeffs, npix, aperture=None):
+    """ Synthesize an OPD from Zernike coefficients, as for
+    ``poppy.zernike.opd_from_zernikes(coeffs, npix=npix, aperture=aperture, outside=0)``,
+    with a single matrix product against the shared single precision Zernike basis.
+    """
+    nterms = len(coeffs)
+    basis = data_registry.get_zernike_basis(npix, nterms)
+    opd = np.dot(np.asarray(coeffs, dtype=basis.dtype), basis.reshape(nterms, -1))
+    opd = opd.reshape(npix, npix).astype(float)
+    if aperture is not None:
+        opd[~(np.isfinite(aperture) & (aperture > 0))] = 0
+    return opd
+
+
+def _si_wfe_lookup(instrument):
+    """ Work out where to find the SI WFE measurements for an instrument's current configuration
+
+    Returns
+    -------
+    lookup_name : str
+        Value of the 'instrument' column in the Zernike table, e.g. 'NIRCamSWA' or 'Guider1'
+    zernike_file : str
+        Path to the Zernike coefficients table file
+    is_nrc_coron : bool
+        Whether the NIRCam coronagraph field measurements are used
+    """
+    # work out which name to index into the CV results with, if for NIRCam
+    is_nrc_coron = False  # Define NRC coronagraph variable for conciseness
+    if instrument.name == 'NIRCam':
+        channel = instrument.channel[0].upper()
+        lookup_name = "NIRCam{channel}W{module}".format(
+            channel=channel,
+            module=instrument.module
+        )
+        # Check for coronagraphy; Set is_ncr_coron to True for Lyot pupil mask
+        pupil_mask = instrument._pupil_mask
+        is_nrc_coron = (pupil_mask is not None) and ( ('LYOT' in pupil_mask.upper()) or ('MASK' in pupil_mask.upper()) )
+    elif instrument.name == 'FGS':
+        # 'GUIDER1' or 'GUIDER2'
+        assert instrument.detector in ('FGS1', 'FGS2')
+        lookup_name = 'Guider' + instrument.detector[3]
+    else:
+        lookup_name = instrument.name
+
+    # load the Zernikes table here
+    zfile = "si_zernikes_isim_cv3.fits"
+    # Check special case NIRCam coronagraphy
+    if is_nrc_coron:
+        zfile = "si_zernikes_coron_wfe.fits"
+    zernike_file = os.path.join(utils.get_webbpsf_data_path(), zfile)
+
+    if not os.path.exists(zernike_file):
+        raise RuntimeError("Could not find Zernike coefficients file {} \
+                           in WebbPSF data directory".format(zfile))
+    return lookup_name, zernike_file, is_nrc_coron
+
+
+def get_si_wfe_coefficients(instrument, detector_positions=None, v2v3=None, return_extrapolated=False):
+    """ Return the SI WFE Zernike coefficients at many field points at once
+
+    This uses the same interpolation and extrapolation of the ISIM CV3 measurements as
+    `WebbFieldDependentAberration`, without building an OPD for each field point, and so
+    is suited to mapping the field dependence of the SI WFE over many points.
+
+    Coefficients are for the instrument's current configuration, i.e. its detector for
+    the conversion of pixel coordinates, and for NIRCam also its channel, module and
+    whether a coronagraph pupil mask is selected.
+
+    Parameters
+    ----------
+    instrument : JWInstrument
+        Instrument instance
+    detector_positions : array_like, optional
+        Science frame pixel coordinates, with shape (N, 2) as (X, Y) pairs, converted
+        to telescope coordinates through the SIAF transformations for the current detector.
+        Defaults to the instrument's detector_position.
+    v2v3 : array_like or astropy.units.Quantity, optional
+        Telescope frame field coordinates, with shape (N, 2) as (V2, V3) pairs, in arcmin if
+        not a Quantity. Use instead of detector_positions.
+    return_extrapolated : bool
+        Also return which field points are extrapolated outside the measured field points
+
+    Returns
+    -------
+    coeffs : ndarray
+        Zernike coefficients in meters, with shape (N, 36), in Noll order
+    extrapolated : ndarray of bool
+        Only if return_extrapolated is set; mask with shape (N,), True for extrapolated field points
+    """
+    if v2v3 is not None:
+        if detector_positions is not None:
+            raise ValueError("Specify either detector_positions or v2v3, not both.")
+        if isinstance(v2v3, units.Quantity):
+            v2v3 = v2v3.to_value(units.arcmin)
+        v2, v3 = np.atleast_2d(np.asarray(v2v3, dtype=float)).T
+    else:
+        if detector_positions is None:
+            detector_positions = [instrument.detector_position]
+        x, y = np.atleast_2d(np.asarray(detector_positions, dtype=float)).T
+        v2, v3 = instrument._detector_geom_info.pix2angle(x, y).to_value(units.arcmin)
+
+    lookup_name, zernike_file, is_nrc_coron = _si_wfe_lookup(instrument)
+    interpolator = data_registry.get_si_wfe_interpolator(zernike_file, lookup_name, coronagraph=is_nrc_coron)
+    coeffs, extrapolated = interpolator.evaluate(v2, v3)
+    if return_extrapolated:
+        return coeffs, extrapolated
+    return coeffs
+
+
 # Field dependent aberration class for JWST instruments
 class WebbFieldDependentAberration(poppy.OpticalElement):
     """ Field dependent aberration generated from Zernikes measured in ISIM CV testing
@@ -1180,10 +1494,16 @@ class WebbFieldDependentAberration(poppy.OpticalElement):
     -----------
     include_oversize : bool
         Explicitly model the 4% oversize for pupil tolerance
+    zernike_coeffs : array_like, optional
+        Zernike coefficients for the instrument's field point, if these have already been
+        evaluated, e.g. for many field points together by `get_si_wfe_coefficients`.
+        By default they are interpolated from the ISIM CV3 measurements here.
+    extrapolated : bool
+        Whether the provided zernike_coeffs were extrapolated outside the measured field points
 
     """
 
-    def __init__(self, instrument, include_oversize=False, **kwargs):
+    def __init__(self, instrument, include_oversize=False, zernike_coeffs=None, extrapolated=False, **kwargs):
         super(WebbFieldDependentAberration, self).__init__(
             name="Aberrations",
             **kwargs
@@ -1192,39 +1512,13 @@ class WebbFieldDependentAberration(poppy.OpticalElement):
         self.instrument = instrument
         self.instr_name = instrument.name
 
-        # work out which name to index into the CV results with, if for NIRCam
-        is_nrc_coron = False  # Define NRC coronagraph variable for conciseness 
-        if instrument.name == 'NIRCam':
-            channel = instrument.channel[0].upper()
-            lookup_name = "NIRCam{channel}W{module}".format(
-                channel=channel,
-                module=instrument.module
-            )
-            # Check for coronagraphy; Set is_ncr_coron to True for Lyot pupil mask
-            pupil_mask = self.instrument._pupil_mask
-            is_nrc_coron = (pupil_mask is not None) and ( ('LYOT' in pupil_mask.upper()) or ('MASK' in pupil_mask.upper()) )
-        elif instrument.name == 'FGS':
-            # 'GUIDER1' or 'GUIDER2'
-            assert instrument.detector in ('FGS1', 'FGS2')
-            lookup_name = 'Guider' + instrument.detector[3]
-        else:
-            lookup_name = instrument.name
+        lookup_name, zernike_file, is_nrc_coron = _si_wfe_lookup(instrument)
+        self._is_nrc_coron = is_nrc_coron
         _log.debug("Retrieving Zernike coefficients for " + lookup_name)
 
         self.tel_coords = instrument._tel_coords()
 
-        # load the Zernikes table here         
-        zfile = "si_zernikes_isim_cv3.fits"
-        # Check special case NIRCam coronagraphy
-        if is_nrc_coron:
-            zfile = "si_zernikes_coron_wfe.fits"
-        zernike_file = os.path.join(utils.get_webbpsf_data_path(), zfile)
-
-        if not os.path.exists(zernike_file):
-            raise RuntimeError("Could not find Zernike coefficients file {} \
-                               in WebbPSF data directory".format(zfile))
-        else:
-            self.ztable_full = Table.read(zernike_file)
+        self.ztable_full = data_registry.get_si_zernike_table(zernike_file)
 
         # Determine the pupil sampling of the first aperture in the
         # instrument's optical system
@@ -1242,14 +1536,19 @@ class WebbFieldDependentAberration(poppy.OpticalElement):
 
             npix = pupilheader['NAXIS1']
             self.pixelscale = pupilheader['PUPLSCAL'] * units.meter / units.pixel
+            if instrument.options.get('pupil_npix'):
+                # match the downsampled OTE linear model
+                self.pixelscale *= npix / instrument.options['pupil_npix']
+                npix = instrument.options['pupil_npix']
 
-        self.ztable = self.ztable_full[self.ztable_full['instrument'] == lookup_name]
+        interpolator = data_registry.get_si_wfe_interpolator(zernike_file, lookup_name, coronagraph=is_nrc_coron)
+        self.ztable = interpolator.ztable
 
         # Figure out the closest field point
 
         telcoords_am = self.tel_coords.to(units.arcmin).value
-        v2 = self.ztable['V2']
-        v3 = self.ztable['V3']
+        v2 = interpolator.v2
+        v3 = interpolator.v3
         r = np.sqrt((telcoords_am[0] - v2) ** 2 + (telcoords_am[1] - v3) ** 2)
         closest = np.argmin(r)
 
@@ -1267,89 +1566,16 @@ class WebbFieldDependentAberration(poppy.OpticalElement):
         # Retrieve those Zernike coeffs
         # Field point interpolation
         v2_tel, v3_tel = telcoords_am
-        coeffs = []
-        for i in range(1, 37):
-            zkey = 'Zernike_{}'.format(i)
-            zvals = self.ztable[zkey]
-
-            # Cubic interpolation of of non-uniform 2D grid
-            cf = griddata((v2, v3), zvals, (v2_tel, v3_tel), method='cubic').tolist()
-            
-            # Want to perform extrapolation if field point outside of bounds
-            if np.isnan(cf):
-                if i==1:
-                    self.si_wfe_type = ("Extrapolated", 
-                            "SI WFE was extrapolated outside available meas.")
-
-                # To extrapolate outside the measured field points, we proceed 
-                # in two steps.  This first creates a fine-meshed cubic fit 
-                # over the known field points, fixes any NaN's using 
-                # RegularGridInterpolator, then again uses RegularGridInterpolator 
-                # on the fixed data to extrapolate the requested field point.
-
-                # In principle, the first call of RegularGridInterpolator can be 
-                # used to extrapolate the requested field point to eliminate 
-                # the intermediate step, but this method enables use of all the 
-                # real data rather than the trimmed data set. RGI is a rather
-                # quick process, so added overheads should be negligible.
-
-                # Full field V2/V3 limits for each instrument.
-                # Produces better initial extrapolation with fewer 
-                # interpolation artifacts in RGI.
-                if lookup_name == 'Guider1':
-                    v2_min, v2_max, v3_min, v3_max = (2.2, 4.7, -12.9, -10.4)
-                elif lookup_name == 'Guider2':
-                    v2_min, v2_max, v3_min, v3_max = (-0.8, 1.6, -12.9, -10.4)
-                elif lookup_name == 'NIRISS': 
-                    v2_min, v2_max, v3_min, v3_max = (-6.0, -3.6, -12.9, -10.4)
-                elif lookup_name == 'MIRI': 
-                    v2_min, v2_max, v3_min, v3_max = (-8.3, -6.1, -7.3, -5.2)
-                elif lookup_name == 'NIRSpec': 
-                    v2_min, v2_max, v3_min, v3_max = (3.7, 9.0, -9.8, -4.5)
-                elif (lookup_name == 'NIRCamLWA') or (lookup_name == 'NIRCamSWA'): 
-                    v2_min, v2_max, v3_min, v3_max = (0.2, 2.7, -9.5, -7.0)
-                elif (lookup_name == 'NIRCamLWB') or (lookup_name == 'NIRCamSWB'): 
-                    v2_min, v2_max, v3_min, v3_max = (-2.7, -0.2, -9.5, -7.0)
-                else:
-                    v2_min, v2_max, v3_min, v3_max = (v2.min(), v2.max(), v3.min(), v3.max())
-
-                # For NIRCam coronagraphy, add 50" to V3 limits
-                if is_nrc_coron:
-                    v3_min += 50. / 60.
-                    v3_max += 50. / 60.
-
-                # Create fine mesh grid
-                dstep = 1. / 60. # 1" steps
-                xgrid = np.arange(v2_min, v2_max+dstep, dstep)
-                ygrid = np.arange(v3_min, v3_max+dstep, dstep)
-                X, Y = np.meshgrid(xgrid,ygrid)
-
-                # Cubic interpolation of all points
-                # Will produce a number of NaN's that need to be extrapolated over
-                zgrid = griddata((v2, v3), zvals, (X, Y), method='cubic')
-
-                # Want to rotate zgrid image of some SIs to minimize NaN clipping
-                if 'NIRSpec' in lookup_name:
-                    rot_ang = 43
-                elif 'MIRI' in lookup_name:
-                    rot_ang = -5
-                elif 'NIRISS' in lookup_name:
-                    rot_ang = 2
-                else:
-                    rot_ang = 0
-
-                # Fix the NaN's within zgrid array
-                # Perform specified rotation for certain SIs
-                # Trim rows/cols
-                zgrid = _fix_zgrid_NaNs(xgrid, ygrid, zgrid, rot_ang=rot_ang)
-
-                # Create final function for extrapolation
-                func = RegularGridInterpolator((ygrid,xgrid), zgrid, method='linear',
-                                               bounds_error=False, fill_value=None)
-                # Extrapolate at requested (V2,V3) coordinates
-                cf = func( (v3_tel, v2_tel) ).tolist()
-
-            coeffs.append(cf)
+        # Cubic interpolation of of non-uniform 2D grid, for all terms at once,
+        # extrapolating if field point outside of bounds
+        if zernike_coeffs is None:
+            coeffs, extrapolated = interpolator.evaluate(v2_tel, v3_tel)
+        else:
+            coeffs = np.asarray(zernike_coeffs, dtype=float)
+        if extrapolated:
+            self.si_wfe_type = ("Extrapolated",
+                    "SI WFE was extrapolated outside available meas.")
+        coeffs = coeffs.tolist()
 
         self.zernike_coeffs = coeffs
 
@@ -1365,21 +1591,24 @@ class WebbFieldDependentAberration(poppy.OpticalElement):
 
             # internal pupils for NIRISS and MIRI instruments are 4 percent
             # oversized tricontagons
+            # These masks are shared between optics, so each optic takes its own copy.
+            # They are sampled to match a 1024 pixel OPD, so are block averaged
+            # like the pupil if a coarser pupil_npix sampling is in use.
             if self.instrument.name == "NIRISS":
-                self.amplitude = fits.getdata(os.path.join(
+                # cut out central region to match the OPD
+                self.amplitude = data_registry.get_pupil_mask(os.path.join(
                     utils.get_webbpsf_data_path(),
-                    'tricontagon_oversized_4pct.fits.gz')
-                )
-                # cut out central region to match the OPD, which is hard coded
-                # to 1024
-                self.amplitude = self.amplitude[256:256 + 1024, 256:256 + 1024]
+                    'tricontagon_oversized_4pct.fits.gz'),
+                    npix=npix, cutout=(256, 256 + 1024)
+                ).copy()
             elif self.instrument.name == "MIRI":
-                self.amplitude = fits.getdata(os.path.join(
+                self.amplitude = data_registry.get_pupil_mask(os.path.join(
                     utils.get_webbpsf_data_path(),
                     'MIRI',
                     'optics',
-                    'MIRI_tricontagon_oversized_rotated.fits.gz')
-                )
+                    'MIRI_tricontagon_oversized_rotated.fits.gz'),
+                    npix=npix
+                ).copy()
 
             else:
                 # internal pupil is a 4 percent oversized circumscribing circle?
@@ -1393,18 +1622,9 @@ class WebbFieldDependentAberration(poppy.OpticalElement):
                 r = np.sqrt(y ** 2 + x ** 2)
                 self.amplitude = (r < (npix - 1) / 2.0 * 1.04).astype(int)
 
-            self.opd = poppy.zernike.opd_from_zernikes(
-                coeffs,
-                npix=npix,
-                aperture=self.amplitude,
-                outside=0
-            )
+            self.opd = _opd_from_zernikes(coeffs, npix, aperture=self.amplitude)
         else:
-            self.opd = poppy.zernike.opd_from_zernikes(
-                coeffs,
-                npix=npix,
-                outside=0
-            )
+            self.opd = _opd_from_zernikes(coeffs, npix)
             self.amplitude = (self.opd != 0).astype(int)
     
     def header_keywords(self):
@@ -1447,6 +1667,7 @@ class NIRSpecFieldDependentAberration(WebbFieldDependentAberration):
     def __init__(self, instrument, where='fore', **kwargs):
         super(NIRSpecFieldDependentAberration, self).__init__(instrument, **kwargs)
 
+        self.where = where
         if where == 'fore':
             self.name = 'NIRSpec fore-optics WFE, near {}'.format(self.row['field_point_name'])
             self.scalefactor = 1. / 3
@@ -1505,24 +1726,59 @@ class NIRCamFieldAndWavelengthDependentAberration(WebbFieldDependentAberration):
         self.ctilt_long  = np.poly1d(lw_ctilt_cf)
 
         # Get the representation of focus in the same Zernike basis as used for
-        # making the OPD. While it looks like this does more work here than needed
-        # by making a whole basis set, in fact because of caching behind the scenes
-        # this is actually quick
-        basis = poppy.zernike.zernike_basis_faster(
-            nterms=len(self.zernike_coeffs),
-            npix=self.opd.shape[0],
-            outside=0
-        )
+        # making the OPD. This is a view of the shared basis set, so is quick
+        basis = data_registry.get_zernike_basis(self.opd.shape[0], len(self.zernike_coeffs))
         self.defocus_zern = basis[3]
         self.tilt_zern = basis[2]
 
-        
+        # Only defocus and (for coronagraphy) tilt vary with wavelength, so work out everything
+        # else about the chromatic model once here, for the configuration this optic was created for.
+        # Which wavelength was used to generate the OPD map we have already
+        # created from zernikes?
+        is_nrc_coron = self._is_nrc_coron
+        if self.instrument.channel.upper() == 'SHORT':
+            self._focusmodel = self.fm_short
+            self._opd_ref_wave = 2.12
+            self._opd_ref_focus = self._focusmodel(self._opd_ref_wave)
+        else:
+            self._focusmodel = self.fm_long
+            self._opd_ref_wave = 3.23
+            # All LW WFE measurements were made using F323N,
+            # which has it's own focus that deviates from focusmodel().
+            # But only do this for direct imaging SI WFE values,
+            # because coronagraph WFE was measured in Zemax (no additional focus power).
+            if is_nrc_coron:
+                self._opd_ref_focus = self._focusmodel(self._opd_ref_wave)
+            else:
+                self._opd_ref_focus = 1.206e-7 # Not coronagraphy (e.g., imaging)
+
+        # If F323N or F212N, then no focus offset necessary
+        self._apply_defocus = not (('F323N' in self.instrument.filter) or ('F212N' in self.instrument.filter))
+
+        # Wavelength-dependent tilt offset for coronagraphy
+        # We want the reference wavelength to be that of the target acq filter
+        # Final offset will position TA ref wave at the OPD ref wave location
+        #   (wave_um - opd_ref_wave) - (ta_ref_wave - opd_ref_wave) = wave_um - ta_ref_wave
+        self._ctilt_model = None
+        if is_nrc_coron:
+            if self.instrument.channel.upper() == 'SHORT':
+                self._ctilt_model = self.ctilt_short
+                self._ta_ref_wave = 2.10
+            else:
+                self._ctilt_model = self.ctilt_long
+                self._ta_ref_wave = 3.35
+            self._ta_ref_tilt = self._ctilt_model(self._ta_ref_wave)
+
     def get_opd(self, wave):
         """
         Parameters
         ----------
         wave : float or obj
             either a scalar wavelength (meters) or a Wavefront object
+
+        The OPD is that of the Zernike coefficients plus a wavelength dependent change in defocus
+        and, for coronagraphy, tilt. If neither changes, a read-only view of the static OPD array
+        is returned.
         """
 
         if isinstance(wave, poppy.Wavefront):
@@ -1531,66 +1787,36 @@ class NIRCamFieldAndWavelengthDependentAberration(WebbFieldDependentAberration):
             wave = poppy.Wavefront(wavelength=float(wave))
             wavelength = wave.wavelength
 
-        # Check for coronagraphy
-        pupil_mask = self.instrument._pupil_mask
-        is_nrc_coron = (pupil_mask is not None) and ( ('LYOT' in pupil_mask.upper()) or ('MASK' in pupil_mask.upper()) )
-
-        # Which wavelength was used to generate the OPD map we have already
-        # created from zernikes?
-        if self.instrument.channel.upper() == 'SHORT':
-            focusmodel = self.fm_short
-            opd_ref_wave = 2.12
-            opd_ref_focus = focusmodel(opd_ref_wave)
-        else:
-            focusmodel = self.fm_long
-            opd_ref_wave = 3.23
-            # All LW WFE measurements were made using F323N,
-            # which has it's own focus that deviates from focusmodel().
-            # But only do this for direct imaging SI WFE values,
-            # because coronagraph WFE was measured in Zemax (no additional focus power).
-            if is_nrc_coron:
-                opd_ref_focus = focusmodel(opd_ref_wave)
-            else:
-                opd_ref_focus = 1.206e-7 # Not coronagraphy (e.g., imaging)
-
-        # If F323N or F212N, then no focus offset necessary
         wave_um = wavelength.to(units.micron).value
-        if ('F323N' in self.instrument.filter) or ('F212N' in self.instrument.filter):
-            deltafocus = 0
-        else:
-            deltafocus = focusmodel(wave_um) - opd_ref_focus
+        deltafocus = self._focusmodel(wave_um) - self._opd_ref_focus if self._apply_defocus else 0
 
         _log.info("  Applying OPD focus adjustment based on NIRCam focus vs wavelength model")
         _log.info("  Modified focus from {} to {} um: {:.3f} nm wfe".format(
-            opd_ref_wave, wave_um, -deltafocus * 1e9)
+            self._opd_ref_wave, wave_um, -deltafocus * 1e9)
         )
 
-        # Apply defocus
-        mod_opd = self.opd - deltafocus * self.defocus_zern
-
-        # Apply wavelength-dependent tilt offset for coronagraphy
-        # We want the reference wavelength to be that of the target acq filter
-        # Final offset will position TA ref wave at the OPD ref wave location
-        #   (wave_um - opd_ref_wave) - (ta_ref_wave - opd_ref_wave) = wave_um - ta_ref_wave
-        if is_nrc_coron:
-            if self.instrument.channel.upper() == 'SHORT':
-                ctilt_model = self.ctilt_short
-                ta_ref_wave = 2.10
-            else: 
-                ctilt_model = self.ctilt_long
-                ta_ref_wave = 3.35
-
-            tilt_offset = ctilt_model(wave_um) - ctilt_model(ta_ref_wave)
+        tilt_offset = 0
+        if self._ctilt_model is not None:
+            tilt_offset = self._ctilt_model(wave_um) - self._ta_ref_tilt
             _log.info("  Applying OPD tilt adjustment based on NIRCam tilt vs wavelength model")
             _log.info("  Modified tilt from {} to {} um: {:.3f} nm wfe".format(
-                ta_ref_wave, wave_um, tilt_offset * 1e9)
+                self._ta_ref_wave, wave_um, tilt_offset * 1e9)
             )
 
-            # Apply tilt offset
-            mod_opd = mod_opd + tilt_offset * self.tilt_zern
+        if deltafocus == 0 and tilt_offset == 0:
+            opd = self.opd.view()
+            opd.flags.writeable = False
+            return opd
+
+        # Apply defocus and tilt offset to one new array, without other full size temporaries
+        mod_opd = np.multiply(self.defocus_zern, -deltafocus, dtype=self.opd.dtype)
+        mod_opd += self.opd
+        if tilt_offset != 0:
+            mod_opd += tilt_offset * self.tilt_zern
 
-        rms = np.sqrt((mod_opd[mod_opd != 0] ** 2).mean())
-        _log.info("  Resulting OPD has {:.3f} nm rms".format(rms * 1e9))
+        if _log.isEnabledFor(logging.DEBUG):
+            rms = np.sqrt((mod_opd[mod_opd != 0] ** 2).mean())
+            _log.debug("  Resulting OPD has {:.3f} nm rms".format(rms * 1e9))
 
         return mod_opd
 
@@ -1615,56 +1841,103 @@ class MIRIFieldDependentAberrationAndObscuration(WebbFieldDependentAberration):
         )
 
         # figure out the XAN, YAN coordinates in degrees,
-        # since that is what Randal's linear model expects
+        # since that is what Randal's linear model expects.
+        # These are rounded slightly, so that the obscuration can be reused for nearby field points.
 
         xanyan = instrument._xan_yan_coords().to(units.degree)
 
-        xan = xanyan[0].value
-        yan = xanyan[1].value
-
-        #    Telfer:
-        #    Here is the matrix that reproduces the projection of the
-        #    obscuration on the primary mirror, V2-V3 coordinates and
-        #    radius in mm, as a function of XAN,YAN in degrees.
-        #    So, V2 is:
-        #
-        #           V2 = -20882.636 * XAN -680.661 * YAN  - 1451.682.
-        #
-        #                     XAN            YAN         Const
-        #           V2     -20882.636     -680.661    -1451.682
-        #           V3        815.955    26395.552    -2414.406
-        #           Rad       176.864     -392.545      626.920
-
-        # we implement the above here, and convert the outputs to meters:
-        self.obsc_v2 = (-20882.636 * xan - 680.661 * yan - 1451.682) * 0.001
-        self.obsc_v3 = (815.955 * xan + 26395.552 * yan - 2414.406) * 0.001
-        self.obsc_r = (176.864 * xan - 392.545 * yan + 626.920) * 0.001
-
-        # generate coordinates. N.B. this assumed hard-coded pixel scale and
-        # array size.
-        pixel_scale = constants.JWST_CIRCUMSCRIBED_DIAMETER / 1024
-        y, x = poppy.Wavefront.pupil_coordinates((1024, 1024), pixel_scale)
-
-        # Now, the v2 and v3 coordinates calculated above are as projected back to
-        # the OTE entrance pupil
-        # But the OTE exit pupil as seen at the MIRI internal pupil is rotated by
-        # 5 degrees with respect to that, and flipped in handedness as well
-        # (but only in V3, given webbpsf axes conventions relative to the definition of the V frame)
-        # Therefore we must transform the v2 and v3 to match the wavefront coords at the
-        # intermediate plane.
-
-        angle = np.deg2rad(instrument._rotation)
-        proj_v2 = np.cos(angle) * self.obsc_v2 - np.sin(angle) * self.obsc_v3
-        proj_v3 = -np.sin(angle) * self.obsc_v2 + np.cos(angle) * self.obsc_v3
-
-        # handle V3 flip from OTE entrance to exit pupils
-        # no flip needed for V2 since that's already implicitly done between
-        # the V frame looking "in" to the OTE vs WebbPSF simulations looking
-        # "out" from the detector toward the sky.
-        proj_v3 *= -1
-
-        mask = np.sqrt((y - proj_v3) ** 2 + (x - proj_v2) ** 2) < self.obsc_r
-        self.amplitude[mask] = 0
+        xan = np.round(xanyan[0].value / _MIRI_OBSCURATION_FIELD_STEP) * _MIRI_OBSCURATION_FIELD_STEP
+        yan = np.round(xanyan[1].value / _MIRI_OBSCURATION_FIELD_STEP) * _MIRI_OBSCURATION_FIELD_STEP
+
+        self.obsc_v2, self.obsc_v3, self.obsc_r, box, mask = _miri_obscuration(xan, yan, instrument._rotation,
+                                                                             npix=self.amplitude.shape[0])
+        self.amplitude[box][mask] = 0
 
         # No need to subclass any of the methods; it's sufficient to set the custom
         # amplitude mask attribute value.
+
+
+# Step in MIRI XAN and YAN, in degrees, to which field points are rounded for the internal
+# obscuration model, so that nearby detector positions share the cached mask. With the
+# projection below (about 21 and 26 m/deg in V2 and V3), rounding moves the obscuration by
+# at most 0.33 mm on the primary, about 5% of a 6.4 mm pupil pixel.
+_MIRI_OBSCURATION_FIELD_STEP = 2.5e-5
+
+
+@functools.lru_cache(maxsize=1024)
+def _miri_obscuration(xan, yan, rotation, npix=1024):
+    """ Compute the obscuration from the MIRI internal calibration source pickoff mirror
+    for a field point, for `MIRIFieldDependentAberrationAndObscuration`.
+
+    Parameters
+    ----------
+    xan, yan : float
+        Field point, in degrees
+    rotation : float
+        Rotation of the MIRI internal pupil relative to the OTE exit pupil, in degrees
+    npix : int
+        Size of the pupil array
+
+    Returns
+    -------
+    obsc_v2, obsc_v3, obsc_r : float
+        Position and radius of the obscuration projected onto the primary, in meters
+    box : tuple of slices
+        The region of the pupil array containing the obscuration
+    mask : ndarray of bool
+        Read-only mask, for the pixels within box, which are obscured
+    """
+    #    Telfer:
+    #    Here is the matrix that reproduces the projection of the
+    #    obscuration on the primary mirror, V2-V3 coordinates and
+    #    radius in mm, as a function of XAN,YAN in degrees.
+    #    So, V2 is:
+    #
+    #           V2 = -20882.636 * XAN -680.661 * YAN  - 1451.682.
+    #
+    #                     XAN            YAN         Const
+    #           V2     -20882.636     -680.661    -1451.682
+    #           V3        815.955    26395.552    -2414.406
+    #           Rad       176.864     -392.545      626.920
+
+    # we implement the above here, and convert the outputs to meters:
+    obsc_v2 = (-20882.636 * xan - 680.661 * yan - 1451.682) * 0.001
+    obsc_v3 = (815.955 * xan + 26395.552 * yan - 2414.406) * 0.001
+    obsc_r = (176.864 * xan - 392.545 * yan + 626.920) * 0.001
+
+    # generate coordinates. N.B. this assumed hard-coded pixel scale and
+    # array size. Pupil coordinates are the same along both axes, as from
+    # poppy.Wavefront.pupil_coordinates, so we only need them in 1D.
+    pixel_scale = constants.JWST_CIRCUMSCRIBED_DIAMETER / npix
+    coords = pixel_scale * (np.arange(npix, dtype=float) - (npix - 1) / 2.0)
+
+    # Now, the v2 and v3 coordinates calculated above are as projected back to
+    # the OTE entrance pupil
+    # But the OTE exit pupil as seen at the MIRI internal pupil is rotated by
+    # 5 degrees with respect to that, and flipped in handedness as well
+    # (but only in V3, given webbpsf axes conventions relative to the definition of the V frame)
+    # Therefore we must transform the v2 and v3 to match the wavefront coords at the
+    # intermediate plane.
+
+    angle = np.deg2rad(rotation)
+    proj_v2 = np.cos(angle) * obsc_v2 - np.sin(angle) * obsc_v3
+    proj_v3 = -np.sin(angle) * obsc_v2 + np.cos(angle) * obsc_v3
+
+    # handle V3 flip from OTE entrance to exit pupils
+    # no flip needed for V2 since that's already implicitly done between
+    # the V frame looking "in" to the OTE vs WebbPSF simulations looking
+    # "out" from the detector toward the sky.
+    proj_v3 *= -1
+
+    # Only evaluate the pixels within the bounding box of the obscuration, plus a pixel margin
+    def span(center):
+        start = int(np.floor((center - obsc_r) / pixel_scale + (npix - 1) / 2.0)) - 1
+        stop = int(np.ceil((center + obsc_r) / pixel_scale + (npix - 1) / 2.0)) + 2
+        return slice(min(max(start, 0), npix), min(max(stop, 0), npix))
+
+    box = (span(proj_v3), span(proj_v2))
+    y = coords[box[0], np.newaxis]
+    x = coords[np.newaxis, box[1]]
+    mask = np.sqrt((y - proj_v3) ** 2 + (x - proj_v2) ** 2) < obsc_r
+    mask.flags.writeable = False
+    return obsc_v2, obsc_v3, obsc_r, box, mask
@@ -0,0 +1,406 @@
+"""
+Shared-memory parallel propagation of polychromatic PSFs.
+
+POPPY's own multiprocessing support pickles the entire optical system,
+including every pupil, OPD and aberration array, once for every wavelength.
+For JWST optical systems that is many megabytes per task. The executor here
+instead copies each large array of the optical planes into a
+`multiprocessing.shared_memory` block once, even if the array is used by
+several optical systems; worker processes attach to those blocks and use them
+directly without copying. The worker pool is kept alive
+between calculations, so repeated calc_psf calls also avoid the cost of
+starting new processes.
+
+Enable it for all calculations by setting
+``webbpsf.conf.use_shared_memory_executor = True``. The number of processes
+is taken from ``poppy.conf.n_processes`` if that is set > 1, otherwise from
+the number of available CPUs.
+"""
+import copy
+import io
+import multiprocessing
+import os
+import pickle
+import types
+import uuid
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import astropy.units as units
+import poppy
+
+try:
+    from multiprocessing import shared_memory
+    _HAS_SHARED_MEMORY = True
+except ImportError:  # Python < 3.8
+    _HAS_SHARED_MEMORY = False
+
+from . import conf
+
+import logging
+
+_log = logging.getLogger('webbpsf')
+
+# Arrays smaller than this are simply pickled along with the rest of the optical system
+_MIN_SHARED_NBYTES = 64 * 1024
+
+# Number of optical systems each worker keeps attached at once
+_WORKER_CACHE_SIZE = 4
+
+
+def _large_arrays(plane):
+    """ Return (attribute name, shape, dtype) for each ndarray attribute of an optic large enough to share """
+    return [(attr, value.shape, value.dtype.str) for attr, value in vars(plane).items()
+            if isinstance(value, np.ndarray) and value.nbytes >= _MIN_SHARED_NBYTES and value.dtype != object]
+
+
+def _share_array(array):
+    """ Copy an array into a new shared memory block """
+    block = shared_memory.SharedMemory(create=True, size=array.nbytes)
+    _refresh_block(block, array)
+    return block
+
+
+def _refresh_block(block, array):
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+    shared[...] = array
+
+
+def _release_block(block):
+    try:
+        block.close()
+        block.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _omitted_optical_system():
+    return None
+
+
+class _SkeletonPickler(pickle.Pickler):
+    """ Pickler which leaves out every optical system other than the skeleton itself.
+
+    Some optics refer back to their instrument (e.g. the SI aberrations), which in turn holds
+    its most recent and cached optical systems, with all their arrays. Workers don't need those.
+    """
+
+    def __init__(self, file, skeleton):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._skeleton = skeleton
+
+    def reducer_override(self, obj):
+        if isinstance(obj, poppy.poppy_core.BaseOpticalSystem) and obj is not self._skeleton:
+            return _omitted_optical_system, ()
+        return NotImplemented
+
+
+class _SharedOpticalSystem(object):
+    """ Pickled skeleton of an optical system in shared memory.
+
+    The skeleton is a pickled copy of the optical system in which every large ndarray
+    attribute of each plane has been replaced by None. Workers unpickle it once and then
+    re-attach the arrays as read-only views of their shared memory blocks, which are
+    owned by the executor rather than by this object, since they may be shared between
+    optical systems.
+
+    Parameters
+    ----------
+    optsys : poppy.OpticalSystem
+        The optical system
+    array_specs : list of tuples
+        (plane index, attribute name, block name, shape, dtype) for each large array
+    """
+
+    def __init__(self, optsys, array_specs):
+        self.token = uuid.uuid4().hex
+        self.array_specs = array_specs
+
+        skeleton = copy.copy(optsys)
+        skeleton.planes = []
+        plane_copies = {}
+        for plane in optsys.planes:
+            plane_copy = copy.copy(plane)
+            for attr, shape, dtype in _large_arrays(plane):
+                setattr(plane_copy, attr, None)
+            skeleton.planes.append(plane_copy)
+            plane_copies[id(plane)] = plane_copy
+        # Some optical systems (e.g. SemiAnalyticCoronagraph) keep extra references to particular
+        # planes; point those at the stripped copies too.
+        for attr, value in vars(optsys).items():
+            if attr != 'planes' and id(value) in plane_copies:
+                setattr(skeleton, attr, plane_copies[id(value)])
+        # Remove any shared-memory calc_psf override set on the instance; workers use the normal class method
+        skeleton.__dict__.pop('calc_psf', None)
+
+        buffer = io.BytesIO()
+        _SkeletonPickler(buffer, skeleton).dump(skeleton)
+        skeleton_bytes = buffer.getvalue()
+        self._block = shared_memory.SharedMemory(create=True, size=max(len(skeleton_bytes), 1))
+        self._block.buf[:len(skeleton_bytes)] = skeleton_bytes
+        self.skeleton_spec = (self._block.name, len(skeleton_bytes))
+
+    def release(self):
+        if self._block is not None:
+            _release_block(self._block)
+            self._block = None
+
+    def worker_args(self):
+        return self.token, self.skeleton_spec, self.array_specs
+
+
+# ---- functions that run in worker processes
+
+_worker_systems = OrderedDict()  # token -> (optical system, shared memory blocks)
+
+
+def _attach_optical_system(token, skeleton_spec, array_specs):
+    """ Get the optical system for a token within a worker process, attaching to shared memory if needed """
+    if token in _worker_systems:
+        _worker_systems.move_to_end(token)
+        return _worker_systems[token][0]
+
+    name, nbytes = skeleton_spec
+    block = shared_memory.SharedMemory(name=name)
+    blocks = [block]
+    optsys = pickle.loads(bytes(block.buf[:nbytes]))
+    for iplane, attr, name, shape, dtype in array_specs:
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+        view = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        view.flags.writeable = False
+        setattr(optsys.planes[iplane], attr, view)
+
+    _worker_systems[token] = (optsys, blocks)
+    while len(_worker_systems) > _WORKER_CACHE_SIZE:
+        _, (old_optsys, old_blocks) = _worker_systems.popitem(last=False)
+        del old_optsys
+        for old_block in old_blocks:
+            try:
+                old_block.close()
+            except BufferError:
+                pass  # views are still referenced somewhere; the mapping is released when they are collected
+    return optsys
+
+
+def _propagate_wavelength(args):
+    """ Worker task: propagate one wavelength through a shared optical system """
+    (token, skeleton_spec, array_specs), wavelength, normalize, use_fftw, double_precision = args
+    poppy.conf.use_fftw = use_fftw
+    poppy.conf.double_precision = double_precision
+    optsys = _attach_optical_system(token, skeleton_spec, array_specs)
+    mono_psf, _ = optsys.propagate_mono(wavelength * units.meter, normalize=normalize)
+    return mono_psf
+
+
+def _init_worker():
+    # Workers should not report progress through the normal handlers, which would duplicate log output
+    logging.getLogger('poppy').setLevel(logging.WARNING)
+    logging.getLogger('webbpsf').setLevel(logging.WARNING)
+
+
+# ---- the executor itself
+
+class SharedMemoryExecutor(object):
+    """ Persistent process pool for computing polychromatic PSFs in parallel over wavelength,
+    with the optical system arrays held in shared memory.
+
+    Parameters
+    ----------
+    n_processes : int, optional
+        Number of worker processes. Defaults to poppy.conf.n_processes if that is > 1,
+        otherwise the number of available CPUs.
+
+    Example
+    -------
+    >>> executor = SharedMemoryExecutor(n_processes=8)
+    >>> osys = nrc.get_optical_system()
+    >>> psf = executor.calc_psf(osys, wavelengths, weights)
+    >>> executor.close()
+
+    """
+
+    def __init__(self, n_processes=None):
+        if not _HAS_SHARED_MEMORY:
+            raise RuntimeError("The shared memory executor requires Python >= 3.8 for multiprocessing.shared_memory")
+        if n_processes is None:
+            n_processes = poppy.conf.n_processes if poppy.conf.n_processes > 1 else os.cpu_count()
+        self.n_processes = int(n_processes)
+        self._pool = None
+        self._shared = weakref.WeakKeyDictionary()  # optical system -> _SharedOpticalSystem
+        self._arrays = {}  # id(array) -> (weak reference to array, shared memory block)
+
+    def _get_pool(self):
+        if self._pool is None:
+            # Use forkserver rather than fork, as in poppy, for robustness; see poppy issue #23
+            ctx = multiprocessing.get_context('forkserver')
+            self._pool = ctx.Pool(self.n_processes, initializer=_init_worker)
+            _log.debug("Started shared memory executor with {} processes".format(self.n_processes))
+        return self._pool
+
+    def _share_arrays(self, optsys):
+        """ Get shared memory blocks for the large arrays of all the optical system's planes.
+
+        Blocks are kept per array, not per optical system, so planes reused between optical
+        systems (such as those calc_psfs builds for each detector position) are copied into
+        shared memory only once. Optics may be modified in place between calculations (for
+        instance by updating the OTE linear model), so existing blocks are refreshed from
+        their arrays; this is a plain memory copy, much cheaper than re-pickling.
+        Each block is released when its array is garbage collected.
+        """
+        array_specs = []
+        for iplane, plane in enumerate(optsys.planes):
+            for attr, shape, dtype in _large_arrays(plane):
+                array = getattr(plane, attr)
+                ref, block = self._arrays.get(id(array), (None, None))
+                if ref is not None and ref() is array:
+                    _refresh_block(block, array)
+                else:
+                    block = _share_array(array)
+                    self._arrays[id(array)] = (weakref.ref(array), block)
+                    weakref.finalize(array, self._release_array, id(array), block)
+                array_specs.append((iplane, attr, block.name, shape, dtype))
+        return array_specs
+
+    def _release_array(self, key, block):
+        if self._arrays.get(key, (None, None))[1] is block:
+            del self._arrays[key]
+        _release_block(block)
+
+    def _get_shared(self, optsys):
+        array_specs = self._share_arrays(optsys)
+        shared = self._shared.get(optsys)
+        if shared is not None and shared.array_specs != array_specs:
+            _log.debug("Optical system arrays were replaced; re-sharing")
+            shared.release()
+            shared = None
+        if shared is None:
+            shared = _SharedOpticalSystem(optsys, array_specs)
+            self._shared[optsys] = shared
+            weakref.finalize(optsys, shared.release)
+        return shared
+
+    def calc_psf(self, optsys, wavelengths, weights=None, normalize='first'):
+        """ Compute a polychromatic PSF in parallel across wavelengths.
+
+        The result is the same as `poppy.OpticalSystem.calc_psf` for the same arguments,
+        apart from small differences in FITS history.
+
+        Parameters
+        ----------
+        optsys : poppy.OpticalSystem
+            Optical system to propagate through.
+        wavelengths : array_like
+            Wavelengths, in meters or as an astropy Quantity.
+        weights : array_like, optional
+            Relative weight for each wavelength. Defaults to equal weights.
+        normalize : string
+            How to normalize the PSF. See `poppy.OpticalSystem.propagate_mono`.
+
+        Returns
+        -------
+        outfits : fits.HDUList
+        """
+        wavelengths = np.atleast_1d(units.Quantity(wavelengths, units.meter).to_value(units.meter))
+        if weights is None:
+            weights = np.ones(len(wavelengths))
+        weights = np.asarray(weights, dtype=float)
+        if len(weights) != len(wavelengths):
+            raise ValueError("Input source has different number of weights and wavelengths...")
+        normwts = weights / weights.sum()
+
+        use_fftw = poppy.conf.use_fftw and poppy.accel_math._FFTW_AVAILABLE
+        shared = self._get_shared(optsys)
+        worker_args = [(shared.worker_args(), wlen, normalize, use_fftw, poppy.conf.double_precision)
+                       for wlen in wavelengths]
+        _log.info("Calculating PSF with {} wavelengths using shared memory executor with {} processes".format(
+            len(wavelengths), self.n_processes))
+        results = self._get_pool().map(_propagate_wavelength, worker_args)
+
+        outfits = results[0]
+        outfits[0].data *= normwts[0]
+        for mono_psf, wave_weight in zip(results[1:], normwts[1:]):
+            outfits[0].data += mono_psf[0].data * wave_weight
+        outfits[0].header.add_history("Multiwavelength PSF calc using shared memory executor "
+                                      "with {} processes completed.".format(self.n_processes))
+
+        # Same output keywords as poppy.OpticalSystem.calc_psf
+        mnwave = (wavelengths * weights).sum() / weights.sum()
+        outfits[0].header['WAVELEN'] = (mnwave, 'Weighted mean wavelength in meters')
+        outfits[0].header['NWAVES'] = (wavelengths.size, 'Number of wavelengths used in calculation')
+        for i in range(wavelengths.size):
+            outfits[0].header['WAVE' + str(i)] = (wavelengths[i], "Wavelength " + str(i))
+            outfits[0].header['WGHT' + str(i)] = (weights[i], "Wavelength weight " + str(i))
+        ffttype = "pyFFTW" if use_fftw else "numpy.fft"
+        outfits[0].header['FFTTYPE'] = (ffttype, 'Algorithm for FFTs: numpy or fftw')
+        outfits[0].header['NORMALIZ'] = (normalize, 'PSF normalization method')
+        return outfits
+
+    def close(self):
+        """ Shut down the worker processes and release all shared memory """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        for shared in list(self._shared.values()):
+            shared.release()
+        self._shared.clear()
+        for _, block in list(self._arrays.values()):
+            _release_block(block)
+        self._arrays.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_default_executor = None
+
+
+def get_executor():
+    """ Return the process-wide SharedMemoryExecutor, creating it if necessary.
+
+    The executor is shut down automatically when Python exits, or explicitly via `shutdown_executor`.
+    """
+    global _default_executor
+    if _default_executor is None:
+        import atexit
+        _default_executor = SharedMemoryExecutor()
+        atexit.register(shutdown_executor)
+    return _default_executor
+
+
+def shutdown_executor():
+    """ Shut down the process-wide SharedMemoryExecutor, if it is running """
+    global _default_executor
+    if _default_executor is not None:
+        _default_executor.close()
+        _default_executor = None
+
+
+def _calc_psf_with_executor(self, wavelength=1e-6, weight=None, save_intermediates=False,
+                            display=False, return_intermediates=False, return_final=False,
+                            normalize='first', display_intermediates=False, **kwargs):
+    """ Replacement for OpticalSystem.calc_psf which uses the shared memory executor when
+    appropriate, and otherwise falls back to the usual poppy calculation.
+    """
+    nwavelengths = np.size(wavelength.value if isinstance(wavelength, units.Quantity) else wavelength)
+    if (conf.use_shared_memory_executor and _HAS_SHARED_MEMORY and nwavelengths > 1 and not
+            (save_intermediates or display or return_intermediates or return_final or display_intermediates
+             or kwargs.get('inwave') is not None or kwargs.get('source') is not None)):
+        return get_executor().calc_psf(self, wavelength, weight, normalize=normalize)
+    return type(self).calc_psf(self, wavelength=wavelength, weight=weight, save_intermediates=save_intermediates,
+                               display=display, return_intermediates=return_intermediates,
+                               return_final=return_final, normalize=normalize,
+                               display_intermediates=display_intermediates, **kwargs)
+
+
+def enable_executor(optsys):
+    """ Route polychromatic calc_psf calls on this optical system through the shared memory
+    executor, whenever ``webbpsf.conf.use_shared_memory_executor`` is True.
+    """
+    optsys.calc_psf = types.MethodType(_calc_psf_with_executor, optsys)
+    return optsys
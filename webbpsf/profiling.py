@@ -0,0 +1,227 @@
+"""
+Per-stage timing and memory profiling of PSF calculations.
+
+Set ``inst.options['profile'] = True`` before calling ``calc_psf`` to record the wall
+time, CPU time and peak memory allocation of each stage of the calculation: building
+the optical system (including the OTE pupil and SI WFE), propagation through each
+optical plane, jitter, rotation, distortion, MIRI scattering and assembly of the output
+FITS extensions. The results are attached to the returned HDUList as a dict, its
+``profile`` attribute, and if ``inst.options['profile_keywords'] = True`` they are also
+written to the primary header as PRFnnNAM, PRFnnWAL, PRFnnCPU and PRFnnMEM keywords.
+
+Stage times include the time of any stages nested within them; e.g. 'propagation'
+includes the time of each 'plane' stage. Stages repeated within one calculation, such as
+the optical planes for each wavelength, are accumulated. Memory is measured with
+`tracemalloc`, which adds some overhead to the calculation while profiling is active,
+and peak memory is only available on Python 3.9 or later. Per-plane timings are not
+recorded when the propagation is done in other processes, i.e. when using either
+poppy's multiprocessing or the shared memory executor.
+
+Other code can add its own stages with the `stage` context manager, which does nothing
+unless a profile is being recorded.
+"""
+import contextlib
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import poppy
+
+from . import conf
+
+import logging
+
+_log = logging.getLogger('webbpsf')
+
+_HAS_RESET_PEAK = hasattr(tracemalloc, 'reset_peak')  # Python >= 3.9
+
+_state = threading.local()
+
+
+class StageProfiler(object):
+    """ Accumulates the wall time, CPU time and peak memory allocated for named stages
+
+    Attributes
+    ----------
+    stages : OrderedDict
+        For each stage name, in order of first use, a dict with the number of 'calls', and
+        the total 'wall_time' and 'cpu_time' in seconds and the largest 'peak_memory' in
+        bytes allocated during any one call (None if memory is not being traced).
+    """
+
+    def __init__(self, trace_memory=True):
+        self.stages = OrderedDict()
+        self.trace_memory = trace_memory and _HAS_RESET_PEAK
+        self._stack = []
+        self._cleanup = []
+        self._profiled_systems = set()
+        self._started_tracing = False
+
+    def start(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def stop(self):
+        """ Stop tracing memory, if this profiler started it, and undo any instrumentation of optical systems """
+        while self._cleanup:
+            self._cleanup.pop()()
+        self._profiled_systems.clear()
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Record the time and memory used within a block as part of the named stage.
+
+        Re-entering a stage which is already active, for instance when an overridden method
+        calls its parent class version, is counted as part of the outer call.
+        """
+        if any(frame['name'] == name for frame in self._stack):
+            yield
+            return
+
+        frame = {'name': name, 'child_peak': 0}
+        if self.trace_memory:
+            frame['start_memory'] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self._stack.append(frame)
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall0, time.process_time() - cpu0
+            self._stack.pop()
+            peak = None
+            if self.trace_memory:
+                absolute_peak = max(tracemalloc.get_traced_memory()[1], frame['child_peak'])
+                peak = absolute_peak - frame['start_memory']
+                if self._stack:
+                    # the reset_peak calls for this stage hide its allocations from the enclosing stage
+                    self._stack[-1]['child_peak'] = max(self._stack[-1]['child_peak'], absolute_peak)
+            self._record(name, wall, cpu, peak)
+
+    def _record(self, name, wall_time, cpu_time, peak_memory):
+        entry = self.stages.setdefault(name, {'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0,
+                                              'peak_memory': None})
+        entry['calls'] += 1
+        entry['wall_time'] += wall_time
+        entry['cpu_time'] += cpu_time
+        if peak_memory is not None:
+            entry['peak_memory'] = max(peak_memory, entry['peak_memory'] or 0)
+
+    def _set_temporary_attribute(self, obj, name, value):
+        """ Set an attribute on an object, to be restored by stop() """
+        had_attribute = name in vars(obj)
+        previous = vars(obj).get(name)
+        setattr(obj, name, value)
+
+        def restore():
+            if had_attribute:
+                setattr(obj, name, previous)
+            else:
+                delattr(obj, name)
+        self._cleanup.append(restore)
+
+    def profile_optical_system(self, optsys):
+        """ Instrument an optical system so its propagation is recorded, in total and per plane,
+        until this profiler is stopped.
+        """
+        if id(optsys) in self._profiled_systems:
+            return
+        self._profiled_systems.add(id(optsys))
+
+        calc_psf = optsys.calc_psf
+
+        def profiled_calc_psf(*args, **kwargs):
+            with self.stage('propagation'):
+                return calc_psf(*args, **kwargs)
+        self._set_temporary_attribute(optsys, 'calc_psf', profiled_calc_psf)
+
+        # Propagation in other processes pickles the optical system, which these wrappers would prevent
+        if poppy.conf.use_multiprocessing or conf.use_shared_memory_executor:
+            return
+
+        stage_names = {id(plane): 'plane {}: {}'.format(i, plane.name) for i, plane in enumerate(optsys.planes)}
+        for plane in optsys.planes:
+            self._set_temporary_attribute(plane, 'get_phasor',
+                                          self._timed_method(plane.get_phasor, stage_names[id(plane)]))
+
+        input_wavefront = optsys.input_wavefront
+
+        def profiled_input_wavefront(*args, **kwargs):
+            wavefront = input_wavefront(*args, **kwargs)
+            propagate_to = wavefront.propagate_to
+
+            def profiled_propagate_to(optic, *args, **kwargs):
+                with self.stage(stage_names.get(id(optic), 'propagation')):
+                    return propagate_to(optic, *args, **kwargs)
+            wavefront.propagate_to = profiled_propagate_to
+            return wavefront
+        self._set_temporary_attribute(optsys, 'input_wavefront', profiled_input_wavefront)
+
+    def _timed_method(self, method, name):
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return method(*args, **kwargs)
+        return timed
+
+    def to_header(self, header):
+        """ Write the profile into FITS header keywords """
+        for i, (name, entry) in enumerate(self.stages.items()):
+            if i >= 100:
+                _log.warning("Too many profiled stages to record all of them in the FITS header")
+                break
+            header['PRF{:02d}NAM'.format(i)] = (name, 'Profiled calculation stage')
+            header['PRF{:02d}WAL'.format(i)] = (entry['wall_time'], '[s] Wall time of stage')
+            header['PRF{:02d}CPU'.format(i)] = (entry['cpu_time'], '[s] CPU time of stage')
+            if entry['peak_memory'] is not None:
+                header['PRF{:02d}MEM'.format(i)] = (entry['peak_memory'], '[byte] Peak memory allocated in stage')
+
+
+def active_profiler():
+    """ Return the StageProfiler recording in this thread, or None """
+    return getattr(_state, 'profiler', None)
+
+
+@contextlib.contextmanager
+def profile(trace_memory=True):
+    """ Record the stages of calculations within a block, in this thread
+
+    Yields the StageProfiler. If a profile is already being recorded, stages are
+    added to that one instead.
+    """
+    profiler = active_profiler()
+    if profiler is not None:
+        yield profiler
+        return
+
+    profiler = _state.profiler = StageProfiler(trace_memory=trace_memory)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        _state.profiler = None
+        profiler.stop()
+
+
+def profile_optical_system(optsys):
+    """ Record the propagation through an optical system as part of the active profile, if any """
+    profiler = active_profiler()
+    if profiler is not None:
+        profiler.profile_optical_system(optsys)
+    return optsys
+
+
+@contextlib.contextmanager
+def stage(name):
+    """ Record a block of code as the named stage of the active profile, if any.
+    Can also be used as a function decorator. """
+    profiler = active_profiler()
+    if profiler is None:
+        yield
+    else:
+        with profiler.stage(name):
+            yield
@@ -270,6 +270,12 @@ class RomanInstrument(webbpsf_core.SpaceTelescopeInstrument):
         optical aberrations. (Called in get_optical_system.)"""
         return self._detectors[self._detector]
 
+    def _get_optical_system_cache_key(self, *args, **kwargs):
+        """Optical systems are not cached for Roman instruments, since the
+        field-dependent aberration optics are shared per detector and their
+        field position is updated in place."""
+        return None
+
     def _get_fits_header(self, result, options):
         """Populate FITS Header keywords"""
         super(RomanInstrument, self)._get_fits_header(result, options)
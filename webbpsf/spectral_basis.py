@@ -0,0 +1,302 @@
+"""
+Monochromatic PSF bases, for fast computation of polychromatic PSFs for many source spectra.
+
+For a fixed instrument configuration, a polychromatic PSF is a weighted sum of monochromatic
+PSFs; only the weights depend on the source spectrum. A `MonochromaticPSFBasis` computes the
+monochromatic PSFs once, on a fine wavelength grid spanning the filter bandpass, and then
+evaluates PSFs for any number of source spectra by re-weighting the cached slices::
+
+    >>> nrc = webbpsf.NIRCam()
+    >>> nrc.filter = 'F200W'
+    >>> basis = nrc.calc_psf_basis(fov_pixels=64)
+    >>> psf_g0v = basis.calc_psf(webbpsf.specFromSpectralType('G0V'))
+    >>> psf_m0v = basis.calc_psf(webbpsf.specFromSpectralType('M0V'))
+
+Computed bases are saved to disk (see `webbpsf.utils.get_webbpsf_cache_dir`), keyed by the
+instrument configuration and calculation parameters, and are reloaded automatically when the
+same configuration is requested again.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import astropy.io.fits as fits
+
+from . import conf
+from . import utils
+
+import logging
+
+_log = logging.getLogger('webbpsf')
+
+# Multiple of the filter's default number of wavelengths to use for the basis grid
+_DEFAULT_OVERSAMPLING_FACTOR = 4
+
+# calc_psf keywords which are set by the basis itself, or which make no sense for a basis
+_DISALLOWED_KEYWORDS = ('outfile', 'source', 'nlambda', 'monochromatic', 'display', 'save_intermediates',
+                        'return_intermediates')
+
+# Attributes of the instrument which are derived from others, in addition to those
+# already ignored by the optical system cache
+_IGNORED_ATTRIBUTES = ('siaf', '_detector_geom_info')
+
+# Options which JWInstrument.calc_psf overwrites from its keyword arguments on every call
+_CALC_PSF_OPTIONS = ('add_distortion', 'crop_psf', 'return_arrays')
+
+
+def _stable_value(value):
+    """ Reduce a hashable cache-key value to plain Python types with a reproducible repr,
+    replacing any other objects by the name of their type """
+    if isinstance(value, tuple):
+        return tuple(_stable_value(v) for v in value)
+    elif isinstance(value, (str, int, float, bool, type(None))):
+        return value
+    elif isinstance(value, type):
+        return f"{value.__module__}.{value.__qualname__}"
+    return type(value).__qualname__
+
+
+def _get_configuration_key(instrument, nlambda, calc_psf_kwargs):
+    """ Return a SHA1 hex digest identifying an instrument configuration and basis calculation.
+
+    The digest includes the instrument class and all its attributes which could affect the
+    PSF, the calc_psf keyword arguments, the number of wavelengths, and the software and
+    reference data versions. It is reproducible between sessions, so can be used as a key
+    for the on-disk cache.
+    """
+    from . import __version__
+
+    ignored = instrument._optsys_cache_ignored_attributes + _IGNORED_ATTRIBUTES
+    state = {k: v for k, v in vars(instrument).items() if k not in ignored}
+    state['options'] = {k: v for k, v in instrument.options.items()
+                        if k not in instrument._optsys_cache_ignored_options + _CALC_PSF_OPTIONS}
+    key = _stable_value(utils._make_hashable((instrument.__class__, state, nlambda, calc_psf_kwargs,
+                                              getattr(instrument, '_data_version', None), __version__)))
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+def _can_cache_to_disk(instrument):
+    """ Optics supplied as in-memory objects can't be identified reproducibly, so don't save those """
+    for value in (instrument.pupil, instrument.pupilopd):
+        if not (value is None or isinstance(value, str) or
+                (isinstance(value, tuple) and isinstance(value[0], str))):
+            return False
+    return True
+
+
+class MonochromaticPSFBasis(object):
+    """ A cube of monochromatic PSFs spanning a filter bandpass, for one instrument configuration.
+
+    Polychromatic PSFs for arbitrary source spectra are computed as weighted sums of the
+    cached monochromatic slices, without repeating the optical propagation.
+
+    Parameters
+    ----------
+    instrument : webbpsf.SpaceTelescopeInstrument
+        Instrument instance, configured with the desired filter, masks, detector position etc.
+    nlambda : int, optional
+        Number of wavelengths in the basis grid. Default is four times the default number of
+        wavelengths for the selected filter.
+    cache : bool
+        Load the basis from, and save it to, the on-disk cache if possible. Default is True.
+    **kwargs
+        Other keyword arguments are passed to `calc_psf` for each wavelength, for instance
+        ``fov_pixels``, ``oversample`` or ``add_distortion``.
+
+    Attributes
+    ----------
+    wavelengths : ndarray
+        Basis wavelengths, in meters
+    cubes : list of ndarray
+        For each extension of the PSF output, an array with shape (nlambda, ny, nx)
+    headers : list of astropy.io.fits.Header
+        For each extension of the PSF output, a header template
+    loaded_from_cache : bool
+        True if the basis was read from the on-disk cache rather than computed
+    """
+
+    def __init__(self, instrument, nlambda=None, cache=True, **kwargs):
+        for key in _DISALLOWED_KEYWORDS:
+            if key in kwargs:
+                raise ValueError(f"Keyword '{key}' cannot be used when computing a monochromatic PSF basis.")
+        if nlambda is None:
+            nlambda = _DEFAULT_OVERSAMPLING_FACTOR * instrument._get_default_nlambda(instrument.filter)
+
+        self.instrument = instrument
+        self.filter = instrument.filter
+        self.nlambda = int(nlambda)
+        self.calc_psf_kwargs = kwargs
+        self.loaded_from_cache = False
+        self._configuration_key = _get_configuration_key(instrument, self.nlambda, kwargs)
+
+        cache_file = None
+        if cache and _can_cache_to_disk(instrument):
+            cache_file = os.path.join(utils.get_webbpsf_cache_dir('psf_basis'),
+                                      f'{instrument.name}_{instrument.filter}_{self._configuration_key}.fits')
+            if os.path.exists(cache_file):
+                try:
+                    self._read(cache_file)
+                    self.loaded_from_cache = True
+                    _log.info(f"Loaded monochromatic PSF basis from {cache_file}")
+                except (OSError, KeyError, ValueError) as err:
+                    _log.warning(f"Could not read cached PSF basis {cache_file} ({err}); recomputing it.")
+
+        if not self.loaded_from_cache:
+            self._compute()
+            if cache_file is not None:
+                self._write(cache_file)
+                _log.info(f"Saved monochromatic PSF basis to {cache_file}")
+
+    def _compute(self):
+        """ Compute one monochromatic PSF per basis wavelength """
+        self.wavelengths = np.asarray(self.instrument._get_weights(nlambda=self.nlambda)[0], dtype=float)
+        _log.info(f"Computing monochromatic PSF basis for {self.instrument.name} {self.filter} "
+                  f"with {self.nlambda} wavelengths")
+
+        slices = []
+        for wavelength in self.wavelengths:
+            slices.append(self.instrument.calc_psf(monochromatic=wavelength, **self.calc_psf_kwargs))
+
+        self.cubes = [np.stack([psf[ext].data for psf in slices]) for ext in range(len(slices[0]))]
+        self.headers = []
+        for ext, hdu in enumerate(slices[0]):
+            header = hdu.header.copy()
+            if 'DIFFLMT' in header:
+                header['DIFFLMT'] = header['DIFFLMT'] / header['WAVELEN']  # lambda/D per meter of wavelength
+            self.headers.append(header)
+
+    def _write(self, filename):
+        """ Save the basis to a FITS file """
+        hdulist = fits.HDUList()
+        for ext, (cube, header) in enumerate(zip(self.cubes, self.headers)):
+            hdu_class = fits.PrimaryHDU if ext == 0 else fits.ImageHDU
+            hdulist.append(hdu_class(cube, header=header))
+        hdulist[0].header['BASISKEY'] = (self._configuration_key, 'Configuration key for this PSF basis')
+        hdulist.append(fits.BinTableHDU.from_columns([fits.Column(name='WAVELENGTH', format='D', unit='m',
+                                                                  array=self.wavelengths)], name='BASIS_WAVELENGTHS'))
+        try:
+            hdulist.writeto(filename, overwrite=True)
+        except OSError as err:
+            _log.warning(f"Could not save PSF basis to {filename} ({err})")
+
+    def _read(self, filename):
+        """ Load the basis from a FITS file """
+        with fits.open(filename) as hdulist:
+            if hdulist[0].header['BASISKEY'] != self._configuration_key:
+                raise ValueError("configuration key mismatch")
+            self.wavelengths = np.array(hdulist['BASIS_WAVELENGTHS'].data['WAVELENGTH'], dtype=float)
+            self.cubes = [np.array(hdu.data) for hdu in hdulist[:-1]]
+            self.headers = [hdu.header.copy() for hdu in hdulist[:-1]]
+        del self.headers[0]['BASISKEY']
+
+    def _check_configuration(self):
+        if _get_configuration_key(self.instrument, self.nlambda, self.calc_psf_kwargs) != self._configuration_key:
+            raise RuntimeError("The instrument configuration has changed since this PSF basis was computed. "
+                               "Please compute a new basis for the new configuration.")
+
+    def get_weights(self, source=None):
+        """ Return the weights for each basis wavelength for a given source spectrum.
+
+        Sources are handled as in `calc_psf`. Spectra which are defined on the basis wavelengths
+        (for instance synphot spectra, which are binned onto the same grid) are used exactly.
+        Otherwise, such as for explicit wavelength and weight arrays, each weight is divided
+        between the two nearest basis wavelengths by linear interpolation.
+
+        Returns
+        -------
+        weights : ndarray
+            Normalized weights, one per basis wavelength
+        """
+        self._check_configuration()
+        wavelengths, weights = self.instrument._get_weights(source=source, nlambda=self.nlambda)
+        wavelengths = np.asarray(wavelengths, dtype=float)
+        weights = np.asarray(weights, dtype=float)
+
+        if wavelengths.shape == self.wavelengths.shape and np.allclose(wavelengths, self.wavelengths,
+                                                                       rtol=1e-10, atol=0):
+            basis_weights = weights
+        elif self.nlambda == 1:
+            basis_weights = np.array([weights.sum()])
+        else:
+            outside = (wavelengths < self.wavelengths[0]) | (wavelengths > self.wavelengths[-1])
+            if np.any(weights[outside] != 0):
+                _log.warning("Source spectrum has nonzero weights outside the PSF basis wavelength range; "
+                             "those weights will be assigned to the nearest basis wavelength.")
+            index = np.clip(np.searchsorted(self.wavelengths, wavelengths), 1, self.nlambda - 1)
+            frac = (wavelengths - self.wavelengths[index - 1]) / (self.wavelengths[index] -
+                                                                  self.wavelengths[index - 1])
+            frac = np.clip(frac, 0, 1)
+            basis_weights = np.zeros(self.nlambda)
+            np.add.at(basis_weights, index - 1, weights * (1 - frac))
+            np.add.at(basis_weights, index, weights * frac)
+
+        return basis_weights / basis_weights.sum()
+
+    def calc_psf(self, source=None):
+        """ Compute a polychromatic PSF as a weighted sum of the monochromatic basis PSFs.
+
+        Parameters
+        ----------
+        source : synphot.spectrum.SourceSpectrum or dict or tuple
+            Source spectrum, specified in any of the ways accepted by `calc_psf`. Default is a
+            5700 K blackbody if synphot is available, else a flat spectrum.
+
+        Returns
+        -------
+        outfits : fits.HDUList
+            The output PSF, in the same format as returned by `calc_psf`
+        """
+        weights = self.get_weights(source)
+
+        outfits = fits.HDUList()
+        for ext, (cube, header) in enumerate(zip(self.cubes, self.headers)):
+            data = np.tensordot(weights, cube, axes=1)
+            hdu_class = fits.PrimaryHDU if ext == 0 else fits.ImageHDU
+            hdu = hdu_class(data, header=self._make_header(header, weights))
+            outfits.append(hdu)
+        return outfits
+
+    def _make_header(self, template, weights):
+        """ Header for a weighted sum of basis PSFs, following the keywords written by poppy """
+        header = template.copy()
+        mean_wavelength = (weights * self.wavelengths).sum()
+        header['WAVELEN'] = (mean_wavelength, 'Weighted mean wavelength in meters')
+        if 'DIFFLMT' in template:
+            header['DIFFLMT'] = (template['DIFFLMT'] * mean_wavelength, 'Diffraction limit lambda/D in arcsec')
+        header['NWAVES'] = (self.nlambda, 'Number of wavelengths used in calculation')
+        for key in ('WAVE0', 'WGHT0'):
+            header.remove(key, ignore_missing=True)
+        after = 'NWAVES'
+        for i in range(self.nlambda):
+            header.set(f'WAVE{i}', self.wavelengths[i], f'Wavelength {i}', after=after)
+            header.set(f'WGHT{i}', weights[i], f'Wavelength weight {i}', after=f'WAVE{i}')
+            after = f'WGHT{i}'
+        header['HISTORY'] = f'Computed from a monochromatic PSF basis with {self.nlambda} wavelengths'
+        return header
+
+    def interpolation_error_bound(self, ext=0):
+        """ Estimate the maximum error from representing the PSF as piecewise linear in wavelength.
+
+        Weights for spectra not defined on the basis wavelengths are distributed by linear
+        interpolation between neighboring basis wavelengths. For a uniform wavelength grid, the
+        error of linear interpolation is bounded by h^2/8 times the maximum second derivative
+        of the PSF with respect to wavelength, estimated here from second differences of the
+        basis. Use a larger ``nlambda`` if this is too large.
+
+        Parameters
+        ----------
+        ext : int
+            PSF output extension to evaluate
+
+        Returns
+        -------
+        bound : float
+            Error bound, relative to the peak pixel of the PSF. None if the basis has fewer
+            than three wavelengths.
+        """
+        cube = self.cubes[ext]
+        if self.nlambda < 3:
+            return None
+        second_difference = np.abs(cube[2:] - 2 * cube[1:-1] + cube[:-2]).max()
+        return second_difference / 8 / np.abs(cube).max()
@@ -71,3 +71,59 @@ def test_miri_aperturename():
     assert miri.detector_position == (128, 128), "Changing to a subarray aperture didn't change the " \
                                                  "reference pixel coords as expected"
     assert np.any( miri._tel_coords() != ref_tel_coords), "Changing to a subarray aperture didn't change the V2V3 coords as expected."
+
+
+def test_miri_obscuration_bounding_box():
+    """Test that the internal obscuration computed within its bounding box matches the full pupil computation"""
+    import poppy
+    from .. import constants, optics
+    xan, yan, rotation = -0.12, -0.03, 4.4497
+    obsc_v2, obsc_v3, obsc_r, box, mask = optics._miri_obscuration(xan, yan, rotation)
+    assert optics._miri_obscuration(xan, yan, rotation)[4] is mask, "Obscuration should be cached"
+
+    y, x = poppy.Wavefront.pupil_coordinates((1024, 1024), constants.JWST_CIRCUMSCRIBED_DIAMETER / 1024)
+    angle = np.deg2rad(rotation)
+    proj_v2 = np.cos(angle) * obsc_v2 - np.sin(angle) * obsc_v3
+    proj_v3 = np.sin(angle) * obsc_v2 - np.cos(angle) * obsc_v3
+    expected = np.sqrt((y - proj_v3) ** 2 + (x - proj_v2) ** 2) < obsc_r
+
+    full_mask = np.zeros((1024, 1024), dtype=bool)
+    full_mask[box] = mask
+    assert expected.any()
+    assert np.array_equal(full_mask, expected)
+
+
+def test_miri_obscuration_cached_for_nearby_positions():
+    """Test that nearby field points share the cached internal obscuration mask"""
+    import astropy.units as units
+    from .. import optics
+    miri = webbpsf_core.MIRI()
+    step = optics._MIRI_OBSCURATION_FIELD_STEP
+    field_point = (np.round(np.array([-0.12, -0.03]) / step) + 0.1) * step
+
+    optics._miri_obscuration.cache_clear()
+    optics_at = []
+    for offset in (0, 5e-6, 1e-4):  # in degrees; 5e-6 deg moves the obscuration by about 0.1 mm
+        miri._xan_yan_coords = lambda: (field_point + offset) * units.degree
+        optics_at.append(optics.MIRIFieldDependentAberrationAndObscuration(miri))
+    info = optics._miri_obscuration.cache_info()
+    assert (info.hits, info.misses) == (1, 2), "Only the two nearby field points should share the cached mask"
+    assert np.array_equal(optics_at[0].amplitude, optics_at[1].amplitude)
+    assert optics_at[2].obsc_v2 != optics_at[0].obsc_v2
+
+
+def test_miri_pupil_npix():
+    """Test the internal pupil mask and obscuration at a coarser pupil sampling"""
+    from .. import optics
+    miri = webbpsf_core.MIRI()
+    full = optics.MIRIFieldDependentAberrationAndObscuration(miri)
+    miri.options['pupil_npix'] = 256
+    coarse = optics.MIRIFieldDependentAberrationAndObscuration(miri)
+    assert coarse.opd.shape == coarse.amplitude.shape == (256, 256)
+
+    # The obscuration should be in the same place as in the full resolution mask
+    obscured = full.amplitude.reshape(256, 4, 256, 4).max(axis=(1, 3)) == 0
+    assert obscured.any()
+    assert np.all(coarse.amplitude[obscured] == 0)
+
+    miri.calc_psf(monochromatic=8e-6, fov_pixels=16)
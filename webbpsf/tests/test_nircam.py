@@ -494,3 +494,28 @@ def test_nircam_auto_aperturename():
     # but changing the detector explicitly always updates apname
     nc.detector = 'NRCA5'
     assert nc.aperturename == 'NRCA5_FULL'
+
+
+def test_nircam_chromatic_si_wfe():
+    """Test that the wavelength dependence of the NIRCam SI WFE is only a change of defocus,
+    plus tilt for coronagraphy"""
+    nrc = webbpsf_core.NIRCam()
+    nrc.filter = 'F200W'
+    wfe = nrc._get_aberrations()
+    assert np.allclose(wfe.get_opd(2.12e-6), wfe.opd, rtol=0, atol=1e-13)
+    deltafocus = wfe.fm_short(1.5) - wfe.fm_short(2.12)
+    assert np.allclose(wfe.get_opd(1.5e-6), wfe.opd - deltafocus * wfe.defocus_zern, rtol=0, atol=1e-13)
+
+    nrc.pupil_mask = 'MASKRND'
+    wfe = nrc._get_aberrations()
+    tilt = wfe.ctilt_short(1.5) - wfe.ctilt_short(2.10)
+    assert np.allclose(wfe.get_opd(1.5e-6), wfe.opd - deltafocus * wfe.defocus_zern + tilt * wfe.tilt_zern,
+                       rtol=0, atol=1e-13)
+
+    nrc.pupil_mask = None
+    nrc.filter = 'F212N'
+    wfe = nrc._get_aberrations()
+    opd = wfe.get_opd(1.5e-6)
+    assert np.shares_memory(opd, wfe.opd), "No OPD changes are needed for the focus reference filter"
+    assert not opd.flags.writeable, "The static OPD should not be modifiable through get_opd"
+    assert wfe.opd.flags.writeable
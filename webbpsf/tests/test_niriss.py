@@ -70,3 +70,13 @@ def test_niriss_aperturename():
     assert np.any(
         niriss._tel_coords() != ref_tel_coords), "Changing to a subarray aperture didn't change the V2V3 coords " \
                                                  "as expected."
+
+
+def test_niriss_oversize_pupil_npix():
+    """ Test the oversized internal pupil mask at a coarser pupil sampling """
+    from .. import optics
+    niriss = webbpsf_core.NIRISS()
+    niriss.options['pupil_npix'] = 256
+    si_wfe = optics.WebbFieldDependentAberration(niriss, include_oversize=True)
+    assert si_wfe.opd.shape == si_wfe.amplitude.shape == (256, 256)
+    assert np.all(si_wfe.opd[si_wfe.amplitude == 0] == 0)
@@ -25,3 +25,17 @@ test_nirspec_source_offset_45 = lambda : do_test_source_offset('NIRSpec', theta=
 
 test_nirspec_set_siaf = lambda : do_test_set_position_from_siaf('NIRSpec')
 
+
+
+def test_calc_psfs_nirspec():
+    """Test that batched PSFs match individual PSFs, with both the fore-optics and spectrograph WFE"""
+    nrs = webbpsf_core.NIRSpec()
+    positions = [(5, 5), (1000, 1500)]
+    kwargs = dict(monochromatic=3e-6, fov_pixels=8)
+
+    psf_cube, headers = nrs.calc_psfs(positions, **kwargs)
+    for i, pos in enumerate(positions):
+        nrs.detector_position = pos
+        psf = nrs.calc_psf(**kwargs)
+        assert np.allclose(psf_cube[0].data[i], psf[0].data, rtol=1e-10, atol=0)
+        assert headers[i][0]['SI_WFE'] == psf[0].header['SI_WFE']
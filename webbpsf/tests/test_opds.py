@@ -126,6 +126,23 @@ def test_thermal_slew_partial_angle():
 
 
 
+@pytest.mark.parametrize('case', ['BOL', 'EOL'])
+def test_thermal_model_coeffs_all(case):
+    """ Test that the vectorized thermal model matches evaluating it per segment and time """
+    model = webbpsf.opds.OteThermalModel(case=case)
+    assert model._fit_params is webbpsf.opds.OteThermalModel()._fit_params, "Fit parameters should be shared"
+
+    delta_times = np.array([0, 0.25, 1, 14])
+    coeffs = model.get_coeffs_all(delta_times)
+    assert coeffs.shape == (4, 19, 9)
+    assert model.get_coeffs_all(1).shape == (19, 9)
+    for itime, delta_time in enumerate(delta_times):
+        for iseg, segname in enumerate(webbpsf.constants.SEGNAMES_WSS_ORDER):
+            assert np.array_equal(coeffs[itime, iseg], model.get_coeffs(segname[0:2], delta_time))
+        assert coeffs[itime, 18, 4] == model.get_coeffs('SM', delta_time)
+        assert np.count_nonzero(coeffs[itime, 18]) == (1 if delta_time else 0)
+
+
 def test_thermal_slew_update_opd():
     ''' Test that running webbpsf.opds.OTE_Linear_Model_WSS.thermal_slew() will
         give the expected output
@@ -194,6 +211,230 @@ def test_update_opd():
     # Todo test random drifts
 
 
+def test_segment_hexike_basis():
+    """ Test that the precomputed segment hexikes match evaluating the hexikes over the segment directly """
+    import poppy
+    ote = webbpsf.opds.OTE_Linear_Model_WSS()
+    basis = ote._get_segment_hexike_basis()
+    assert basis is ote._get_segment_hexike_basis(), "Segment hexikes should be shared"
+    assert basis.counts.sum() == np.count_nonzero(ote._segment_masks)
+
+    segment = 'B4'
+    iseg = list(ote.segnames).index(segment)
+    coeffs = np.linspace(1, 2, 9) * 1e-8
+    ote._apply_hexikes_to_seg(segment, coeffs.copy())
+
+    wseg = np.where(ote._segment_masks == iseg + 1)
+    cx, cy = ote._seg_centers_pixels[segment]
+    seg_radius = (wseg[1].max() - wseg[1].min()) / 2.0
+    hexikes = poppy.zernike.hexike_basis_wss(x=(wseg[1] - cx) / seg_radius, y=(wseg[0] - cy) / seg_radius,
+                                             nterms=9, aperture=np.ones(len(wseg[0])))
+    expected = np.zeros_like(ote.opd)
+    expected[wseg] = np.tensordot(coeffs, hexikes, axes=1)
+    assert np.allclose(ote.opd, expected, rtol=1e-12, atol=1e-20)
+
+
+def test_influence_function_sensitivities():
+    """ Test the dense sensitivity matrices against looking up rows in the influence function table """
+    ote = webbpsf.opds.OTE_Linear_Model_WSS()
+    assert ote._seg_sensitivities.shape == (18, 6, 9)
+    assert ote._sm_sensitivities.shape == (18, 5, 9)
+    assert ote._influence_fns is webbpsf.opds.OTE_Linear_Model_WSS()._influence_fns, "Table should be shared"
+
+    table = ote._influence_fns
+    hexike_cols = ['Hexike_{}'.format(i) for i in range(9)]
+    for iseg, segment in enumerate(ote.segnames[0:18]):
+        for moved, sensitivities in ((segment, ote._get_seg_sensitivities(segment)),
+                                     ('SM', ote._get_seg_sensitivities_from_sm(segment))):
+            rows = table[(table['segment_moved'] == moved) & (table['segment_affected'] == segment)]
+            expected = np.asarray([list(row) for row in rows[hexike_cols]]) * 1e-6
+            assert np.allclose(sensitivities, expected, rtol=1e-14, atol=0)
+
+    state = np.zeros((19, 6))
+    state[4] = [0.1, -0.2, 0.3, 0.05, -0.01, 0.02]
+    state[18, :5] = [0.1, 0.2, -1, 2, 5]
+    coeffs, coeffs_from_sm = ote._get_hexike_coeffs_from_state(np.stack([state, 2 * state]))
+    assert coeffs.shape == coeffs_from_sm.shape == (2, 18, 9)
+    assert np.allclose(coeffs[0, 4], state[4] @ ote._seg_sensitivities[4], rtol=1e-14, atol=0)
+    assert np.all(coeffs[0, :4] == 0)
+    assert np.allclose(coeffs_from_sm[0], state[18, :5] @ ote._sm_sensitivities, rtol=1e-14, atol=0)
+    assert np.allclose(coeffs[1], 2 * coeffs[0], rtol=1e-14, atol=0)
+
+
+def test_global_bases():
+    """ Test the shared global hexike and Zernike bases against computing them with poppy """
+    import poppy
+    ote = webbpsf.opds.OTE_Linear_Model_WSS()
+    basis = ote._get_global_hexike_basis()
+    assert basis is webbpsf.opds.OTE_Linear_Model_WSS()._get_global_hexike_basis(), "Basis should be shared"
+
+    coeffs = np.zeros(15)
+    coeffs[4] = 2e-8
+    ote._apply_global_hexikes(coeffs)
+    expected = 2e-8 * poppy.zernike.hexike_basis_wss(nterms=9, npix=1024, aperture=ote._segment_masks != 0)[4]
+    expected[~np.isfinite(expected)] = 0
+    assert np.allclose(ote.opd, expected, rtol=1e-12, atol=1e-22)
+
+    ote.zero()
+    zcoeffs = [0, 0, 0, 1e-8, 0, 2e-9]
+    ote._apply_global_zernikes(zcoeffs)
+    expected = poppy.zernike.opd_from_zernikes(zcoeffs, npix=1024, basis=poppy.zernike.zernike_basis_faster)
+    inside = np.isfinite(expected)
+    # The Zernike basis is shared in single precision
+    assert np.allclose(ote.opd[inside], expected[inside], rtol=1e-6, atol=1e-15)
+    assert np.all(ote.opd[~inside] == 0)
+
+
+@pytest.mark.parametrize('npix', [256, 512])
+def test_downsampled_linear_model(npix):
+    """ Test the OTE linear model at coarser pupil sampling against block averaging the 1024 pixel model """
+    full = webbpsf.opds.OTE_Linear_Model_WSS()
+    ote = webbpsf.opds.OTE_Linear_Model_WSS(npix=npix)
+    factor = 1024 // npix
+    assert ote.shape == (npix, npix)
+    assert np.isclose(ote.pixelscale.value, full.pixelscale.value * factor)
+    assert np.isclose(ote.header['PUPLSCAL'], full.header['PUPLSCAL'] * factor)
+    assert ote._segment_masks.shape == (npix, npix)
+    assert np.all((ote._segment_masks != 0) == (ote.amplitude != 0))
+
+    for model in (full, ote):
+        model.move_seg_local('B3', xtilt=0.5, piston=0.1)
+        model.move_seg_local('C5', roc=0.1)
+        model.move_sm_local(xtilt=0.1)
+
+    def block_sum(array):
+        return array.reshape(npix, factor, npix, factor).sum(axis=(1, 3))
+
+    # Compare over the blocks lying entirely within one segment
+    weights = block_sum(full.amplitude)
+    expected = block_sum(full.opd * full.amplitude) / np.where(weights == 0, 1, weights)
+    blocks = full._segment_masks.reshape(npix, factor, npix, factor)
+    pure = (blocks.min(axis=(1, 3)) == blocks.max(axis=(1, 3))) & (ote._segment_masks != 0)
+    assert np.all(ote._segment_masks[pure] == blocks.max(axis=(1, 3))[pure])
+    rms = lambda a: np.sqrt((a ** 2).mean())
+    assert rms(ote.opd[pure] - expected[pure]) < 0.03 * rms(expected[pure])
+
+    with pytest.raises(ValueError):
+        webbpsf.opds.OTE_Linear_Model_WSS(npix=300)
+
+
+def test_incremental_update_opd():
+    """ Test that incremental OPD updates match rebuilding the OPD from scratch """
+    ote = webbpsf.opds.OTE_Linear_Model_WSS()
+    ote.move_seg_local('A3', xtilt=0.1, piston=0.05)
+    opd_before = ote.opd.copy()
+
+    # A single segment move should only change the pixels of that segment
+    ote.move_seg_local('B5', clocking=1, radial=0.1)
+    changed = ote.opd != opd_before
+    assert changed.any()
+    assert np.all(ote._segment_masks[changed] == list(ote.segnames).index('B5') + 1)
+
+    ote.move_sm_local(xtilt=0.2)
+    ote.move_global_zernikes([0, 0, 0, 1e-3])
+    ote.move_seg_local('A3', xtilt=0, piston=0.05)
+    ote.move_seg_local('B5', clocking=0, radial=0)
+    ote.remove_piston_tip_tilt = True
+    ote.update_opd()
+    assert ote.check_update_consistency() < 1e-15
+
+    ote.move_seg_local('C2', ytilt=-0.3)
+    incremental = ote.opd.copy()
+    ote.update_opd(full_rebuild=True)
+    assert np.allclose(incremental, ote.opd, rtol=0, atol=1e-15, equal_nan=True)
+
+    ote.opd[500, 500] += 1e-9
+    with pytest.raises(RuntimeError):
+        ote.check_update_consistency()
+
+
+def test_opds_from_states(tmpdir):
+    """ Test that batched OPDs match updating the model for each state in turn """
+    rng = np.random.default_rng(0)
+    states = rng.normal(size=(3, 19, 6)) * 0.05
+    delta_times = [0, 5, 24]
+    frill_amplitudes = [1, 0, 3]
+    iec_amplitudes = [0, 2, 1]
+
+    ote = webbpsf.opds.OTE_Linear_Model_WSS(rm_ptt=True)
+    ote.thermal_slew(1 * u.hour, start_angle=0, end_angle=30, delay_update=True)
+    ote.move_global_zernikes([0, 0, 0, 1e-3], delay_update=True)
+
+    chunks = list(ote.opds_from_states(states, delta_times * u.hour, frill_amplitudes, iec_amplitudes, chunk_size=2))
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    out = np.lib.format.open_memmap(str(tmpdir / 'opds.npy'), mode='w+', shape=(3,) + ote.opd.shape)
+    assert ote.opds_from_states(states, delta_times, frill_amplitudes, iec_amplitudes, out=out) is out
+    assert np.array_equal(np.concatenate(chunks), out, equal_nan=True)
+
+    for i in range(3):
+        ote.segment_state[:] = states[i]
+        ote.thermal_slew(delta_times[i] * u.hour, start_angle=0, end_angle=30, delay_update=True)
+        ote.apply_frill_drift(frill_amplitudes[i], delay_update=True)
+        ote.apply_iec_drift(iec_amplitudes[i])
+        assert np.allclose(out[i], ote.opd, rtol=0, atol=1e-15, equal_nan=True)
+
+    with pytest.raises(ValueError):
+        ote.opds_from_states(states[:, :18])
+
+
+def test_opd_time_series(tmpdir):
+    """ Test that the OPD time series matches updating the model for each time in turn """
+    times = [1, 5, 24] * u.hour
+    frill_amplitudes = [0, 1, 2]
+    iec_amplitudes = [1, 3, 0]
+
+    ote = webbpsf.opds.OTE_Linear_Model_WSS()
+    ote.move_seg_local('C4', xtilt=0.1, piston=-0.05)
+    ote.thermal_slew(0, start_angle=5, end_angle=40, case='EOL')
+    opd_before = ote.opd.copy()
+
+    expected = []
+    for i in range(3):
+        ote.thermal_slew(times[i], start_angle=5, end_angle=40, case='EOL', delay_update=True)
+        ote.apply_frill_drift(frill_amplitudes[i], delay_update=True)
+        ote.apply_iec_drift(iec_amplitudes[i])
+        expected.append(ote.opd.copy())
+    expected = np.asarray(expected)
+    ote.thermal_slew(0, start_angle=5, end_angle=40, case='EOL', delay_update=True)
+    ote.apply_frill_drift(0, delay_update=True)
+    ote.apply_iec_drift(0)
+
+    opds = np.concatenate(list(ote.opd_time_series(times, frill_amplitudes, iec_amplitudes, chunk_size=2)))
+    assert np.allclose(opds, expected, rtol=0, atol=1e-15)
+
+    deltas = np.concatenate(list(ote.opd_time_series(times, frill_amplitudes, iec_amplitudes, deltas=True,
+                                                     chunk_size=2)))
+    assert np.allclose(opd_before + np.cumsum(deltas, axis=0), expected, rtol=0, atol=1e-15)
+
+    coeffs = ote.opd_time_series(times, frill_amplitudes, iec_amplitudes, coefficients=True, out=np.zeros((3, 19, 9)))
+    assert coeffs.shape == (3, 19, 9)
+    assert np.allclose(coeffs[:, 18, 4], ote._get_thermal_slew_coeffs_all(times.to_value(u.day))[:, 18, 4])
+
+    filename = str(tmpdir / 'opds.fits')
+    ote.opd_time_series(times, frill_amplitudes, iec_amplitudes, filename=filename)
+    assert np.allclose(fits.getdata(filename), expected, rtol=0, atol=1e-15)
+    assert fits.getheader(filename)['THRMCASE'] == 'EOL'
+
+
+def test_opd_slice_loading(tmpdir):
+    """ Test that single slices of OPD datacubes are loaded via memory mapping of a
+    decompressed cached copy, with the same results as reading the whole file """
+    import os
+    nc = webbpsf.NIRCam()
+    opd_file = os.path.join(nc._datapath, 'OPD', nc.opd_list[-1])
+    cube = fits.getdata(opd_file)
+
+    with webbpsf.conf.set_temp('cache_directory', str(tmpdir)):
+        for opd_slice in range(min(cube.shape[0], 3)):
+            ote = webbpsf.opds.OTE_Linear_Model_WSS(opd=(opd_file, opd_slice))
+            with webbpsf.conf.set_temp('memmap_opd_files', False):
+                ote_direct = webbpsf.opds.OTE_Linear_Model_WSS(opd=(opd_file, opd_slice))
+            assert np.allclose(ote.opd, ote_direct.opd)
+            assert ote.opd_file == opd_file
+            assert ote.opd_slice == opd_slice
+        assert len(os.listdir(os.path.join(str(tmpdir), 'fits'))) == 1, "Decompressed OPD file should be cached once"
+
+
 def test_move_sur(plot=False):
     """ Test we can move mirrors using Segment Update Requests
     """
@@ -288,3 +529,36 @@ def test_single_seg_psf(segmentid=1):
     psf_rm_ptt = nrc.calc_psf(nlambda=1)
     assert not np.allclose(psf[0].data, psf_rm_ptt[0].data), "Piston/Tip/Tip removal should shift the overall PSF"
     assert np.abs(webbpsf.measure_centroid(psf)[0] - webbpsf.measure_centroid(psf_rm_ptt)[0]) > 40, "centroid should shift susbtantially with/without tip/tilt removal"
+
+
+def test_was_ptt_basis_fit():
+    """ Test fitting segment piston, tip and tilt with the JWST WAS PTT basis """
+    ote = webbpsf.opds.OTE_Linear_Model_WSS()
+    ptt_basis = webbpsf.opds.JWST_WAS_PTT_Basis()
+    basis = ptt_basis(npix=256, outside=0)
+    assert basis.shape == (54, 256, 256)
+    assert ptt_basis(nterms=4, npix=256, outside=0).shape == (4, 256, 256)
+
+    rng = np.random.default_rng(1)
+    for segname in ote.segnames[0:18]:
+        ote.move_seg_local(segname, xtilt=rng.normal(), ytilt=rng.normal(), piston=rng.normal())
+    expected = ote.segment_state[0:18].copy()
+    expected[:, 3:] = 0
+
+    coeffs = ptt_basis.fit(ote.opd, aperture=ote.amplitude)
+    assert np.allclose(webbpsf.opds.coeffs_to_seg_state(coeffs), expected, rtol=1e-9, atol=1e-9)
+
+    # The fit should be consistent with the basis arrays, and robust to missing pixels
+    opd = np.tensordot(coeffs, ptt_basis(outside=0), axes=1)
+    opd[500:520, 300:700] = np.nan
+    assert np.allclose(ptt_basis.fit(opd, aperture=ote.amplitude), coeffs, rtol=1e-9, atol=1e-15)
+
+    # Segments whose remaining pixels cannot constrain piston, tip and tilt should be NaN
+    aperture = ote.amplitude.copy()
+    rows, cols = np.where(ote._segment_masks == 1)
+    aperture[rows[2:], cols[2:]] = 0  # only two pixels left in A1
+    rows, cols = np.where(ote._segment_masks == 2)
+    aperture[rows[rows != rows[0]], cols[rows != rows[0]]] = 0  # only one row of pixels left in A2
+    partial = ptt_basis.fit(opd, aperture=aperture).reshape(18, 3)
+    assert np.all(np.isnan(partial[0:2]))
+    assert np.allclose(partial[2:], coeffs.reshape(18, 3)[2:], rtol=1e-9, atol=1e-15)
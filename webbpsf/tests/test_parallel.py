@@ -0,0 +1,60 @@
+import copy
+
+import numpy as np
+import pytest
+
+from .. import webbpsf_core
+from .. import parallel
+from .. import conf
+
+
+@pytest.mark.skipif(not parallel._HAS_SHARED_MEMORY, reason="requires multiprocessing.shared_memory")
+def test_shared_memory_executor():
+    """ Test that PSFs computed using the shared memory executor match serial calculations,
+    and that the worker pool and shared arrays are reused across calls """
+    nc = webbpsf_core.NIRCam()
+    nc.filter = 'F212N'
+    kwargs = dict(nlambda=3, fov_pixels=32, oversample=2, add_distortion=False)
+
+    psf_serial = nc.calc_psf(**kwargs)
+
+    with conf.set_temp('use_shared_memory_executor', True):
+        executor = parallel.SharedMemoryExecutor(n_processes=2)
+        parallel._default_executor = executor
+        try:
+            psf_shared = nc.calc_psf(**kwargs)
+            assert 'shared memory executor' in str(psf_shared[0].header['HISTORY'])
+            assert np.allclose(psf_shared[0].data, psf_serial[0].data)
+            assert psf_shared[0].header['NWAVES'] == 3
+            assert psf_shared[0].header['WAVELEN'] == psf_serial[0].header['WAVELEN']
+
+            pool = executor._pool
+            assert len(executor._shared) == 1
+
+            # Changing the OTE OPD in place should be reflected in the next calculation
+            ote = nc.optsys.planes[0]
+            ote.opd *= 2
+            psf_shared2 = nc.calc_psf(**kwargs)
+            assert executor._pool is pool, "Worker pool should persist between calculations"
+            assert len(executor._shared) == 1, "Shared memory should be reused for the same optical system"
+            assert not np.allclose(psf_shared2[0].data, psf_shared[0].data)
+
+            # Another optical system reusing the same planes should reuse their shared memory blocks
+            n_arrays = len(executor._arrays)
+            optsys2 = copy.copy(nc.optsys)
+            optsys2.planes = list(nc.optsys.planes)
+            psf_shared3 = executor.calc_psf(optsys2, [2.1e-6, 2.12e-6])
+            assert len(executor._shared) == 2
+            assert len(executor._arrays) == n_arrays, "Arrays reused between optical systems should not be re-shared"
+            assert executor._shared[optsys2].array_specs == executor._shared[nc.optsys].array_specs
+            assert np.all(np.isfinite(psf_shared3[0].data))
+
+            # Batches of PSFs build an optical system per position, which must also work with the executor
+            positions = [(100, 100), (1000, 1000)]
+            psf_cube_shared, _ = nc.calc_psfs(positions, **kwargs)
+        finally:
+            parallel.shutdown_executor()
+    assert executor._pool is None
+
+    psf_cube_serial, _ = nc.calc_psfs(positions, **kwargs)
+    assert np.allclose(psf_cube_shared[0].data, psf_cube_serial[0].data)
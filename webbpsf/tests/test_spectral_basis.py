@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from .. import webbpsf_core
+from .. import spectral_basis
+from .. import conf
+
+
+def test_monochromatic_psf_basis(tmpdir):
+    """ Test that PSFs computed from a monochromatic basis match full calculations,
+    and that bases are saved to and reloaded from the on-disk cache """
+    nc = webbpsf_core.NIRCam()
+    nc.filter = 'F212N'
+    kwargs = dict(fov_pixels=16, oversample=2, add_distortion=False)
+
+    with conf.set_temp('cache_directory', str(tmpdir)):
+        basis = nc.calc_psf_basis(nlambda=3, **kwargs)
+        assert not basis.loaded_from_cache
+        assert basis.cubes[0].shape == (3, 32, 32)
+
+        # Spectra on the basis wavelengths are reproduced exactly
+        psf = nc.calc_psf(nlambda=3, **kwargs)
+        psf_basis = basis.calc_psf()
+        assert len(psf_basis) == len(psf)
+        for ext in range(len(psf)):
+            assert np.allclose(psf_basis[ext].data, psf[ext].data)
+        assert psf_basis[0].header['NWAVES'] == 3
+        assert np.isclose(psf_basis[0].header['WAVELEN'], psf[0].header['WAVELEN'])
+
+        # Other spectra are interpolated onto the basis wavelengths
+        source = {'wavelengths': [basis.wavelengths[0], basis.wavelengths[1]], 'weights': [1, 1]}
+        assert np.allclose(basis.get_weights(source), [0.5, 0.5, 0])
+        midpoint = {'wavelengths': [basis.wavelengths[:2].mean()], 'weights': [1]}
+        assert np.allclose(basis.get_weights(midpoint), [0.5, 0.5, 0])
+
+        bound = basis.interpolation_error_bound()
+        assert 0 < bound < 1
+
+        basis2 = spectral_basis.MonochromaticPSFBasis(nc, nlambda=3, **kwargs)
+        assert basis2.loaded_from_cache
+        assert np.allclose(basis2.calc_psf()[0].data, psf_basis[0].data)
+
+    nc.filter = 'F200W'
+    with pytest.raises(RuntimeError):
+        basis.calc_psf()
@@ -1,4 +1,4 @@
-import sys, os
+import sys, os, subprocess
 import numpy as np
 import matplotlib.pyplot as plt
 import astropy.io.fits as fits
@@ -97,3 +97,22 @@ def test_measure_strehl():
     assert meas_perf_strehl <= 1.0, 'measured Strehl cannot be > 1, even for a perfect PSF'
 
 
+
+
+def test_lazy_import():
+    """ Test that importing webbpsf doesn't load the heavy dependencies until they're needed """
+    if sys.version_info < (3, 7):
+        return  # lazy imports require module __getattr__, from Python 3.7
+    results = utils.benchmark_import(iterations=1, verbose=False)
+    assert results['loaded_modules'] == [], "import webbpsf should not load poppy, matplotlib etc."
+
+    results = utils.benchmark_import(iterations=1, statement='import webbpsf; webbpsf.display_psf', verbose=False)
+    assert 'poppy' in results['loaded_modules']
+
+
+def test_eager_import_fallback():
+    """ Test that on Python 3.6, without module __getattr__, everything is imported up front """
+    statement = ("import sys, poppy; sys.version_info = (3, 6, 9, 'final', 0); import webbpsf; "
+                 "assert 'NIRCam' in vars(webbpsf) and 'display_psf' in vars(webbpsf); "
+                 "assert webbpsf.webbpsf_core.NIRCam is webbpsf.NIRCam")
+    subprocess.run([sys.executable, '-c', statement], check=True)
@@ -1,7 +1,9 @@
 import sys, os
 import numpy as np
+import pytest
 import matplotlib.pyplot as plt
 import astropy.io.fits as fits
+import astropy.units as units
 
 
 import logging
@@ -215,6 +217,275 @@ def test_calc_psf_format_output():
     psf_dist = nir.calc_psf(add_distortion=True)
     assert len(psf_dist) == 2
 
+
+def test_optical_system_cache():
+    """Test that optical systems are reused for unchanged configurations,
+    and rebuilt when the configuration changes
+    """
+    from .. import conf
+    nc = webbpsf_core.NIRCam()
+
+    osys = nc.get_optical_system()
+    assert nc.get_optical_system() is osys, "Unchanged configuration should reuse the cached optical system"
+
+    psf1 = nc.calc_psf(monochromatic=2e-6, fov_pixels=32)
+    psf2 = nc.calc_psf(monochromatic=2.1e-6, fov_pixels=32)
+    assert len(nc._optsys_cache) == 2, "Changing only the wavelength should not require a new optical system"
+    assert psf1[0].header['SI_WFE'] == psf2[0].header['SI_WFE']
+
+    nc.detector_position = (500, 500)
+    assert nc.get_optical_system() is not osys, "Changing detector position should invalidate the cache"
+    nc.filter = 'F200W'
+    assert nc.get_optical_system() is not osys, "Changing filter should invalidate the cache"
+    nc.options['pupil_shift_x'] = 0.01
+    assert nc.get_optical_system() is not osys, "Changing options should invalidate the cache"
+    assert len(nc._optsys_cache) <= conf.optsys_cache_size
+
+    # in-memory OPDs may be modified in place, so are not cached
+    nc.pupilopd = fits.open(os.path.join(nc._datapath, 'OPD', nc.opd_list[-1]))
+    assert nc.get_optical_system() is not nc.get_optical_system()
+
+    nc.clear_optical_system_cache()
+    assert len(nc._optsys_cache) == 0
+
+    with conf.set_temp('optsys_cache_size', 0):
+        nc.pupilopd = None
+        assert nc.get_optical_system() is not nc.get_optical_system()
+
+
+def test_data_registry():
+    """Test that instrument reference data are shared between instances, and can be refreshed"""
+    from .. import data_registry
+    nc1 = webbpsf_core.NIRCam()
+    nc2 = webbpsf_core.NIRCam()
+    assert nc1.siaf is nc2.siaf
+    assert nc1._filters == nc2._filters
+    assert nc1.opd_list == nc2.opd_list
+
+    # Per-instance containers are copies, so can be modified independently
+    nc1.filter_list.append('TEST')
+    assert 'TEST' not in nc2.filter_list
+
+    data_registry.refresh()
+    nc3 = webbpsf_core.NIRCam()
+    assert nc3.siaf is not nc1.siaf
+    assert nc3.filter_list == nc2.filter_list
+
+
+def test_si_wfe_field_interpolator():
+    """Test that the shared SI WFE interpolator matches separate cubic interpolation of each Zernike term"""
+    import scipy.interpolate
+    from .. import data_registry, optics
+    nc = webbpsf_core.NIRCam()
+    nc.detector_position = (1000, 1200)
+    wfe = optics.WebbFieldDependentAberration(nc)
+    assert wfe.si_wfe_type[0] == 'Interpolated'
+
+    v2, v3 = nc._tel_coords().to_value(units.arcmin)
+    for i in [1, 4, 11, 36]:
+        expected = scipy.interpolate.griddata((wfe.ztable['V2'], wfe.ztable['V3']), wfe.ztable['Zernike_{}'.format(i)],
+                                              (v2, v3), method='cubic')
+        assert wfe.zernike_coeffs[i - 1] == expected
+
+    wfe2 = optics.WebbFieldDependentAberration(webbpsf_core.NIRCam())
+    assert wfe2.ztable is wfe.ztable, "Interpolator should be shared between instrument instances"
+    zernike_file = os.path.join(webbpsf_core.utils.get_webbpsf_data_path(), 'si_zernikes_isim_cv3.fits')
+    assert data_registry.get_si_wfe_interpolator(zernike_file, 'NIRCamSWA').ztable is wfe.ztable
+
+
+def test_si_wfe_extrapolation_cache(tmpdir):
+    """Test that SI WFE extrapolation grids are saved to the cache directory and reused"""
+    from .. import data_registry, optics
+    nis = webbpsf_core.NIRISS()
+    nis.detector_position = (2040, 2040)
+    with webbpsf_core.conf.set_temp('cache_directory', str(tmpdir)):
+        data_registry.refresh()
+        wfe = optics.WebbFieldDependentAberration(nis)
+        assert wfe.si_wfe_type[0] == 'Extrapolated'
+        cache_files = os.listdir(os.path.join(str(tmpdir), 'si_wfe'))
+        assert len(cache_files) == 1, "Extrapolation grid should be saved once"
+
+        data_registry.refresh()
+        wfe2 = optics.WebbFieldDependentAberration(nis)
+        assert wfe2.ztable is not wfe.ztable
+        assert os.listdir(os.path.join(str(tmpdir), 'si_wfe')) == cache_files
+        assert np.allclose(wfe2.zernike_coeffs, wfe.zernike_coeffs, rtol=1e-12, atol=0)
+    data_registry.refresh()
+
+
+def test_zernike_basis_cache(tmpdir):
+    """Test that the shared Zernike basis is memory mapped from the cache and gives the same OPDs as poppy"""
+    import poppy
+    from .. import data_registry, optics
+    coeffs = np.linspace(-1, 1, 36) * 1e-8
+    with webbpsf_core.conf.set_temp('cache_directory', str(tmpdir)):
+        data_registry.refresh()
+        basis = data_registry.get_zernike_basis(64, 36)
+        assert basis.dtype == np.float32
+        assert isinstance(basis, np.memmap)
+        assert len(os.listdir(os.path.join(str(tmpdir), 'zernike'))) == 1
+        assert data_registry.get_zernike_basis(64, 36) is basis
+        assert data_registry.memory_usage()['memory_mapped'] == basis.nbytes
+
+        opd = optics._opd_from_zernikes(coeffs, 64)
+        expected = poppy.zernike.opd_from_zernikes(coeffs, npix=64, outside=0)
+        assert np.allclose(opd, expected, rtol=0, atol=1e-6 * np.abs(expected).max())
+    data_registry.refresh()
+
+
+def test_get_si_wfe_coefficients():
+    """Test that SI WFE coefficients for many field points match those of the optic for each point"""
+    from .. import optics
+    nis = webbpsf_core.NIRISS()
+    positions = [(1024, 1024), (5, 5), (2040, 100)]  # includes extrapolated points
+    coeffs = optics.get_si_wfe_coefficients(nis, positions)
+    assert coeffs.shape == (len(positions), 36)
+
+    v2v3 = []
+    for i, pos in enumerate(positions):
+        nis.detector_position = pos
+        wfe = optics.WebbFieldDependentAberration(nis)
+        assert np.allclose(coeffs[i], wfe.zernike_coeffs, rtol=1e-12, atol=0)
+        v2v3.append(nis._tel_coords())
+    assert np.allclose(optics.get_si_wfe_coefficients(nis, v2v3=units.Quantity(v2v3)), coeffs, rtol=1e-12, atol=0)
+
+    with pytest.raises(ValueError):
+        optics.get_si_wfe_coefficients(nis, positions, v2v3=v2v3)
+
+
+def test_calc_psfs(monkeypatch):
+    """Test that batched PSFs at multiple positions match PSFs calculated individually"""
+    from .. import optics
+    nis = webbpsf_core.NIRISS()
+    nis.filter = 'F277W'
+    positions = [(100, 100), (1024, 1024), (2000, 300), (2047, 2047)]
+    kwargs = dict(monochromatic=2.8e-6, fov_pixels=16, oversample=2)
+
+    # The SI WFE should be evaluated for all positions together
+    evaluate_calls = []
+    evaluate = optics.SIWFEFieldInterpolator.evaluate
+    monkeypatch.setattr(optics.SIWFEFieldInterpolator, 'evaluate',
+                        lambda self, *args: evaluate_calls.append(args) or evaluate(self, *args))
+    progress_calls = []
+    psf_cube, headers = nis.calc_psfs(positions, progress=lambda i, pos: progress_calls.append((i, pos)), **kwargs)
+    assert len(evaluate_calls) == 1
+    monkeypatch.undo()
+    assert progress_calls == list(enumerate(positions))
+    # The OTE model should have been updated for the field position of each PSF
+    last_ote_v2v3 = nis.optsys.planes[0].v2v3
+    assert len(headers) == len(positions)
+    assert nis.detector_position == (1024, 1024), "detector_position should be restored after calc_psfs"
+
+    for i, pos in enumerate(positions):
+        nis.detector_position = pos
+        psf = nis.calc_psf(**kwargs)
+        assert len(psf_cube) == len(psf)
+        for ext in range(len(psf)):
+            assert psf_cube[ext].data.shape == (len(positions),) + psf[ext].data.shape
+            assert np.allclose(psf_cube[ext].data[i], psf[ext].data)
+        assert headers[i][0]['DET_X'] == psf[0].header['DET_X']
+        assert headers[i][0]['SIWFETYP'] == psf[0].header['SIWFETYP']
+        for term in range(1, 36):
+            assert headers[i][0]['SIZERN{}'.format(term)] == psf[0].header['SIZERN{}'.format(term)]
+    assert np.allclose(units.Quantity(last_ote_v2v3, units.arcsec), units.Quantity(nis._tel_coords(), units.arcsec))
+
+    # position-dependent keywords should not appear in the header of the cube
+    assert 'DET_X' not in psf_cube[0].header
+    assert psf_cube[0].header['NUM_PSFS'] == len(positions)
+
+
+def test_single_precision():
+    """Test that single precision calculations stay in float32 and closely match double precision"""
+    nc = webbpsf_core.NIRCam()
+    nc.filter = 'F212N'
+    kwargs = dict(nlambda=1, fov_pixels=32, oversample=2)
+
+    psf_double = nc.calc_psf(**kwargs)
+    nc.options['precision'] = 'single'
+    psf_single = nc.calc_psf(**kwargs)
+
+    assert nc.optsys.planes[0].opd.dtype == np.float32
+    assert psf_single[0].header['PRECISN'] == 'single'
+    for ext in range(len(psf_double)):
+        assert psf_single[ext].data.dtype == np.float32
+        rel_diff = np.abs(psf_single[ext].data - psf_double[ext].data).max() / psf_double[ext].data.max()
+        assert rel_diff < 1e-5, "Single precision PSF differs from double precision by more than expected"
+
+    nc.options['precision'] = 'quad'
+    with pytest.raises(ValueError):
+        nc.calc_psf(**kwargs)
+
+
+def test_single_precision_user_optics():
+    """Test that single precision calculations do not convert optics owned by the caller"""
+    from .. import opds
+    nc = webbpsf_core.NIRCam()
+    nc, ote = opds.enable_adjustable_ote(nc)
+    nc.options['precision'] = 'single'
+    optsys = nc.get_optical_system(fov_pixels=32)
+    assert optsys.planes[0].opd.dtype == np.float32
+    assert optsys.planes[0] is not ote
+    assert ote.opd.dtype == np.float64
+    assert ote._opd_original.dtype == np.float64
+
+    nc.options['precision'] = 'double'
+    ote.move_seg_local('A1', xtilt=0.1)
+    assert ote.opd.dtype == np.float64
+    assert nc.get_optical_system(fov_pixels=32).planes[0] is ote
+
+
+def test_return_arrays():
+    """Test that calc_psf with return_arrays matches the HDUList output, computing distortion only on access"""
+    nc = webbpsf_core.NIRCam()
+    nc.filter = 'F212N'
+    kwargs = dict(nlambda=1, fov_pixels=16, oversample=2)
+
+    psf = nc.calc_psf(**kwargs)
+    # The undistorted PSF is not modified when the distorted copy is made
+    assert not np.shares_memory(psf['OVERSAMP'].data, psf['OVERDIST'].data)
+
+    arrays = nc.calc_psf(return_arrays=True, **kwargs)
+    assert list(arrays) == [hdu.header['EXTNAME'] for hdu in psf]
+    assert arrays.header['FILTER'] == 'F212N'
+    assert 'OVERDIST' not in arrays._arrays, "Distortion should not be computed before it is accessed"
+    for hdu in psf:
+        assert np.array_equal(arrays[hdu.header['EXTNAME']], hdu.data)
+
+    with pytest.raises(ValueError):
+        nc.calc_psf(return_arrays=True, outfile='psf.fits', **kwargs)
+
+
+def test_profiling(tmpdir):
+    """Test that profiling records each stage of a calculation, and leaves the optical system unchanged"""
+    nc = webbpsf_core.NIRCam()
+    nc.filter = 'F212N'
+    nc.options['profile'] = True
+    nc.options['profile_keywords'] = True
+    outfile = str(tmpdir.join('psf.fits'))
+    psf = nc.calc_psf(outfile, nlambda=2, fov_pixels=16, oversample=2)
+
+    for stage in ['calc_psf', 'optical_system', 'ote_pupil', 'si_wfe', 'propagation', 'jitter',
+                  'rotation', 'distortion', 'fits_assembly']:
+        assert stage in psf.profile, "Missing profile for stage " + stage
+        assert psf.profile[stage]['wall_time'] <= psf.profile['calc_psf']['wall_time']
+    plane_stages = [stage for stage in psf.profile if stage.startswith('plane 0')]
+    assert len(plane_stages) == 1
+    assert psf.profile[plane_stages[0]]['calls'] == 4, "Each wavelength should propagate to and apply each plane"
+
+    assert psf[0].header['PRF00NAM'] == list(psf.profile)[0]
+    assert psf[0].header['PRF00WAL'] == psf.profile[list(psf.profile)[0]]['wall_time']
+    with fits.open(outfile) as written:
+        assert np.isclose(written[0].header['PRF00WAL'], psf[0].header['PRF00WAL'], rtol=1e-12)
+        assert written[0].header['FILENAME'] == 'psf.fits'
+        assert len(written) == len(psf)
+
+    # Profiling wrappers are removed from the (cached) optical system afterwards
+    assert 'calc_psf' not in vars(nc.optsys)
+    assert not any('get_phasor' in vars(plane) for plane in nc.optsys.planes)
+
+    nc.options['profile'] = False
+    assert not hasattr(nc.calc_psf(nlambda=1, fov_pixels=16, oversample=2), 'profile')
+
 #------------------    Utility Function Tests    ----------------------------
 
 
@@ -1,17 +1,13 @@
 from collections import OrderedDict
 import os, sys
-import astropy.io.fits as fits
-from astropy.nddata import NDData
 import numpy as np
-import matplotlib.pyplot as plt
-
-import scipy.interpolate as sciint
 
 import logging
 
 _log = logging.getLogger('webbpsf')
 
 from . import conf
+from . import data_registry
 
 _DISABLE_FILE_LOGGING_VALUE = 'none'
 
@@ -213,10 +209,9 @@ def get_webbpsf_data_path(data_version_min=None, return_version=False):
         # Check if the data in WEBBPSF_PATH meet the minimum data version
         version_file_path = os.path.join(path, 'version.txt')
         try:
-            with open(version_file_path) as f:
-                version_contents = f.read().strip()
-                # keep only first 3 elements for comparison (allows "0.3.4.dev" or similar)
-                parts = version_contents.split('.')[:3]
+            version_contents = data_registry.get_data_version(path)
+            # keep only first 3 elements for comparison (allows "0.3.4.dev" or similar)
+            parts = version_contents.split('.')[:3]
             version_tuple = tuple(map(int, parts))
         except (IOError, ValueError):
             raise EnvironmentError(
@@ -241,6 +236,102 @@ def get_webbpsf_data_path(data_version_min=None, return_version=False):
     return path
 
 
+def get_webbpsf_cache_dir(subdir=None):
+    """Get the directory used for caching computed WebbPSF data products
+
+    This is set by the ``cache_directory`` configuration item; by default a 'webbpsf'
+    subdirectory of the astropy cache directory is used. The directory (and the optional
+    subdirectory within it) is created if it does not already exist.
+    """
+    if conf.cache_directory == 'default':
+        from astropy.config.paths import get_cache_dir
+        path = os.path.join(get_cache_dir(), 'webbpsf')
+    else:
+        path = os.path.expanduser(conf.cache_directory)
+    if subdir is not None:
+        path = os.path.join(path, subdir)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def get_uncompressed_fits_filename(filename):
+    """Return the filename of an uncompressed copy of a gzipped FITS file
+
+    Gzipped FITS files can't be memory mapped, so they are decompressed once into the
+    WebbPSF cache directory and the cached copy is used thereafter. The cached copy is
+    keyed by the original file's path, size and modification time, so it is replaced
+    automatically if the original changes. Filenames which are not gzipped are returned
+    unchanged, as is the original filename if the cache directory is not writable.
+    """
+    import gzip
+    import hashlib
+    import shutil
+    import tempfile
+
+    if not filename.endswith('.gz'):
+        return filename
+
+    stat = os.stat(filename)
+    key = hashlib.sha1(f"{os.path.abspath(filename)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+    try:
+        cache_dir = get_webbpsf_cache_dir('fits')
+        cached_filename = os.path.join(cache_dir, f"{key[:16]}_{os.path.basename(filename)[:-3]}")
+        if not os.path.exists(cached_filename):
+            _log.debug(f"Decompressing {filename} to {cached_filename}")
+            fd, tmp_filename = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            try:
+                with gzip.open(filename, 'rb') as infile, os.fdopen(fd, 'wb') as outfile:
+                    shutil.copyfileobj(infile, outfile)
+                os.replace(tmp_filename, cached_filename)  # atomic, in case of concurrent processes
+            except BaseException:
+                os.remove(tmp_filename)
+                raise
+    except OSError as err:
+        _log.warning(f"Could not cache a decompressed copy of {filename} ({err}); reading it directly.")
+        return filename
+    return cached_filename
+
+
+def load_fits_slice(filename, slice=None):
+    """Load a single 2D image from a FITS file, which may contain a datacube
+
+    If the ``memmap_opd_files`` configuration item is set, the file is memory mapped so
+    that only the selected slice is read from disk, using a decompressed cached copy for
+    gzipped files (see `get_uncompressed_fits_filename`).
+
+    Parameters
+    ----------
+    filename : str
+        FITS file name. The data are read from the primary HDU, or the first extension if
+        the primary HDU has no data, as for `astropy.io.fits.getdata`.
+    slice : int, optional
+        Slice to use if the data are a datacube. Default is the first slice.
+
+    Returns
+    -------
+    hdulist : fits.HDUList
+        HDUList containing the 2D image, as float64, and the header of the file
+    """
+    import astropy.io.fits as fits
+
+    if conf.memmap_opd_files:
+        filename = get_uncompressed_fits_filename(filename)
+
+    with fits.open(filename, memmap=conf.memmap_opd_files) as hdulist:
+        hdu = hdulist[0] if hdulist[0].data is not None else hdulist[1]
+        data = hdu.data
+        if data.ndim > 2:
+            data = data[0 if slice is None else slice]
+        data = np.array(data, dtype='=f8')  # copy just this slice out of the memory map
+        header = hdu.header.copy()
+
+    # remove structural keywords which don't apply to the 2D slice
+    for key in ('SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'NAXIS3', 'EXTEND',
+                'PCOUNT', 'GCOUNT', 'BSCALE', 'BZERO'):
+        header.remove(key, ignore_missing=True)
+    return fits.HDUList([fits.PrimaryHDU(data, header=header)])
+
+
 DIAGNOSTIC_REPORT = """
 OS: {os}
 CPU: {cpu}
@@ -442,6 +533,8 @@ def measure_strehl(HDUlist_or_filename=None, ext=0, slice=0, center=None, displa
 
     """
 
+    import astropy.io.fits as fits
+    import matplotlib.pyplot as plt
     from .webbpsf_core import Instrument
     from poppy import display_psf
 
@@ -663,6 +756,78 @@ nlambda={nlambda:d}""".format(nlambda=nlambda))
     return _run_benchmark(timer, iterations=iterations)
 
 
+def benchmark_import(iterations=5, statement='import webbpsf', verbose=True):
+    """ Performance benchmark for the cold-start latency of importing webbpsf
+
+    Each iteration times the import statement in a new Python interpreter process,
+    as experienced by short-lived worker processes. Also reports which of the heavier
+    dependencies were loaded as a side effect of the import.
+
+    Parameters
+    ----------
+    iterations : int
+        Number of new processes to time
+    statement : str
+        Python statement(s) to time, e.g. 'import webbpsf; webbpsf.NIRCam()'
+    verbose : bool
+        Print the results?
+
+    Returns
+    -------
+    results : dict
+        Minimum and median times in seconds, and the list of heavy modules loaded
+    """
+    import subprocess
+    import json
+
+    heavy_modules = ['poppy', 'pysiaf', 'matplotlib', 'scipy', 'astropy.table', 'synphot', 'pysynphot']
+    script = ("import sys, time, json\n"
+              "t0 = time.perf_counter()\n"
+              "{statement}\n"
+              "t1 = time.perf_counter()\n"
+              "print(json.dumps([t1 - t0, [m for m in {heavy!r} if m in sys.modules]]))\n"
+              ).format(statement=statement, heavy=heavy_modules)
+
+    times = []
+    for i in range(iterations):
+        output = subprocess.run([sys.executable, '-c', script], check=True, stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout
+        elapsed, loaded = json.loads(output.strip().splitlines()[-1])
+        times.append(elapsed)
+
+    results = {'min': np.min(times),
+               'median': np.median(times),
+               'loaded_modules': loaded}
+    if verbose:
+        print("Timing '{}' in {} new processes:".format(statement, iterations))
+        print("  min {:.3f} s, median {:.3f} s".format(results['min'], results['median']))
+        print("  heavy modules loaded: {}".format(', '.join(loaded) if loaded else 'none'))
+    return results
+
+
+def _make_hashable(value):
+    """ Recursively convert a value into something hashable, for use in cache keys.
+
+    Dicts, lists and tuples are converted to tuples; numpy arrays and astropy Quantities
+    are represented by their shape, dtype, unit and a SHA1 digest of their contents.
+    Other values are returned unchanged, so unhashable types will still raise TypeError
+    when the result is hashed.
+    """
+    import hashlib
+    import astropy.units as u
+
+    if isinstance(value, dict):
+        return tuple((k, _make_hashable(value[k])) for k in sorted(value))
+    elif isinstance(value, (list, tuple)):
+        return tuple(_make_hashable(v) for v in value)
+    elif isinstance(value, u.Quantity):
+        return (_make_hashable(value.value), str(value.unit))
+    elif isinstance(value, np.ndarray):
+        arr = np.ascontiguousarray(value)
+        return ('ndarray', arr.shape, arr.dtype.str, hashlib.sha1(arr.view(np.uint8)).hexdigest())
+    return value
+
+
 def combine_docstrings(cls):
     """ Combine the docstrings of a method and earlier implementations of the same method in parent classes """
     for name, func in cls.__dict__.items():
@@ -704,6 +869,8 @@ def to_griddedpsfmodel(HDUlist_or_filename=None, ext_data=0, ext_header=0):
         Photutils object with 3D data array and metadata with specified
         grid_xypos and oversampling keys
     """
+    import astropy.io.fits as fits
+    from astropy.nddata import NDData
     try:
         from photutils import GriddedPSFModel
     except ImportError:
@@ -19,11 +19,13 @@ the logger name "webbpsf".
 
 Code by Marshall Perrin <mperrin@stsci.edu>
 """
+import contextlib
+import inspect
 import os
-import glob
 import time
 import copy
-from collections import namedtuple, OrderedDict
+from collections import OrderedDict
+from collections.abc import Mapping
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.interpolate, scipy.ndimage
@@ -31,13 +33,10 @@ import matplotlib
 
 import astropy
 import astropy.io.fits as fits
-import astropy.io.ascii as ioascii
 import astropy.units as units
 
 import poppy
 
-import pysiaf
-
 from . import conf
 from . import utils
 from . import optics
@@ -45,24 +44,47 @@ from . import DATA_VERSION_MIN
 from . import distortion
 from . import gridded_library
 from . import opds
+from . import parallel
+from . import spectral_basis
+from . import data_registry
+from . import profiling
 
 try:
     from .version import version
 except ImportError:
     version = ''
 
-try:
-    import pysynphot
-
-    _HAS_PYSYNPHOT = True
-except ImportError:
-    _HAS_PYSYNPHOT = False
-
 import logging
 
 _log = logging.getLogger('webbpsf')
 
-Filter = namedtuple('Filter', ['name', 'filename', 'default_nlambda'])
+Filter = data_registry.Filter
+
+
+# Arrays smaller than this are left in double precision by _to_single_precision, since they
+# are parameters (e.g. mirror states or coefficients) rather than sampled maps of the optics
+_MIN_SINGLE_PRECISION_SIZE = 1024
+
+
+def _to_single_precision(optics):
+    """ Convert the 2D float64 and complex128 arrays of optical elements, such as their
+    transmission and OPD maps, to float32 and complex64.
+
+    Each optic with arrays to convert is replaced in the list by a converted shallow copy,
+    so that optics supplied by the user, such as an adjustable OTE model used as the pupil,
+    are left unchanged for later calculations.
+    """
+    for i, optic in enumerate(optics):
+        converted = {}
+        for name, value in vars(optic).items():
+            if isinstance(value, np.ndarray) and value.ndim == 2 and value.size >= _MIN_SINGLE_PRECISION_SIZE:
+                if value.dtype == np.float64:
+                    converted[name] = value.astype(np.float32)
+                elif value.dtype == np.complex128:
+                    converted[name] = value.astype(np.complex64)
+        if converted:
+            optics[i] = copy.copy(optic)
+            vars(optics[i]).update(converted)
 
 
 class SpaceTelescopeInstrument(poppy.instrument.Instrument):
@@ -131,6 +153,25 @@ class SpaceTelescopeInstrument(poppy.instrument.Instrument):
         This is usually not what you want to do, but is available for comparison tests.
         The SAM code will in general be much faster than the FFT method,
         particularly for high oversampling.
+    precision : string "double" or "single"
+        Floating point precision for the calculation (default: "double"). In single precision,
+        the pupil, OPD and SI aberration maps, wavefronts and output PSFs are all kept as
+        float32/complex64, which halves memory use and substantially speeds up the FFTs and
+        MFTs. The cost is numerical noise at roughly the 1e-6 level relative to the PSF peak,
+        so single precision is not suitable for high contrast calculations which need the
+        PSF wings far below that level.
+    profile : bool
+        Record the wall time, CPU time and peak memory allocated for each stage of calc_psf,
+        as the `profile` dict attribute of the returned HDUList. See `webbpsf.profiling`.
+    profile_keywords : bool
+        When profiling, also write the results to the header of the PSF. If an `outfile`
+        is given, it is written once the profile is complete, so also includes them;
+        the time to write it is not part of the profile.
+    pupil_npix : int
+        For JWST, number of pixels across the entrance pupil, e.g. 256 or 512 rather than
+        the default 1024 pixels. The OTE linear model, its segment masks and hexike bases
+        are then all downsampled to that resolution, for faster but lower fidelity
+        calculations. Must evenly divide the 1024 pixel sampling of the pupil file.
 
     """
     _detectors = {}
@@ -150,24 +191,9 @@ class SpaceTelescopeInstrument(poppy.instrument.Instrument):
     """
 
     def _get_filters(self):
-        filter_table = ioascii.read(os.path.join(self._WebbPSF_basepath, self.name, 'filters.tsv'))
-        filter_info = {}
-        filter_list = []  # preserve the order from the table
-
-        for filter_row in filter_table:
-            filter_filename = os.path.join(
-                self._WebbPSF_basepath,
-                self.name,
-                'filters',
-                '{}_throughput.fits'.format(filter_row['filter'])
-            )
-            filter_info[filter_row['filter']] = Filter(
-                name=filter_row['filter'],
-                filename=filter_filename,
-                default_nlambda=filter_row['nlambda']
-            )
-            filter_list.append(filter_row['filter'])
-        return filter_list, filter_info
+        filter_list, filter_info = data_registry.get_filters(self._WebbPSF_basepath, self.name)
+        # copies, since instances may modify these but the registry's data are shared
+        return list(filter_list), dict(filter_info)
 
     def _get_default_nlambda(self, filtername):
         """ Return the default # of wavelengths to be used for calculation by a given filter """
@@ -218,6 +244,7 @@ class SpaceTelescopeInstrument(poppy.instrument.Instrument):
         self.pixelscale = pixelscale
         "Detector pixel scale, in arcsec/pixel"
         self._spectra_cache = {}  # for caching pysynphot results.
+        self._optsys_cache = OrderedDict()  # for caching optical systems; see get_optical_system.
 
         # n.b.STInstrument subclasses must set these
         self._detectors = {}
@@ -326,6 +353,7 @@ class SpaceTelescopeInstrument(poppy.instrument.Instrument):
         """
         self.aperturename = self._detectors[self._detector]
 
+    @profiling.stage('fits_assembly')
     def _get_fits_header(self, result, options):
         """ populate FITS Header keywords """
         super(SpaceTelescopeInstrument, self)._get_fits_header(result, options)
@@ -353,6 +381,45 @@ class SpaceTelescopeInstrument(poppy.instrument.Instrument):
         for key in self._extra_keywords:
             result[0].header[key] = self._extra_keywords[key]
 
+    def _single_precision(self, options=None):
+        """ Should calculations use single precision, per the 'precision' option? """
+        precision = (self.options if options is None else options).get('precision', 'double')
+        if precision not in ('single', 'double'):
+            raise ValueError("Invalid precision option '{}'; must be 'single' or 'double'.".format(precision))
+        return precision == 'single'
+
+    def calc_psf(self, *args, **kwargs):
+        with contextlib.ExitStack() as stack:
+            if self._single_precision():
+                stack.enter_context(poppy.conf.set_temp('double_precision', False))
+            if not self.options.get('profile', False):
+                return super(SpaceTelescopeInstrument, self).calc_psf(*args, **kwargs)
+
+            profile_keywords = self.options.get('profile_keywords', False)
+            if profile_keywords:
+                # The profile is only complete once calc_psf returns, so write any output file afterwards
+                call = inspect.signature(poppy.instrument.Instrument.calc_psf).bind(self, *args, **kwargs)
+                outfile = call.arguments.get('outfile')
+                overwrite = call.arguments.get('overwrite', True)
+                call.arguments['outfile'] = None
+                args, kwargs = call.args[1:], call.kwargs
+
+            profiler = stack.enter_context(profiling.profile())
+            with profiler.stage('calc_psf'):
+                result = super(SpaceTelescopeInstrument, self).calc_psf(*args, **kwargs)
+            psf = result[0] if isinstance(result, tuple) else result
+            psf.profile = copy.deepcopy(profiler.stages)
+            if profile_keywords:
+                profiler.to_header(psf[0].header)
+                if outfile is not None:
+                    psf[0].header["FILENAME"] = (os.path.basename(outfile), "Name of this file")
+                    psf.writeto(outfile, overwrite=overwrite)
+                    _log.info("Saved result to " + outfile)
+            return result
+
+    calc_psf.__doc__ = poppy.instrument.Instrument.calc_psf.__doc__
+
+    @profiling.stage('fits_assembly')
     def _calc_psf_format_output(self, result, options):
         """ Apply desired formatting to output file:
                  - rebin to detector pixel scale if desired
@@ -367,9 +434,44 @@ class SpaceTelescopeInstrument(poppy.instrument.Instrument):
             # first rebin down to detector sampling
             # then call mockdms routines to embed in larger detector etc
             raise NotImplementedError('Not implemented yet')
+        elif 'both' in output_mode.lower():
+            self._add_detector_sampled_extensions(result, options)
         else:
             poppy.Instrument._calc_psf_format_output(self, result, options)
 
+        if self._single_precision(options):
+            for hdu in result:
+                hdu.data = hdu.data.astype(np.float32, copy=False)
+                hdu.header['PRECISN'] = ('single', 'Floating point precision of calculation')
+
+    def _add_detector_sampled_extensions(self, result, options):
+        """ Follow each extension of result with a copy rebinned to detector pixels, as for the
+        'Both as FITS extensions' output mode of poppy.Instrument._calc_psf_format_output.
+
+        This rebins the oversampled data directly, rather than first making a full copy of each
+        oversampled extension.
+        """
+        detector_oversample = options.get('detector_oversample', 1)
+        _log.info(" Adding extension with image downsampled to detector pixel scale.")
+
+        hdus = []
+        for hdu in result:
+            if detector_oversample > 1:
+                rebinned_data = poppy.utils.rebin_array(hdu.data, rc=(detector_oversample, detector_oversample))
+            else:
+                rebinned_data = hdu.data.copy()
+            rebinned = fits.ImageHDU(rebinned_data, hdu.header)
+            rebinned.header['OVERSAMP'] = (1, 'These data are rebinned to detector pixels')
+            rebinned.header['CALCSAMP'] = (detector_oversample, 'This much oversampling used in calculation')
+            rebinned.header['PIXELSCL'] *= detector_oversample
+            rebinned.header['EXTNAME'] = rebinned.header['EXTNAME'].replace("OVER", "DET_")
+            hdus += [hdu, rebinned]
+
+        # Create enough new extensions to append all psfs to them, keeping the same HDUList object
+        [result.append(fits.ImageHDU()) for i in np.arange(len(hdus) - len(result))]
+        for ext in np.arange(len(hdus)): result[ext] = hdus[ext]
+
+    @profiling.stage('optical_system')
     def get_optical_system(self, fft_oversample=2, detector_oversample=None,
                             fov_arcsec=2, fov_pixels=None, options=None):
         """ Return an OpticalSystem instance corresponding to the instrument as currently configured.
@@ -400,6 +502,101 @@ class SpaceTelescopeInstrument(poppy.instrument.Instrument):
         osys : poppy.OpticalSystem
             an optical system instance representing the desired configuration.
 
+        Notes
+        -----
+        Optical systems are cached per instrument instance, keyed on the full instrument configuration
+        (filter, masks, detector and position, pupil, OPD, sampling and options), so repeated calls with
+        an unchanged configuration return the same OpticalSystem object rather than rebuilding it.
+        The number of cached systems is set by `webbpsf.conf.optsys_cache_size`; set that to 0 to disable
+        caching. Configurations using in-memory pupil or OPD objects (OpticalElement or HDUList instances)
+        are never cached, since those may be modified in place. If you modify the planes of a returned
+        optical system directly, call `clear_optical_system_cache` afterwards.
+
+        """
+        if options is None: options = self.options
+        if detector_oversample is None: detector_oversample = fft_oversample
+
+        cache_key = self._get_optical_system_cache_key(fft_oversample, detector_oversample,
+                                                       fov_arcsec, fov_pixels, options)
+        if cache_key is not None and cache_key in self._optsys_cache:
+            _log.info("Reusing cached optical system model")
+            self._optsys_cache.move_to_end(cache_key)
+            optsys, extra_keywords, pupil_radius = self._optsys_cache[cache_key]
+            self._extra_keywords = extra_keywords.copy()
+            self.pupil_radius = pupil_radius
+            if conf.use_shared_memory_executor:
+                parallel.enable_executor(optsys)
+            return profiling.profile_optical_system(optsys)
+
+        optsys = self._build_optical_system(fft_oversample=fft_oversample, detector_oversample=detector_oversample,
+                                            fov_arcsec=fov_arcsec, fov_pixels=fov_pixels, options=options)
+        if self._single_precision(options):
+            _to_single_precision(optsys.planes)
+        if conf.use_shared_memory_executor:
+            parallel.enable_executor(optsys)
+
+        if cache_key is not None:
+            self._optsys_cache[cache_key] = (optsys, self._extra_keywords.copy(), self.pupil_radius)
+            while len(self._optsys_cache) > max(conf.optsys_cache_size, 0):
+                self._optsys_cache.popitem(last=False)
+        return profiling.profile_optical_system(optsys)
+
+    def __getstate__(self):
+        # Cached optical systems can be large, and are not needed in copies of the instrument
+        # (for instance those sent to other processes along with an optical system), so omit them.
+        state = self.__dict__.copy()
+        state['_optsys_cache'] = OrderedDict()
+        state['optsys'] = None
+        return state
+
+    def clear_optical_system_cache(self):
+        """ Discard all cached optical systems for this instrument.
+
+        Call this after modifying any optical plane of a previously returned optical system in place,
+        or after changing data files on disk, to force the next calculation to rebuild its optics.
+        """
+        self._optsys_cache.clear()
+
+    # Options which vary between calls to calc_psf without affecting the optical system itself
+    _optsys_cache_ignored_options = ('monochromatic', 'nlambda')
+    # Instance attributes which are updated as side effects of a calculation, rather than being configuration
+    _optsys_cache_ignored_attributes = ('_spectra_cache', '_optsys_cache', '_extra_keywords', 'pupil_radius',
+                                        'optsys')
+
+    def _get_optical_system_cache_key(self, fft_oversample, detector_oversample, fov_arcsec, fov_pixels, options):
+        """ Return a hashable key describing the current configuration, for use in caching optical
+        systems. Returns None if the configuration cannot be cached.
+
+        The key includes all instance attributes (other than caches and calculation outputs), so that
+        changes to any attribute, including ones added by user subclasses, invalidate the cache.
+        """
+        if conf.optsys_cache_size <= 0:
+            return None
+        # Optics supplied as in-memory objects may be changed in place by the user, so don't cache those
+        for value in (self.pupil, self.pupilopd):
+            if not (value is None or isinstance(value, str) or
+                    (isinstance(value, tuple) and isinstance(value[0], str))):
+                return None
+
+        def _freeze_options(opts):
+            return {k: v for k, v in opts.items() if k not in self._optsys_cache_ignored_options}
+
+        state = {k: v for k, v in vars(self).items() if k not in self._optsys_cache_ignored_attributes}
+        state['options'] = _freeze_options(self.options)
+        try:
+            key = utils._make_hashable((self.__class__, state,
+                                        fft_oversample, detector_oversample, fov_arcsec, fov_pixels,
+                                        _freeze_options(options)))
+            hash(key)
+        except TypeError:
+            _log.debug("Optical system configuration is not hashable; not caching it.")
+            return None
+        return key
+
+    def _build_optical_system(self, fft_oversample=2, detector_oversample=None,
+                              fov_arcsec=2, fov_pixels=None, options=None):
+        """ Construct a new OpticalSystem for the current configuration, bypassing the cache.
+        See `get_optical_system` for parameters.
         """
 
         _log.info("Creating optical system model:")
@@ -526,6 +723,7 @@ class SpaceTelescopeInstrument(poppy.instrument.Instrument):
 
         return optsys
 
+    @profiling.stage('ote_pupil')
     def _get_telescope_pupil_and_aberrations(self):
         """return OpticalElement modeling wavefront aberrations for the telescope.
 
@@ -628,6 +826,8 @@ class SpaceTelescopeInstrument(poppy.instrument.Instrument):
             msg = "Couldn't find filter '{}' for {} in PySynphot or local throughput files"
             raise RuntimeError(msg.format(filtername, self.name))
 
+        import pysynphot
+
         # The existing FITS files all have wavelength in ANGSTROMS since that is
         # the pysynphot convention...
         filterfits = fits.open(filter_info.filename)
@@ -650,6 +850,27 @@ class SpaceTelescopeInstrument(poppy.instrument.Instrument):
         filterfits.close()
         return band
 
+    def calc_psf_basis(self, nlambda=None, cache=True, **kwargs):
+        """ Compute a cube of monochromatic PSFs spanning the bandpass of the current filter,
+        from which polychromatic PSFs for any source spectrum can be computed quickly.
+
+        Parameters
+        ----------
+        nlambda : int, optional
+            Number of wavelengths in the basis. Default is four times the default number of
+            wavelengths for the selected filter.
+        cache : bool
+            Load the basis from, and save it to, the on-disk cache if possible.
+        **kwargs
+            Other keyword arguments are passed to `calc_psf` for each wavelength.
+
+        Returns
+        -------
+        basis : webbpsf.spectral_basis.MonochromaticPSFBasis
+            Use ``basis.calc_psf(source)`` to compute a PSF for a given source spectrum.
+        """
+        return spectral_basis.MonochromaticPSFBasis(self, nlambda=nlambda, cache=cache, **kwargs)
+
     def psf_grid(self, num_psfs=16, all_detectors=True, save=False,
                  outdir=None, outfile=None, overwrite=True, verbose=True,
                  use_detsampled_psf=False, single_psf_centered=True, **kwargs):
@@ -752,6 +973,100 @@ class SpaceTelescopeInstrument(poppy.instrument.Instrument):
 
 #######  JWInstrument classes  #####
 
+def _distort_psf(result, instrument_name, crop_psf=True):
+    """ Apply the distortion effects for an instrument to extension 1 of a PSF HDUList
+
+    Returns a new HDUList. The data arrays of the unmodified extensions are shared with the input.
+    """
+    if instrument_name in ["NIRCam", "NIRISS", "FGS"]:
+        # Apply distortion effects: Rotation and optical distortion
+        _log.debug("NIRCam/NIRISS/FGS: Adding rotation and optical distortion")
+        with profiling.stage('rotation'):
+            psf_rotated = distortion.apply_rotation(result, crop=crop_psf)  # apply rotation
+        with profiling.stage('distortion'):
+            psf_distorted = distortion.apply_distortion(psf_rotated)  # apply siaf distortion model
+    elif instrument_name == "MIRI":
+        # Apply distortion effects to MIRI psf: Distortion and MIRI Scattering
+        _log.debug("MIRI: Adding optical distortion and Si:As detector internal scattering")
+        with profiling.stage('distortion'):
+            psf_siaf = distortion.apply_distortion(result)  # apply siaf distortion
+        with profiling.stage('miri_scattering'):
+            psf_distorted = distortion.apply_miri_scattering(psf_siaf)  # apply scattering effect
+    elif instrument_name == "NIRSpec":
+        # Apply distortion effects to NIRSpec psf: Distortion only
+        _log.debug("NIRSpec: Adding optical distortion")
+        with profiling.stage('distortion'):
+            psf_distorted = distortion.apply_distortion(result)  # apply siaf distortion model
+    else:
+        raise NotImplementedError("Distortion is not implemented for {}.".format(instrument_name))
+    return psf_distorted
+
+
+class _LazyPSFArrays(Mapping):
+    """ PSF arrays keyed by extension name, as returned by JWInstrument.calc_psf(return_arrays=True)
+
+    The keys and their order match the EXTNAMEs of the HDUList which calc_psf would otherwise
+    return. The distorted PSFs are only computed when first accessed. Arrays may share memory
+    with each other, so copy them before modifying any in place.
+
+    Attributes
+    ----------
+    header : astropy.io.fits.Header
+        Header of the oversampled PSF, with the keywords describing the calculation.
+    profile : dict or None
+        Timing and memory profile of the calculation, if options['profile'] was set.
+        See `webbpsf.profiling`.
+    """
+
+    def __init__(self, result, options, instrument_name):
+        self.header = result[0].header
+        self.profile = getattr(result, 'profile', None)
+        self._oversampled_hdu = result[0]
+        self._instrument_name = instrument_name
+        self._crop_psf = options.get('crop_psf', True)
+        self._detector_oversample = self.header['DET_SAMP']
+        self._arrays = {'OVERSAMP': result[0].data}
+
+        output_mode = options.get('output_mode', conf.default_output_mode).lower()
+        if 'oversampled' in output_mode:
+            samplings = ['OVER']
+        elif 'detector' in output_mode:
+            samplings = ['DET_']
+        else:
+            samplings = ['OVER', 'DET_']
+        kinds = ['SAMP', 'DIST'] if options.get('add_distortion', True) else ['SAMP']
+        self._keys = [sampling + kind for kind in kinds for sampling in samplings]
+
+    def _get(self, key):
+        if key not in self._arrays:
+            _log.debug("Computing PSF extension {} on first access".format(key))
+            if key == 'OVERDIST':
+                distortion_input = fits.HDUList([self._oversampled_hdu,
+                                                 fits.ImageHDU(self._oversampled_hdu.data,
+                                                               self._oversampled_hdu.header)])
+                distortion_input[1].header['EXTNAME'] = 'OVERDIST'
+                self._arrays[key] = _distort_psf(distortion_input, self._instrument_name,
+                                                 crop_psf=self._crop_psf)[1].data
+            elif self._detector_oversample > 1:
+                self._arrays[key] = poppy.utils.rebin_array(self._get('OVER' + key[4:]),
+                                                            rc=(self._detector_oversample,
+                                                                self._detector_oversample))
+            else:
+                self._arrays[key] = self._get('OVER' + key[4:])
+        return self._arrays[key]
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return self._get(key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+
 @utils.combine_docstrings
 class JWInstrument(SpaceTelescopeInstrument):
     """ Superclass for all JWST instruments
@@ -780,17 +1095,14 @@ class JWInstrument(SpaceTelescopeInstrument):
     def __init__(self, *args, **kwargs):
         super(JWInstrument, self).__init__(*args, **kwargs)
 
-        self.siaf = pysiaf.Siaf(self.name)
+        self.siaf = data_registry.get_siaf(self.name)
 
         opd_path = os.path.join(self._datapath, 'OPD')
-        self.opd_list = []
-        for filename in glob.glob(os.path.join(opd_path, 'OPD*.fits*')):
-            self.opd_list.append(os.path.basename(os.path.abspath(filename)))
+        self.opd_list = list(data_registry.get_opd_list(opd_path))
 
         if not len(self.opd_list) > 0:
             raise RuntimeError("No pupil OPD files found for {name} in {path}".format(name=self.name, path=opd_path))
 
-        self.opd_list.sort()
         self.pupilopd = self.opd_list[-1]
 
         self.pupil = os.path.abspath(os.path.join(
@@ -817,7 +1129,23 @@ class JWInstrument(SpaceTelescopeInstrument):
         """ Return default FOV in arcseconds """
         return 5  # default for all NIR instruments
 
+    # State used by calc_psfs while computing a batch of PSFs; not part of the instrument configuration
+    _batch_mode = False
+    _batch_template = None
+    _batch_si_wfe_coeffs = None
+    _optsys_cache_ignored_attributes = SpaceTelescopeInstrument._optsys_cache_ignored_attributes + (
+        '_batch_mode', '_batch_template', '_batch_si_wfe_coeffs')
+    # Options set by calc_psf which only affect the formatting of its output
+    _optsys_cache_ignored_options = SpaceTelescopeInstrument._optsys_cache_ignored_options + (
+        'add_distortion', 'crop_psf', 'return_arrays')
+
+    @profiling.stage('optical_system')
     def get_optical_system(self, fft_oversample=2, detector_oversample=None, fov_arcsec=2, fov_pixels=None, options=None):
+        if self._batch_template is not None:
+            # Within calc_psfs, only the detector position changes between PSFs,
+            # so reuse all the other optics and just swap in the SI aberrations for this position.
+            return self._get_optical_system_at_new_position()
+
         # invoke superclass version of this
         # then add a few display tweaks
         optsys = SpaceTelescopeInstrument.get_optical_system(self,
@@ -825,6 +1153,8 @@ class JWInstrument(SpaceTelescopeInstrument):
                                                               detector_oversample=detector_oversample,
                                                               fov_arcsec=fov_arcsec, fov_pixels=fov_pixels,
                                                               options=options)
+        if self._batch_mode:
+            self._batch_template = (optsys, self._extra_keywords.copy(), self.pupil_radius)
         # If the OTE model in the entrance pupil is a plain FITSOpticalElement, cast it to the linear model class
         if not isinstance(optsys.planes[0], opds.OTE_Linear_Model_WSS):
             lom_ote = opds.OTE_Linear_Model_WSS()
@@ -833,17 +1163,156 @@ class JWInstrument(SpaceTelescopeInstrument):
         optsys.planes[0].display_annotate = utils.annotate_ote_entrance_coords
         return optsys
 
-    def _get_aberrations(self):
+    def _get_optical_system_at_new_position(self):
+        """ Return a copy of the calc_psfs template optical system, with the SI aberration
+        plane(s) replaced by ones for the current detector position.
+
+        All other planes are shared with the template, except that an OTE linear model
+        built by WebbPSF is copied and updated for the new field position, so that
+        its field dependence model is applied there.
+        """
+        template, extra_keywords, pupil_radius = self._batch_template
+        self._extra_keywords = extra_keywords.copy()
+        self.pupil_radius = pupil_radius
+
+        optsys = copy.copy(template)
+        optsys.planes = list(template.planes)
+        optsys.__dict__.pop('calc_psf', None)  # don't keep any executor override bound to the template
+        ote = optsys.planes[0]
+        if isinstance(ote, opds.OTE_Linear_Model_WSS) and ote.v2v3 is not None and ote is not self.pupil:
+            # Shallow copy, sharing the segment masks and bases; update_opd rebuilds the OPD into a
+            # new array when v2v3 changes, so the template's OPD is left unchanged.
+            ote = copy.copy(ote)
+            ote.meta = ote.meta.copy()
+            ote.v2v3 = self._tel_coords()
+            ote.update_opd()
+            optsys.planes[0] = ote
+        if conf.use_shared_memory_executor:
+            parallel.enable_executor(optsys)
+        for i, plane in enumerate(optsys.planes):
+            if not isinstance(plane, self._si_wfe_class):
+                continue
+            # NIRSpec has a second SI aberration plane, for its spectrograph optics
+            where = getattr(plane, 'where', 'fore')
+            aberration_optic = self._get_aberrations() if where == 'fore' else self._get_aberrations(where=where)
+            aberration_optic.planetype = plane.planetype
+            optsys.planes[i] = aberration_optic
+            if where != 'fore':
+                continue
+            try:
+                inst_rms_wfe_nm = np.sqrt(np.mean(aberration_optic.opd[aberration_optic.amplitude == 1] ** 2)) * 1e9
+                self._extra_keywords['SI_WFE'] = (inst_rms_wfe_nm, '[nm] instrument pupil RMS wavefront error')
+            except TypeError:
+                pass
+            if hasattr(aberration_optic, 'header_keywords'):
+                self._extra_keywords.update(aberration_optic.header_keywords())
+        if self._single_precision():
+            _to_single_precision(optsys.planes)
+        return profiling.profile_optical_system(optsys)
+
+    def calc_psfs(self, positions, progress=None, **kwargs):
+        """ Compute PSFs at many detector positions in one call.
+
+        The telescope pupil, OPD and all other position-independent optics are set up once,
+        for the first position, and then only the field-dependent SI aberration plane is
+        replaced for each subsequent position. The SI WFE Zernike coefficients are evaluated
+        for all positions together. This is much faster than calling
+        `calc_psf` repeatedly while changing `detector_position`.
+
+        Parameters
+        ----------
+        positions : list of tuples
+            Detector pixel positions (X, Y), in the same convention as `detector_position`.
+        progress : callable, optional
+            Function called as ``progress(i, position)`` before computing the PSF for each
+            position, e.g. to print progress messages.
+        **kwargs
+            Any other arguments to `calc_psf`, used for every position.
+            Writing output files via `outfile` is not supported here.
+
+        Returns
+        -------
+        psf_cube : fits.HDUList
+            HDUList with the same extensions as `calc_psf` returns, except that each extension
+            contains a 3D array with axes [i, y, x], where i indexes the input positions.
+            Header keywords whose values differ between positions are omitted.
+        headers : list of lists of fits.Header
+            The full per-position headers; ``headers[i][ext]`` is the header of extension
+            ``ext`` for the PSF at ``positions[i]``.
+        """
+        if kwargs.get('outfile') is not None:
+            raise ValueError("calc_psfs does not support writing output files; save the returned cube instead.")
+        if kwargs.get('return_arrays'):
+            raise ValueError("calc_psfs does not support return_arrays.")
+        positions = [tuple(pos) for pos in positions]
+        if len(positions) == 0:
+            raise ValueError("At least one detector position must be specified.")
+
+        si_wfe_coeffs = [None] * len(positions)
+        if self.include_si_wfe:
+            coeffs, extrapolated = optics.get_si_wfe_coefficients(self, detector_positions=positions,
+                                                                  return_extrapolated=True)
+            si_wfe_coeffs = list(zip(coeffs, extrapolated))
+
+        original_position = self.detector_position
+        cubes = None
+        headers = []
+        try:
+            self._batch_mode = True
+            for i, (pos, pos_si_wfe_coeffs) in enumerate(zip(positions, si_wfe_coeffs)):
+                self.detector_position = pos
+                self._batch_si_wfe_coeffs = pos_si_wfe_coeffs
+                if progress is not None:
+                    progress(i, pos)
+                psf = self.calc_psf(**kwargs)
+                if cubes is None:
+                    # Fill in each extension's cube as we go, rather than keeping every HDUList
+                    cubes = [np.empty((len(positions),) + hdu.data.shape, dtype=hdu.data.dtype) for hdu in psf]
+                for ext, hdu in enumerate(psf):
+                    cubes[ext][i] = hdu.data
+                headers.append([hdu.header for hdu in psf])
+                del psf
+        finally:
+            self._batch_mode = False
+            self._batch_template = None
+            self._batch_si_wfe_coeffs = None
+            self.detector_position = original_position
+
+        psf_cube = fits.HDUList()
+        for ext, data in enumerate(cubes):
+            header = headers[0][ext].copy()
+            for key in set(header.keys()):
+                if key in ('', 'COMMENT', 'HISTORY'):
+                    continue
+                if any(pos_headers[ext].get(key) != header[key] for pos_headers in headers[1:]):
+                    del header[key]
+            header['NUM_PSFS'] = (len(positions), "The total number of PSFs in the cube")
+            for i, pos in enumerate(positions):
+                header["DET_YX{}".format(i)] = (str((pos[1], pos[0])),
+                                                "The #{} PSF's (y,x) detector pixel position".format(i))
+            hdu_class = fits.PrimaryHDU if ext == 0 else fits.ImageHDU
+            psf_cube.append(hdu_class(data, header=header))
+        return psf_cube, headers
+
+    @profiling.stage('si_wfe')
+    def _get_aberrations(self, **kwargs):
         """ return OpticalElement modeling wavefront aberrations for a given instrument,
         including field dependence based on a lookup table of Zernike coefficients derived from
         ISIM cryovac test data.
+
+        Any keyword arguments, such as where for NIRSpec, are passed on to the optic.
         """
         if not self.include_si_wfe:
             return None
 
-        optic = self._si_wfe_class(self)
+        if self._batch_si_wfe_coeffs is not None:
+            # Within calc_psfs, the coefficients have already been evaluated for this position
+            kwargs['zernike_coeffs'], kwargs['extrapolated'] = self._batch_si_wfe_coeffs
+
+        optic = self._si_wfe_class(self, **kwargs)
         return optic
 
+    @profiling.stage('ote_pupil')
     def _get_telescope_pupil_and_aberrations(self):
         """return OpticalElement modeling wavefront aberrations for the telescope.
 
@@ -899,13 +1368,14 @@ class JWInstrument(SpaceTelescopeInstrument):
             # TODO - more flexibly be smart about if the pupil size works for the LOM or not...
 
             if 'npix1024' in pupil_transmission:
-                # The linear model is limited to require 1024 pixels right now, so in this case (the default)
-                # we can use that:
+                # The linear model requires the 1024 pixel segment masks, so in this case (the default)
+                # we can use that, optionally downsampled to a coarser resolution:
                 pupil_optic = opds.OTE_Linear_Model_WSS(
                     name='{} Entrance Pupil'.format(self.telescope),
                     transmission=pupil_transmission,
                     opd=opd_map,
-                    v2v3=self._tel_coords()
+                    v2v3=self._tel_coords(),
+                    npix=self.options.get('pupil_npix')
                 )
             else:
                 _log.warning("Nonstandard resolution pupil, so linear model for OTE mirror moves is not supported")
@@ -941,7 +1411,7 @@ class JWInstrument(SpaceTelescopeInstrument):
             self.detector_position = (ap.XSciRef, ap.YSciRef)
 
             # Update DetectorGeometry class
-            self._detector_geom_info = DetectorGeometry(self.siaf, self._aperturename)
+            self._detector_geom_info = data_registry.get_detector_geometry(self.name, self._aperturename)
             _log.info(f"{self.name} SIAF aperture name updated to {self._aperturename}")
 
     def _tel_coords(self):
@@ -996,7 +1466,7 @@ class JWInstrument(SpaceTelescopeInstrument):
     def calc_psf(self, outfile=None, source=None, nlambda=None, monochromatic=None,
                  fov_arcsec=None, fov_pixels=None, oversample=None, detector_oversample=None, fft_oversample=None,
                  overwrite=True, display=False, save_intermediates=False, return_intermediates=False,
-                 normalize='first', add_distortion=True, crop_psf=True):
+                 normalize='first', add_distortion=True, crop_psf=True, return_arrays=False):
         """
         Compute a PSF
 
@@ -1010,12 +1480,21 @@ class JWInstrument(SpaceTelescopeInstrument):
             If True, when the PSF is rotated to match the detector's rotation in the focal
             plane, the PSF will be cropped so the shape of the distorted PSF will match it's
             undistorted counterpart. This will only be used for NIRCam, NIRISS, and FGS PSFs.
+        return_arrays : bool
+            If True, return a read-only mapping of the PSF arrays keyed by extension name
+            (e.g. 'OVERSAMP', 'DET_DIST'), instead of an HDUList. The distorted PSFs are only
+            computed when first accessed, which avoids the cost of the distortion calculations
+            for PSFs that are never used. The header of the oversampled PSF is available as the
+            mapping's `header` attribute. Cannot be used together with outfile.
 
         """
+        if return_arrays and outfile is not None:
+            raise ValueError("Cannot write an output file when return_arrays=True.")
 
         # Save new keywords to the options dictionary
         self.options['add_distortion'] = add_distortion
         self.options['crop_psf'] = crop_psf
+        self.options['return_arrays'] = return_arrays
 
         # Run poppy calc_psf
         psf = SpaceTelescopeInstrument.calc_psf(self, outfile=outfile, source=source, nlambda=nlambda,
@@ -1026,6 +1505,11 @@ class JWInstrument(SpaceTelescopeInstrument):
                                                 save_intermediates=save_intermediates,
                                                 return_intermediates=return_intermediates, normalize=normalize)
 
+        if return_arrays:
+            if return_intermediates:
+                psf, intermediates = psf
+                return _LazyPSFArrays(psf, self.options, self.name), intermediates
+            return _LazyPSFArrays(psf, self.options, self.name)
         return psf
 
     def _calc_psf_format_output(self, result, options):
@@ -1050,13 +1534,21 @@ class JWInstrument(SpaceTelescopeInstrument):
         add_distortion = options.get('add_distortion', True)
         crop_psf = options.get('crop_psf', True)
 
+        if add_distortion and self.image_mask == "LRS slit" and self.pupil_mask == "P750L LRS grating":
+            raise NotImplementedError("Distortion is not implemented yet for MIRI LRS mode.")
+
+        if options.get('return_arrays', False):
+            # Leave just the oversampled PSF; calc_psf wraps it in a _LazyPSFArrays which
+            # computes the other extensions when they are accessed
+            SpaceTelescopeInstrument._calc_psf_format_output(self, result, dict(options, output_mode='oversampled'))
+            return
+
         # Add distortion if set in calc_psf
         if add_distortion:
             _log.debug("Adding PSF distortion(s)")
-            if self.image_mask == "LRS slit" and self.pupil_mask == "P750L LRS grating":
-                raise NotImplementedError("Distortion is not implemented yet for MIRI LRS mode.")
 
-            # Set up new extensions to add distortion to:
+            # Set up new extensions to add distortion to. These initially share the undistorted data arrays,
+            # which the distortion functions replace rather than modify.
             n_exts = len(result)
             for ext in np.arange(n_exts):
                 hdu_new = fits.ImageHDU(result[ext].data, result[ext].header)  # these will be the PSFs that are edited
@@ -1065,21 +1557,7 @@ class JWInstrument(SpaceTelescopeInstrument):
                 result[ext_new].header["EXTNAME"] = result[ext].header["EXTNAME"][0:4] + "DIST"  # change extension name
                 _log.debug("Appending new extension {} with EXTNAME = {}".format(ext_new, result[ext_new].header["EXTNAME"]))
 
-            # Apply distortions based on the instrument
-            if self.name in ["NIRCam", "NIRISS", "FGS"]:
-                # Apply distortion effects: Rotation and optical distortion
-                _log.debug("NIRCam/NIRISS/FGS: Adding rotation and optical distortion")
-                psf_rotated = distortion.apply_rotation(result, crop=crop_psf)  # apply rotation
-                psf_distorted = distortion.apply_distortion(psf_rotated)  # apply siaf distortion model
-            elif self.name == "MIRI":
-                # Apply distortion effects to MIRI psf: Distortion and MIRI Scattering
-                _log.debug("MIRI: Adding optical distortion and Si:As detector internal scattering")
-                psf_siaf = distortion.apply_distortion(result)  # apply siaf distortion
-                psf_distorted = distortion.apply_miri_scattering(psf_siaf)  # apply scattering effect
-            elif self.name == "NIRSpec":
-                # Apply distortion effects to NIRSpec psf: Distortion only
-                _log.debug("NIRSpec: Adding optical distortion")
-                psf_distorted = distortion.apply_distortion(result)  # apply siaf distortion model
+            psf_distorted = _distort_psf(result, self.name, crop_psf=crop_psf)
 
             # Edit the variable to match if input didn't request distortion
             # (cannot set result = psf_distorted due to return method)
@@ -1200,6 +1678,7 @@ class JWInstrument(SpaceTelescopeInstrument):
         return shift_x, shift_y
 
 
+    @profiling.stage('jitter')
     def _apply_jitter(self,  result, local_options=None):
         """ Modify a PSF to account for the blurring effects of image jitter.
         Parameter arguments are taken from the options dictionary.
@@ -1733,7 +2212,7 @@ class NIRCam(JWInstrument):
                 self._detector = new_det
 
             # Update DetectorGeometry class
-            self._detector_geom_info = DetectorGeometry(self.siaf, self._aperturename)
+            self._detector_geom_info = data_registry.get_detector_geometry(self.name, self._aperturename)
             _log.info("NIRCam aperture name updated to {}".format(self._aperturename))
 
     @property
@@ -2146,7 +2625,7 @@ class NIRSpec(JWInstrument):
         # Add here a second instance of the instrument WFE, representing the WFE in the
         # collimator and camera.
         if self.include_si_wfe:
-            optsys.add_pupil(optic=self._si_wfe_class(self, where='spectrograph'))
+            optsys.add_pupil(optic=self._get_aberrations(where='spectrograph'))
 
         return (optsys, trySAM, SAM_box_size)
 